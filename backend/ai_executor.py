@@ -0,0 +1,246 @@
+"""
+Ejecutor acotado para las llamadas bloqueantes a Gemini
+Saca las generaciones del event loop para que /health, las subidas y el resto
+de usuarios sigan respondiendo mientras una carta tarda varios minutos
+"""
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
+from typing import Any, AsyncIterator, Callable, Dict, Iterable
+
+from backend.metrics import metrics
+
+
+# Tipos de mensaje entre el hilo productor y el event loop
+_ITEM = "item"
+_ERROR = "error"
+_DONE = "done"
+
+# Cada cuánto revisa el hilo productor si el consumidor abandonó el stream
+_PUT_POLL_SECONDS = 0.5
+
+
+class AIExecutorSaturated(Exception):
+    """
+    Se lanza cuando el ejecutor ya tiene todos sus hilos ocupados y la cola llena
+    """
+    pass
+
+
+class AIExecutor:
+    """
+    Pool de hilos con cola acotada para ejecutar funciones bloqueantes de IA
+    """
+
+    def __init__(self, max_workers: int = 4, max_queue: int = 32, name: str = "ai"):
+        """
+        Inicializa el ejecutor
+
+        Args:
+            max_workers: Número máximo de generaciones simultáneas
+            max_queue: Número máximo de generaciones esperando un hilo libre
+            name: Prefijo de los hilos y de las métricas
+        """
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.name = name
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix=f"{name}-worker"
+        )
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._publish_gauges()
+
+        print(f"Ejecutor de IA '{name}' inicializado: {max_workers} hilos, cola de {max_queue}")
+
+    async def run(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Ejecuta una función bloqueante en el pool sin bloquear el event loop
+
+        Args:
+            func: Función a ejecutar
+            *args: Argumentos posicionales de la función
+            **kwargs: Argumentos nombrados de la función
+
+        Returns:
+            El valor devuelto por la función
+
+        Raises:
+            AIExecutorSaturated: Si la cola está llena
+        """
+        return await asyncio.wrap_future(self.submit(func, *args, **kwargs))
+
+    def submit(self, func: Callable[..., Any], *args, **kwargs) -> Future:
+        """
+        Encola una función bloqueante en el pool
+
+        Args:
+            func: Función a ejecutar
+            *args: Argumentos posicionales de la función
+            **kwargs: Argumentos nombrados de la función
+
+        Returns:
+            Future: Future de concurrent.futures con el resultado
+
+        Raises:
+            AIExecutorSaturated: Si la cola está llena
+        """
+        self._reserve_slot()
+
+        def task():
+            with self._lock:
+                self._queued -= 1
+                self._running += 1
+            self._publish_gauges()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                self._publish_gauges()
+
+        future = self._executor.submit(task)
+        future.add_done_callback(self._release_if_cancelled)
+        return future
+
+    async def stream(
+        self,
+        iterator_factory: Callable[..., Iterable[Any]],
+        *args,
+        queue_size: int = 64,
+        **kwargs
+    ) -> AsyncIterator[Any]:
+        """
+        Consume un iterador síncrono (p. ej. el streaming de Gemini) en un hilo
+        del pool y entrega sus elementos de forma asíncrona
+
+        El hilo productor deposita cada elemento en una asyncio.Queue acotada;
+        si el cliente SSE lee más lento que Gemini, el hilo espera en lugar de
+        acumular chunks en memoria. Cerrar el generador asíncrono detiene al
+        productor y cierra el iterador síncrono.
+
+        Args:
+            iterator_factory: Función que devuelve el iterador síncrono
+            *args: Argumentos posicionales de la función
+            queue_size: Máximo de elementos en tránsito entre el hilo y el loop
+            **kwargs: Argumentos nombrados de la función
+
+        Yields:
+            Los elementos del iterador, en orden
+
+        Raises:
+            AIExecutorSaturated: Si la cola del pool está llena
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        stop_event = threading.Event()
+
+        def put(message) -> bool:
+            # Espera mientras la cola está llena, pero abandona si el consumidor se fue
+            future = asyncio.run_coroutine_threadsafe(queue.put(message), loop)
+            while True:
+                try:
+                    future.result(timeout=_PUT_POLL_SECONDS)
+                    return True
+                except FutureTimeoutError:
+                    if stop_event.is_set():
+                        future.cancel()
+                        return False
+
+        def pump():
+            iterator = None
+            try:
+                # Si la función falla al abrir el stream, el error también llega al consumidor
+                iterator = iter(iterator_factory(*args, **kwargs))
+                for item in iterator:
+                    if stop_event.is_set() or not put((_ITEM, item)):
+                        return
+                put((_DONE, None))
+            except Exception as e:
+                if not stop_event.is_set():
+                    put((_ERROR, e))
+            finally:
+                close = getattr(iterator, "close", None)
+                if close:
+                    try:
+                        close()
+                    except Exception as e:
+                        print(f"Error al cerrar el stream de '{self.name}': {e}")
+
+        producer = self.submit(pump)
+        producer.add_done_callback(_consume_exception)
+
+        try:
+            while True:
+                kind, payload = await queue.get()
+                if kind == _ITEM:
+                    yield payload
+                elif kind == _ERROR:
+                    raise payload
+                else:
+                    return
+        finally:
+            stop_event.set()
+            producer.cancel()
+
+    def _reserve_slot(self):
+        """
+        Reserva un lugar en la cola o lanza AIExecutorSaturated
+        """
+        with self._lock:
+            if self._queued + self._running >= self.max_workers + self.max_queue:
+                metrics.increment(f"{self.name}_executor_rejected")
+                raise AIExecutorSaturated(
+                    f"El ejecutor de IA está saturado ({self._running} en curso, {self._queued} en cola)"
+                )
+            self._queued += 1
+        self._publish_gauges()
+
+    def _release_if_cancelled(self, future: Future):
+        """
+        Libera el lugar en la cola si la tarea se canceló antes de empezar
+        """
+        if future.cancelled():
+            with self._lock:
+                self._queued -= 1
+            self._publish_gauges()
+
+    def _publish_gauges(self):
+        """
+        Publica la profundidad de la cola y los hilos activos
+        """
+        metrics.set_gauge(f"{self.name}_executor_queue_depth", self._queued)
+        metrics.set_gauge(f"{self.name}_executor_active", self._running)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Obtiene el estado actual del ejecutor
+
+        Returns:
+            dict: Hilos máximos, tamaño de cola, tareas en curso y en cola
+        """
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "running": self._running,
+                "queued": self._queued
+            }
+
+    def shutdown(self):
+        """
+        Detiene el pool sin esperar a las generaciones en curso
+        """
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _consume_exception(future: Future):
+    """
+    Recupera la excepción de un future en segundo plano para que no quede sin leer
+    """
+    if not future.cancelled():
+        future.exception()
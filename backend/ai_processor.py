@@ -5,11 +5,109 @@ Integración con Google Gemini API
 
 import os
 import time
+import json
+import hashlib
+import queue
+import threading
 import xml.etree.ElementTree as ET
-from typing import Optional, Dict
+from typing import Optional, Dict, List
 import google.generativeai as genai
 from pathlib import Path
 
+from backend.ocr import IMAGE_EXTENSIONS
+from backend.gemini_scheduler import GeminiQueueTimeout, PRIORITY_INTERACTIVE, gemini_turn
+from backend.gemini_retry import RetryPolicy, RetryRecord, call_with_retry, stream_with_retry
+from backend.deadline import Deadline, GenerationDeadlineExceeded, StallWatchdog
+from backend.circuit_breaker import CircuitBreakerRegistry, CircuitOpenError
+from backend.gemini_keys import GeminiKeyPool
+from backend.hedging import HedgePolicy
+from backend.continuation import SeamStitcher, continuation_request, hit_max_tokens, response_text, trim_overlap
+from backend.case_facts import EXTRACTION_INSTRUCTIONS, format_case_facts, parse_case_facts
+from backend.context_cache import CACHE_MISSING_ERRORS, ContextCache
+from backend.ai_executor import AIExecutor
+from backend.metrics import metrics
+
+
+class GenerationCancelled(Exception):
+    """
+    Se lanza cuando una generación en streaming se cancela porque el cliente ya no la necesita
+    """
+    pass
+
+
+def abort_stream(response):
+    """
+    Cancela el iterador de transporte (gRPC o REST) de una respuesta en streaming
+    
+    Args:
+        response: GenerateContentResponse devuelto por generate_content(stream=True)
+    """
+    iterator = getattr(response, "_iterator", None)
+    cancel = getattr(iterator, "cancel", None)
+    if cancel:
+        try:
+            cancel()
+        except Exception as e:
+            print(f"No se pudo cancelar el stream de Gemini: {e}")
+
+
+class StreamCancellation:
+    """
+    Permite cortar desde otro hilo un generate_content(stream=True) en curso
+    """
+    
+    def __init__(self):
+        """
+        Inicializa la cancelación sin respuesta asociada
+        """
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._response = None
+    
+    @property
+    def cancelled(self) -> bool:
+        """
+        Indica si se pidió la cancelación
+        """
+        return self._event.is_set()
+    
+    def attach(self, response):
+        """
+        Asocia la respuesta en streaming de Gemini que se debe cortar
+        
+        Args:
+            response: GenerateContentResponse devuelto por generate_content(stream=True)
+        """
+        with self._lock:
+            self._response = response
+        if self.cancelled:
+            self._abort(response)
+    
+    def wait(self, timeout: float) -> bool:
+        """
+        Espera hasta timeout segundos o hasta que se cancele
+        
+        Returns:
+            bool: True si se canceló
+        """
+        return self._event.wait(timeout)
+    
+    def cancel(self):
+        """
+        Marca la generación como cancelada y cierra la conexión con Gemini
+        """
+        self._event.set()
+        with self._lock:
+            response = self._response
+        if response is not None:
+            self._abort(response)
+    
+    def _abort(self, response):
+        """
+        Cancela el iterador de transporte (gRPC o REST) de la respuesta
+        """
+        abort_stream(response)
+
 
 class AIProcessor:
     """
@@ -23,7 +121,7 @@ class AIProcessor:
         Args:
             api_key: API key de Google Gemini
             model_name: Nombre del modelo a usar
-            request_timeout: Timeout en segundos para las solicitudes (default: 300s = 5 minutos)
+            request_timeout: Plazo total en segundos de cada generación (default: 300s = 5 minutos)
         """
         self.api_key = api_key
         self.model_name = model_name
@@ -33,8 +131,49 @@ class AIProcessor:
         self.cover_letter_system_prompt = ""
         self.cover_letter_structure = ""
         
-        # Configurar Gemini
-        genai.configure(api_key=api_key)
+        # Extractor de PDF por páginas en paralelo y OCR local (opcionales, los asigna la aplicación)
+        self.pdf_extractor = None
+        self.ocr = None
+        
+        # Planificador compartido de llamadas a Gemini (opcional, lo asigna la aplicación)
+        self.scheduler = None
+        
+        # Reintentos ante errores transitorios (429, 503...) dentro del timeout total
+        self.retry_policy = RetryPolicy(deadline_seconds=request_timeout)
+        
+        # Segundos máximos sin recibir chunks antes de cortar un stream (0 = sin límite)
+        self.stall_timeout = 60
+        
+        # Circuit breaker por modelo y modelos de respaldo mientras el principal
+        # tiene el circuito abierto (la aplicación asigna el registro compartido)
+        self.breakers = CircuitBreakerRegistry()
+        self.fallback_models: List[str] = []
+        self._fallback_clients: Dict[tuple, genai.GenerativeModel] = {}
+        
+        # Solicitudes de respaldo si el primer chunk tarda (None = desactivado, lo asigna la aplicación)
+        self.hedging: Optional[HedgePolicy] = None
+        
+        # Continuaciones automáticas si la respuesta se corta por max_output_tokens (0 = ninguna)
+        self.max_continuations = 3
+        
+        # Cover Letter por secciones en paralelo (encabezado y secciones I-VI de
+        # CoverLetterStructure.xml); lo activa la aplicación
+        self.cover_letter_parallel_sections = False
+        self.cover_letter_sections: List[Dict[str, str]] = []
+        # Ejecutor acotado donde corre cada sección (sin él se genera el Cover Letter completo)
+        self.section_executor: Optional[AIExecutor] = None
+        
+        # Extracción previa de los hechos del caso: la Declaration Letter se genera
+        # a partir del JSON de hechos en lugar del cuestionario completo (lo activa la aplicación)
+        self.case_facts_enabled = False
+        
+        # Caché de contexto para el prefijo estable de los prompts (None = prompt completo
+        # en cada llamada, la asigna la aplicación)
+        self.context_cache: Optional[ContextCache] = None
+        
+        # API keys de Gemini: cada llamada usa el cliente de una key del pool, sin
+        # configuración global (la aplicación asigna el pool compartido)
+        self.keys = GeminiKeyPool([api_key])
         
         # Configuración de generación estándar
         self.generation_config = {
@@ -53,6 +192,14 @@ class AIProcessor:
             "candidate_count": 1,  # Solo una respuesta para ser más rápido
         }
         
+        # Configuración para la extracción de hechos del caso (JSON, sin creatividad)
+        self.case_facts_generation_config = {
+            "temperature": 0.1,
+            "top_p": 0.95,
+            "max_output_tokens": 8000,
+            "response_mime_type": "application/json",
+        }
+        
         # Configuración de seguridad
         self.safety_settings = [
             {
@@ -87,6 +234,13 @@ class AIProcessor:
             safety_settings=self.safety_settings
         )
         
+        # Modelo para la extracción de hechos del caso
+        self.case_facts_model = genai.GenerativeModel(
+            model_name=model_name,
+            generation_config=self.case_facts_generation_config,
+            safety_settings=self.safety_settings
+        )
+        
         print(f"Procesador de IA inicializado con modelo: {model_name}")
         print(f"Timeout configurado: {request_timeout} segundos")
     
@@ -137,6 +291,9 @@ class AIProcessor:
             with open(structure_path, 'r', encoding='utf-8') as f:
                 self.cover_letter_structure = f.read()
             
+            # Partes que se pueden generar por separado (modo por secciones)
+            self.cover_letter_sections = self._parse_cover_letter_sections(self.cover_letter_structure)
+            
             print("Archivos XML de Cover Letter cargados correctamente")
             return True
         
@@ -144,6 +301,48 @@ class AIProcessor:
             print(f"Error al cargar archivos XML de Cover Letter: {e}")
             return False
     
+    def _parse_cover_letter_sections(self, structure_xml: str) -> List[Dict[str, str]]:
+        """
+        Divide CoverLetterStructure.xml en las partes del Cover Letter que se
+        pueden generar por separado: encabezado y capítulos I-VI (el último con
+        el bloque de firma)
+        
+        Args:
+            structure_xml: Contenido de CoverLetterStructure.xml
+        
+        Returns:
+            list: [{'id', 'title', 'guide', 'style'}] en el orden de la carta, o [] si no se puede dividir
+        """
+        try:
+            root = ET.fromstring(structure_xml)
+        except ET.ParseError as e:
+            print(f"No se pudo dividir CoverLetterStructure.xml en secciones: {e}")
+            return []
+        
+        def xml(element) -> str:
+            return ET.tostring(element, encoding="unicode") if element is not None else ""
+        
+        style = xml(root.find("./chapter_explanations/writing_style"))
+        header = root.find("./chapter_explanations/template_example")
+        chapters = root.findall("./chapter_explanations/chapter")
+        signature = root.find("./conclusion_and_signature")
+        if header is None or not chapters:
+            print("CoverLetterStructure.xml no tiene encabezado y capítulos; se genera el Cover Letter completo")
+            return []
+        
+        sections = [{"id": "header", "title": "", "guide": xml(header), "style": style}]
+        for position, chapter in enumerate(chapters):
+            guide = xml(chapter)
+            if position == len(chapters) - 1:
+                guide += "\n" + xml(signature)
+            sections.append({
+                "id": chapter.get("id", str(position + 1)),
+                "title": chapter.get("title", ""),
+                "guide": guide,
+                "style": style,
+            })
+        return sections
+    
     def extract_text_from_file(self, file_path: str) -> Optional[str]:
         """
         Extrae texto de un archivo
@@ -170,15 +369,27 @@ class AIProcessor:
                     text = []
                     for paragraph in doc.paragraphs:
                         text.append(paragraph.text)
-                    return '\n'.join(text)
+                    docx_text = '\n'.join(text)
                 except ImportError:
                     # Si python-docx no está disponible, intentar lectura básica
                     print("Advertencia: python-docx no disponible, usando lectura básica")
-                    return self._extract_text_from_docx_basic(file_path)
+                    docx_text = self._extract_text_from_docx_basic(file_path)
+                
+                # DOCX con páginas escaneadas pegadas como imágenes
+                if self.ocr and self.ocr.available and len((docx_text or '').strip()) < self.ocr.min_page_chars:
+                    images = self.ocr.docx_images(file_path)
+                    if images:
+                        print(f"DOCX sin texto: aplicando OCR a {len(images)} imágenes")
+                        ocr_text = '\n'.join(t.strip() for t in self.ocr.recognize(images) if t.strip())
+                        docx_text = '\n'.join(t for t in [docx_text, ocr_text] if t)
+                return docx_text
             
             # Para archivos PDF
             elif file_extension == '.pdf':
                 try:
+                    if self.pdf_extractor:
+                        return self.pdf_extractor.extract(file_path)
+                    
                     import PyPDF2
                     with open(file_path, 'rb') as f:
                         pdf_reader = PyPDF2.PdfReader(f)
@@ -190,6 +401,14 @@ class AIProcessor:
                     print("Advertencia: PyPDF2 no disponible")
                     return None
             
+            # Para fotos o escaneos del cuestionario
+            elif file_extension in IMAGE_EXTENSIONS:
+                if not self.ocr or not self.ocr.available:
+                    print("Advertencia: OCR no disponible para procesar imágenes")
+                    return None
+                with open(file_path, 'rb') as f:
+                    return self.ocr.recognize([f.read()])[0]
+            
             else:
                 print(f"Tipo de archivo no soportado: {file_extension}")
                 return None
@@ -232,38 +451,54 @@ class AIProcessor:
             print(f"Error en extracción básica de DOCX: {e}")
             return None
     
-    def generate_declaration_letter(self, questionnaire_text: str) -> Optional[str]:
+    def generate_declaration_letter(
+        self,
+        questionnaire_text: str,
+        priority: int = PRIORITY_INTERACTIVE,
+        fairness_key: Optional[str] = None,
+        retry_record: Optional[RetryRecord] = None,
+        deadline: Optional[Deadline] = None,
+        case_facts: Optional[Dict] = None
+    ) -> Optional[str]:
         """
         Genera una declaration letter basada en el cuestionario
         
         Args:
             questionnaire_text: Texto del cuestionario del afectado
+            priority: Prioridad en el planificador de Gemini
+            fairness_key: Documento o usuario, para repartir los turnos con equidad
+            retry_record: Registra los intentos hechos (opcional)
+            deadline: Plazo total de la generación (default: request_timeout desde ahora)
+            case_facts: Hechos del caso extraídos del cuestionario; si se dan, reemplazan al cuestionario en el prompt
         
         Returns:
             str: Declaration letter en formato Markdown o None si hay error
         """
         try:
             # Construir el prompt completo
-            full_prompt = self._build_prompt(questionnaire_text)
+            full_prompt = self._build_prompt(questionnaire_text, case_facts)
             
             print("Generando declaration letter con IA...")
             print(f"Usando timeout de {self.request_timeout} segundos...")
+            deadline = deadline or Deadline(self.request_timeout)
             
-            # Generar respuesta (el timeout está configurado en el cliente HTTP)
+            # Generar respuesta dentro del plazo total
             start_time = time.time()
             
-            response = self.model.generate_content(full_prompt)
+            text = self._generate_text("declaration", full_prompt, priority, fairness_key, retry_record, deadline)
             
             elapsed_time = time.time() - start_time
             print(f"Generacion completada en {elapsed_time:.2f} segundos")
             
-            if response and response.text:
+            if text:
                 print("Declaration letter generada exitosamente")
-                return response.text
+                return text
             else:
                 print("No se pudo generar contenido")
                 return None
         
+        except (GeminiQueueTimeout, GenerationDeadlineExceeded, CircuitOpenError):
+            raise
         except Exception as e:
             error_msg = str(e)
             if "timeout" in error_msg.lower() or "timed out" in error_msg.lower() or "ReadTimeout" in str(type(e).__name__):
@@ -271,32 +506,34 @@ class AIProcessor:
                 print("Sugerencia: El documento es muy largo o el servidor esta ocupado. Intente nuevamente.")
             else:
                 print(f"Error al generar declaration letter: {e}")
-            raise Exception(f"Error al generar declaration letter: {error_msg}")
+            raise Exception(f"Error al generar declaration letter: {error_msg}") from e
     
-    def _build_prompt(self, questionnaire_text: str) -> str:
+    def _build_prompt(self, questionnaire_text: str, case_facts: Optional[Dict] = None) -> str:
         """
         Construye el prompt completo para la IA
         
         Args:
             questionnaire_text: Texto del cuestionario
+            case_facts: Hechos del caso extraídos del cuestionario (si se dan, se usan en su lugar)
         
         Returns:
             str: Prompt completo
         """
-        prompt = f"""
-{self.system_prompt}
-
-{self.declaration_guide}
-
----
-
-CUESTIONARIO DEL AFECTADO:
-{questionnaire_text}
+        if case_facts is not None:
+            source = f"""HECHOS DEL CASO (extraídos del cuestionario del afectado, en JSON):
+{format_case_facts(case_facts)}"""
+            source_name = "los hechos del caso proporcionados (no inventes hechos que no aparezcan en ellos)"
+        else:
+            source = f"""CUESTIONARIO DEL AFECTADO:
+{questionnaire_text}"""
+            source_name = "el cuestionario proporcionado"
+        
+        prompt = self._declaration_prompt_prefix() + f"""{source}
 
 ---
 
 INSTRUCCIONES FINALES:
-Basándote en el System Prompt, la Declaration Guide y el cuestionario proporcionado, genera una Declaration Letter completa en formato Markdown. 
+Basándote en el System Prompt, la Declaration Guide y {source_name}, genera una Declaration Letter completa en formato Markdown. 
 
 IMPORTANTE:
 1. Usa EXACTAMENTE el formato Markdown especificado (## para secciones, numeración consecutiva de párrafos)
@@ -314,12 +551,91 @@ Genera la declaration letter ahora:
 """
         return prompt
     
-    def generate_cover_letter(self, declaration_letter_content: str) -> Optional[str]:
+    def _declaration_prompt_prefix(self) -> str:
+        """
+        Parte estable del prompt de la Declaration Letter (System Prompt y
+        Declaration Guide), igual en todas las llamadas
+        
+        Returns:
+            str: Prefijo del prompt
+        """
+        return f"""
+{self.system_prompt}
+
+{self.declaration_guide}
+
+---
+
+"""
+    
+    def extract_case_facts(
+        self,
+        questionnaire_text: str,
+        priority: int = PRIORITY_INTERACTIVE,
+        fairness_key: Optional[str] = None,
+        retry_record: Optional[RetryRecord] = None,
+        deadline: Optional[Deadline] = None
+    ) -> Dict:
+        """
+        Extrae del cuestionario los hechos del caso en JSON (primera etapa de la generación)
+        
+        Args:
+            questionnaire_text: Texto del cuestionario del afectado
+            priority: Prioridad en el planificador de Gemini
+            fairness_key: Documento o usuario, para repartir los turnos con equidad
+            retry_record: Registra los intentos hechos (opcional)
+            deadline: Plazo total de la generación (default: request_timeout desde ahora)
+        
+        Returns:
+            dict: Hechos del caso
+        
+        Raises:
+            ValueError: Si la respuesta no es un objeto JSON
+        """
+        full_prompt = self._build_case_facts_prompt(questionnaire_text)
+        
+        print("Extrayendo hechos del caso con IA...")
+        deadline = deadline or Deadline(self.request_timeout)
+        text = self._generate_text("facts", full_prompt, priority, fairness_key, retry_record, deadline)
+        return parse_case_facts(text)
+    
+    def _build_case_facts_prompt(self, questionnaire_text: str) -> str:
+        """
+        Construye el prompt de la extracción de hechos del caso
+        
+        Args:
+            questionnaire_text: Texto del cuestionario
+        
+        Returns:
+            str: Prompt completo
+        """
+        prompt = f"""
+Eres un asistente que prepara casos de T-Visa. Lee el cuestionario que respondió el afectado.
+
+CUESTIONARIO DEL AFECTADO:
+{questionnaire_text}
+
+---
+{EXTRACTION_INSTRUCTIONS}"""
+        return prompt
+    
+    def generate_cover_letter(
+        self,
+        declaration_letter_content: str,
+        priority: int = PRIORITY_INTERACTIVE,
+        fairness_key: Optional[str] = None,
+        retry_record: Optional[RetryRecord] = None,
+        deadline: Optional[Deadline] = None
+    ) -> Optional[str]:
         """
         Genera un Cover Letter basado en el Declaration Letter
         
         Args:
             declaration_letter_content: Contenido completo del Declaration Letter
+            priority: Prioridad en el planificador de Gemini
+            fairness_key: Documento o usuario, para repartir los turnos con equidad
+            retry_record: Registra los intentos hechos (opcional)
+            deadline: Plazo total de la generación (default: request_timeout desde ahora)
         
         Returns:
             str: Cover Letter en formato Markdown o None si hay error
@@ -335,23 +651,30 @@ Genera la declaration letter ahora:
             
             print("Generando Cover Letter con IA...")
             print(f"Usando timeout de {self.request_timeout} segundos...")
+            deadline = deadline or Deadline(self.request_timeout)
             
-            # Generar respuesta usando el modelo optimizado para Cover Letter
-            # (el timeout está configurado en el cliente HTTP)
+            # Generar respuesta usando el modelo optimizado para Cover Letter, dentro del plazo total
             start_time = time.time()
             
-            response = self.cover_letter_model.generate_content(full_prompt)
+            if self._cover_sections_enabled():
+                text = "".join(self._stream_cover_sections(
+                    declaration_letter_content, None, priority, fairness_key, retry_record, deadline
+                ))
+            else:
+                text = self._generate_text("cover", full_prompt, priority, fairness_key, retry_record, deadline)
             
             elapsed_time = time.time() - start_time
             print(f"Generacion completada en {elapsed_time:.2f} segundos")
             
-            if response and response.text:
+            if text:
                 print("Cover Letter generado exitosamente")
-                return response.text
+                return text
             else:
                 print("No se pudo generar contenido para el Cover Letter")
                 return None
         
+        except (GeminiQueueTimeout, GenerationDeadlineExceeded, CircuitOpenError):
+            raise
         except Exception as e:
             error_msg = str(e)
             if "timeout" in error_msg.lower() or "timed out" in error_msg.lower() or "ReadTimeout" in str(type(e).__name__):
@@ -359,7 +682,7 @@ Genera la declaration letter ahora:
                 print("Sugerencia: El documento es muy largo o el servidor esta ocupado. Intente nuevamente.")
             else:
                 print(f"Error al generar Cover Letter: {e}")
-            raise Exception(f"Error al generar Cover Letter: {error_msg}")
+            raise Exception(f"Error al generar Cover Letter: {error_msg}") from e
     
     def _build_cover_letter_prompt(self, declaration_letter_content: str) -> str:
         """
@@ -371,14 +694,7 @@ Genera la declaration letter ahora:
         Returns:
             str: Prompt completo
         """
-        prompt = f"""
-{self.cover_letter_system_prompt}
-
-{self.cover_letter_structure}
-
----
-
-DECLARATION LETTER DEL SOBREVIVIENTE:
+        prompt = self._cover_letter_prompt_prefix() + f"""DECLARATION LETTER DEL SOBREVIVIENTE:
 {declaration_letter_content}
 
 ---
@@ -416,54 +732,238 @@ Genera el Cover Letter ahora:
 """
         return prompt
     
-    def generate_declaration_letter_stream(self, questionnaire_text: str):
+    def _cover_letter_prompt_prefix(self) -> str:
+        """
+        Parte estable del prompt del Cover Letter (System Prompt y estructura), igual en todas las llamadas
+        
+        Returns:
+            str: Prefijo del prompt
+        """
+        return f"""
+{self.cover_letter_system_prompt}
+
+{self.cover_letter_structure}
+
+---
+
+"""
+    
+    def _build_cover_letter_section_prompt(self, declaration_letter_content: str, section: Dict[str, str]) -> str:
+        """
+        Construye el prompt de una sola parte del Cover Letter (modo por secciones)
+        
+        Args:
+            declaration_letter_content: Contenido del Declaration Letter
+            section: Parte de cover_letter_sections
+        
+        Returns:
+            str: Prompt de la parte
+        """
+        if section["id"] == "header":
+            task = (
+                "el ENCABEZADO del Cover Letter: fecha, método de envío y dirección de USCIS, "
+                "línea RE: con el nombre del aplicante, referencia al formulario, saludo y párrafo de apertura. "
+                "NO escribas ninguna de las secciones I-VI"
+            )
+        else:
+            task = (
+                f"la Sección {section['id']}: {section['title']}. Empieza con el título de la sección en una "
+                f"línea propia ({section['id']}. {section['title']}) y NO escribas el encabezado de la carta "
+                f"ni ninguna otra sección"
+            )
+            if section is self.cover_letter_sections[-1]:
+                task += ". Termina con el bloque de firma profesional"
+        
+        prompt = self._cover_section_prompt_prefix(section["style"]) + f"""GUÍA DE ESTA PARTE DEL COVER LETTER:
+{section["guide"]}
+
+---
+
+DECLARATION LETTER DEL SOBREVIVIENTE:
+{declaration_letter_content}
+
+---
+
+INSTRUCCIONES FINALES:
+Estás redactando UNA parte de un Cover Letter para una petición de T-Visa. Las demás partes se redactan por separado y se unirán en orden, así que no repitas contenido de otras secciones ni anuncies lo que viene.
+
+Genera SOLAMENTE {task}.
+
+IMPORTANTE:
+1. Escribe en tercera persona neutral ("the applicant", "the declarant", "the victim")
+2. Incluye citas del Declaration Letter usando el formato [Decl. ¶ n] y citas de regulaciones cuando sean requeridas (8 C.F.R., INA)
+3. Respeta la extensión y el número de párrafos indicados en la guía de esta parte
+4. NO incluyas texto introductorio de tu parte como asistente ni disclaimers o notas del AI
+5. Sigue el estilo formal persuasivo narrativo especificado
+6. Evita usar guiones largos (em dashes)
+
+Genera esta parte ahora:
+"""
+        return prompt
+    
+    def _cover_section_prompt_prefix(self, style: str) -> str:
+        """
+        Parte estable de los prompts por secciones del Cover Letter (System Prompt
+        y estilo de redacción), común a todas las secciones
+        
+        Args:
+            style: Estilo de redacción de las secciones
+        
+        Returns:
+            str: Prefijo del prompt
+        """
+        return f"""
+{self.cover_letter_system_prompt}
+
+ESTILO DE REDACCIÓN (común a todo el Cover Letter):
+{style}
+
+"""
+    
+    def _stable_prompt_prefix(self, full_prompt: str) -> Optional[str]:
+        """
+        Obtiene el prefijo estable con el que empieza un prompt (el que se guarda en la caché de contexto)
+        
+        Args:
+            full_prompt: Prompt completo de la llamada
+        
+        Returns:
+            str: Prefijo, o None si el prompt no empieza con ninguno
+        """
+        prefixes = [self._declaration_prompt_prefix(), self._cover_letter_prompt_prefix()]
+        if self.cover_letter_sections:
+            prefixes.append(self._cover_section_prompt_prefix(self.cover_letter_sections[0]["style"]))
+        for prefix in prefixes:
+            if full_prompt.startswith(prefix):
+                return prefix
+        return None
+
+    def generation_fingerprint(self, kind: str) -> str:
+        """
+        Obtiene una huella de todo lo que, además del texto de entrada, determina
+        el resultado de una generación: modelo, configuración y prompt (XML y plantilla)
+        
+        Args:
+            kind: Tipo de generación ('declaration', 'cover' o 'facts')
+        
+        Returns:
+            str: Hash SHA-256 en hexadecimal
+        """
+        if kind == "facts":
+            config = self.case_facts_generation_config
+            prompt_template = self._build_case_facts_prompt("")
+        elif kind == "cover":
+            config = self.cover_letter_generation_config
+            if self._cover_sections_enabled():
+                prompt_template = "".join(
+                    self._build_cover_letter_section_prompt("", section) for section in self.cover_letter_sections
+                )
+            else:
+                prompt_template = self._build_cover_letter_prompt("")
+        elif self.case_facts_enabled:
+            # La declaración depende también de cómo se extraen los hechos
+            config = self.generation_config
+            prompt_template = self._build_prompt("", {}) + self.generation_fingerprint("facts")
+        else:
+            config = self.generation_config
+            prompt_template = self._build_prompt("")
+        
+        fingerprint = json.dumps({
+            "model": self.model_name,
+            "generation_config": config,
+            "prompt_sha256": hashlib.sha256(prompt_template.encode("utf-8")).hexdigest(),
+        }, sort_keys=True)
+        return hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()
+    
+    def generate_declaration_letter_stream(
+        self,
+        questionnaire_text: str,
+        cancellation: Optional[StreamCancellation] = None,
+        priority: int = PRIORITY_INTERACTIVE,
+        fairness_key: Optional[str] = None,
+        retry_record: Optional[RetryRecord] = None,
+        deadline: Optional[Deadline] = None,
+        case_facts: Optional[Dict] = None
+    ):
         """
         Genera una declaration letter basada en el cuestionario usando streaming
         
         Args:
             questionnaire_text: Texto del cuestionario del afectado
+            cancellation: Permite detener la generación desde otro hilo (opcional)
+            priority: Prioridad en el planificador de Gemini
+            fairness_key: Documento o usuario, para repartir los turnos con equidad
+            retry_record: Registra los intentos hechos (opcional)
+            deadline: Plazo total de la generación (default: request_timeout desde ahora)
+            case_facts: Hechos del caso extraídos del cuestionario; si se dan, reemplazan al cuestionario en el prompt
         
         Yields:
             str: Chunks de texto generados en tiempo real
+        
+        Raises:
+            GenerationCancelled: Si se canceló la generación
+            GenerationDeadlineExceeded: Si se agotó el plazo o el stream dejó de enviar chunks
         """
         try:
             # Construir el prompt completo
-            full_prompt = self._build_prompt(questionnaire_text)
+            full_prompt = self._build_prompt(questionnaire_text, case_facts)
             
             print("Generando declaration letter con IA (streaming)...")
             print(f"Usando timeout de {self.request_timeout} segundos...")
+            deadline = deadline or Deadline(self.request_timeout)
             
             start_time = time.time()
             
             # Generar respuesta con streaming
-            response = self.model.generate_content(full_prompt, stream=True)
-            
-            # Yield cada chunk generado
-            for chunk in response:
-                if chunk.text:
-                    yield chunk.text
+            yield from self._stream("declaration", full_prompt, cancellation, priority, fairness_key, retry_record, deadline)
             
             elapsed_time = time.time() - start_time
             print(f"Generacion con streaming completada en {elapsed_time:.2f} segundos")
         
+        except GenerationCancelled:
+            print("Generacion de declaration letter cancelada por el cliente")
+            raise
         except Exception as e:
+            if cancellation and cancellation.cancelled:
+                print("Generacion de declaration letter cancelada por el cliente")
+                raise GenerationCancelled("Generación cancelada")
+            if isinstance(e, (GeminiQueueTimeout, GenerationDeadlineExceeded, CircuitOpenError)):
+                print(f"Generacion de declaration letter interrumpida: {e}")
+                raise
             error_msg = str(e)
             if "timeout" in error_msg.lower() or "timed out" in error_msg.lower() or "ReadTimeout" in str(type(e).__name__):
                 print(f"Error: La generacion excedio el tiempo limite de {self.request_timeout}s")
                 print("Sugerencia: El documento es muy largo o el servidor esta ocupado. Intente nuevamente.")
             else:
                 print(f"Error al generar declaration letter (streaming): {e}")
-            raise Exception(f"Error al generar declaration letter: {error_msg}")
+            raise Exception(f"Error al generar declaration letter: {error_msg}") from e
     
-    def generate_cover_letter_stream(self, declaration_letter_content: str):
+    def generate_cover_letter_stream(
+        self,
+        declaration_letter_content: str,
+        cancellation: Optional[StreamCancellation] = None,
+        priority: int = PRIORITY_INTERACTIVE,
+        fairness_key: Optional[str] = None,
+        retry_record: Optional[RetryRecord] = None,
+        deadline: Optional[Deadline] = None
+    ):
         """
         Genera un Cover Letter basado en el Declaration Letter usando streaming
         
         Args:
             declaration_letter_content: Contenido completo del Declaration Letter
+            cancellation: Permite detener la generación desde otro hilo (opcional)
+            priority: Prioridad en el planificador de Gemini
+            fairness_key: Documento o usuario, para repartir los turnos con equidad
+            retry_record: Registra los intentos hechos (opcional)
+            deadline: Plazo total de la generación (default: request_timeout desde ahora)
         
         Yields:
             str: Chunks de texto generados en tiempo real
+        
+        Raises:
+            GenerationCancelled: Si se canceló la generación
+            GenerationDeadlineExceeded: Si se agotó el plazo o el stream dejó de enviar chunks
         """
         try:
             # Validar que se hayan cargado los archivos XML de Cover Letter
@@ -476,28 +976,585 @@ Genera el Cover Letter ahora:
             
             print("Generando Cover Letter con IA (streaming)...")
             print(f"Usando timeout de {self.request_timeout} segundos...")
+            deadline = deadline or Deadline(self.request_timeout)
             
             start_time = time.time()
             
             # Generar respuesta con streaming usando el modelo optimizado
-            response = self.cover_letter_model.generate_content(full_prompt, stream=True)
-            
-            # Yield cada chunk generado
-            for chunk in response:
-                if chunk.text:
-                    yield chunk.text
+            if self._cover_sections_enabled():
+                yield from self._stream_cover_sections(
+                    declaration_letter_content, cancellation, priority, fairness_key, retry_record, deadline
+                )
+            else:
+                yield from self._stream("cover", full_prompt, cancellation, priority, fairness_key, retry_record, deadline)
             
             elapsed_time = time.time() - start_time
             print(f"Generacion de Cover Letter con streaming completada en {elapsed_time:.2f} segundos")
         
+        except GenerationCancelled:
+            print("Generacion de Cover Letter cancelada por el cliente")
+            raise
         except Exception as e:
+            if cancellation and cancellation.cancelled:
+                print("Generacion de Cover Letter cancelada por el cliente")
+                raise GenerationCancelled("Generación cancelada")
+            if isinstance(e, (GeminiQueueTimeout, GenerationDeadlineExceeded, CircuitOpenError)):
+                print(f"Generacion de Cover Letter interrumpida: {e}")
+                raise
             error_msg = str(e)
             if "timeout" in error_msg.lower() or "timed out" in error_msg.lower() or "ReadTimeout" in str(type(e).__name__):
                 print(f"Error: La generacion excedio el tiempo limite de {self.request_timeout}s")
                 print("Sugerencia: El documento es muy largo o el servidor esta ocupado. Intente nuevamente.")
             else:
                 print(f"Error al generar Cover Letter (streaming): {e}")
-            raise Exception(f"Error al generar Cover Letter: {error_msg}")
+            raise Exception(f"Error al generar Cover Letter: {error_msg}") from e
+    
+    def _cover_sections_enabled(self) -> bool:
+        """
+        Indica si el Cover Letter se genera por secciones en paralelo
+        """
+        return (
+            self.cover_letter_parallel_sections
+            and bool(self.cover_letter_sections)
+            and self.section_executor is not None
+        )
+    
+    def _stream_cover_sections(
+        self,
+        declaration_letter_content: str,
+        cancellation: Optional[StreamCancellation],
+        priority: int,
+        fairness_key: Optional[str],
+        retry_record: Optional[RetryRecord],
+        deadline: Deadline
+    ):
+        """
+        Genera el encabezado y cada sección del Cover Letter a la vez (un stream
+        de Gemini por parte) y los entrega en el orden de la carta: los chunks de
+        la parte en curso salen en cuanto llegan y los de las siguientes se
+        guardan hasta que les toca. La latencia total es la de la parte más lenta
+        
+        Yields:
+            str: Chunks de texto del Cover Letter completo
+        
+        Raises:
+            GenerationCancelled: Si se canceló la generación
+            AIExecutorSaturated: Si el ejecutor de secciones está saturado
+            Exception: El primer error de cualquiera de las partes (las demás se cortan)
+        """
+        sections = self.cover_letter_sections
+        events = queue.Queue()
+        cancellations = [StreamCancellation() for _ in sections]
+        # Intentos de cada sección por separado: se suman al registro de la generación al final
+        records = [RetryRecord() for _ in sections]
+        
+        def run(index: int, section: Dict[str, str]):
+            try:
+                prompt = self._build_cover_letter_section_prompt(declaration_letter_content, section)
+                # Cada sección alterna turnos como un documento más: con una sola clave
+                # el planificador atendería las partes de a una y se perdería el paralelismo
+                section_key = f"{fairness_key}:{section['id']}" if fairness_key else None
+                for chunk in self._stream(
+                    "cover", prompt, cancellations[index], priority, section_key, records[index], deadline
+                ):
+                    events.put((index, chunk, None))
+                events.put((index, None, None))
+            except Exception as e:
+                events.put((index, None, e))
+        
+        print(f"Generando Cover Letter por secciones en paralelo ({len(sections)} partes)")
+        futures = []
+        pending: Dict[int, List[str]] = {index: [] for index in range(len(sections))}
+        finished = set()
+        current = 0
+        try:
+            for index, section in enumerate(sections):
+                futures.append(self.section_executor.submit(run, index, section))
+            
+            while current < len(sections):
+                if cancellation and cancellation.cancelled:
+                    raise GenerationCancelled("Generación cancelada")
+                try:
+                    index, chunk, error = events.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                
+                if error is not None:
+                    print(f"Sección {sections[index]['id']} del Cover Letter falló: {error}")
+                    raise error
+                if chunk is None:
+                    finished.add(index)
+                elif index == current:
+                    yield chunk
+                else:
+                    pending[index].append(chunk)
+                
+                # Parte en curso terminada: se pasa a la siguiente y se envía lo que ya tenía
+                while current in finished:
+                    current += 1
+                    if current < len(sections):
+                        yield "\n\n"
+                        yield from pending.pop(current)
+        finally:
+            if current < len(sections):
+                for section_cancellation in cancellations:
+                    section_cancellation.cancel()
+                for future in futures:
+                    future.cancel()
+            if retry_record is not None:
+                self._merge_section_records(retry_record, records)
+    
+    def _merge_section_records(self, retry_record: RetryRecord, records: List[RetryRecord]):
+        """
+        Suma los intentos de las secciones al registro de la generación; si
+        alguna sección la atendió un modelo de respaldo, ese queda como modelo
+        de la generación (el resultado no se guarda bajo el modelo principal)
+        """
+        for record in records:
+            retry_record.merge(record)
+        served_models = [record.model for record in records if record.model]
+        fallback = next((name for name in served_models if name != self.model_name), None)
+        if fallback:
+            retry_record.model = fallback
+    
+    def _generate(
+        self,
+        kind: str,
+        full_prompt: str,
+        priority: int,
+        fairness_key: Optional[str],
+        retry_record: Optional[RetryRecord],
+        deadline: Deadline,
+        generated: str = ""
+    ):
+        """
+        Llama a Gemini sin streaming, con turno en el planificador y reintentos,
+        dentro del plazo de la generación
+        
+        Args:
+            generated: Texto ya generado, si la llamada continúa una respuesta cortada
+        
+        Returns:
+            GenerateContentResponse: Respuesta de Gemini
+        """
+        def attempt():
+            model_name, model, probe = self._choose_model(kind, retry_record)
+            with self.breakers.track(model_name, probe) as call:
+                with self._turn(
+                    model_name, full_prompt + generated, priority, fairness_key, deadline
+                ) as turn, self.keys.lease() as key:
+                    deadline.enter("la respuesta de Gemini")
+                    call.start()
+                    try:
+                        response = self._generate_content(
+                            model, key, model_name, full_prompt, generated,
+                            request_options={"timeout": deadline.remaining()}
+                        )
+                    except Exception as e:
+                        # Timeout del cliente HTTP al vencer el plazo: no cuenta como fallo del modelo
+                        if deadline.expired:
+                            raise deadline.exceeded() from e
+                        raise
+                    turn.record_usage(getattr(response, "usage_metadata", None))
+                    return response
+        
+        try:
+            return call_with_retry(
+                attempt, self.retry_policy, retry_record, label=f"Gemini ({kind})", deadline=deadline
+            )
+        except (GenerationDeadlineExceeded, CircuitOpenError):
+            raise
+        except Exception as e:
+            # Timeout del cliente HTTP al vencer el plazo
+            if deadline.expired:
+                raise deadline.exceeded() from e
+            raise
+    
+    def _generate_text(
+        self,
+        kind: str,
+        full_prompt: str,
+        priority: int,
+        fairness_key: Optional[str],
+        retry_record: Optional[RetryRecord],
+        deadline: Deadline
+    ) -> str:
+        """
+        Genera el texto completo sin streaming: si Gemini corta la respuesta por
+        max_output_tokens, pide continuaciones y las une
+        
+        Returns:
+            str: Texto generado
+        """
+        text = ""
+        for piece in range(self.max_continuations + 1):
+            if piece:
+                self._log_continuation(kind, piece, text)
+            response = self._generate(kind, full_prompt, priority, fairness_key, retry_record, deadline, text)
+            text += trim_overlap(text, response_text(response)) if text else response_text(response)
+            if not hit_max_tokens(response):
+                return text
+        print(f"Gemini ({kind}): la respuesta sigue cortada tras {self.max_continuations} continuaciones")
+        return text
+    
+    def _log_continuation(self, kind: str, piece: int, text: str):
+        """
+        Registra una continuación de una respuesta cortada por max_output_tokens
+        """
+        metrics.increment("gemini_continuations")
+        print(
+            f"Gemini ({kind}): respuesta cortada por max_output_tokens tras {len(text)} caracteres; "
+            f"pidiendo continuación {piece}/{self.max_continuations}"
+        )
+    
+    def _stream(
+        self,
+        kind: str,
+        full_prompt: str,
+        cancellation: Optional[StreamCancellation],
+        priority: int,
+        fairness_key: Optional[str],
+        retry_record: Optional[RetryRecord],
+        deadline: Deadline
+    ):
+        """
+        Llama a Gemini con streaming; el turno del planificador se conserva
+        mientras dura el stream y cada reintento pide uno nuevo (y elige de nuevo
+        el modelo). Un watchdog corta el stream si deja de enviar chunks o si vence el plazo.
+        Si Gemini corta la respuesta por max_output_tokens, se piden continuaciones
+        y sus chunks siguen saliendo en el mismo stream
+        
+        Yields:
+            str: Chunks de texto
+        
+        Raises:
+            GenerationCancelled: Si se canceló la generación
+            GenerationDeadlineExceeded: Si se agotó el plazo o el stream dejó de enviar chunks
+            CircuitOpenError: Si todos los modelos tienen el circuito abierto
+        """
+        cancelled = (lambda: cancellation.cancelled) if cancellation else None
+        
+        def attempt(generated: str, outcome: Dict):
+            model_name, model, probe = self._choose_model(kind, retry_record)
+            with self.breakers.track(model_name, probe) as call:
+                with self._turn(
+                    model_name, full_prompt + generated, priority, fairness_key, deadline, cancelled
+                ) as turn, self.keys.lease() as key:
+                    deadline.enter("la espera del primer chunk de Gemini")
+                    call.start()
+                    try:
+                        response, stream_key, stream_turn = self._open_stream(
+                            lambda lease: self._generate_content(
+                                model, lease, model_name, full_prompt, generated,
+                                stream=True, request_options={"timeout": deadline.remaining()}
+                            ),
+                            key, turn, model_name, full_prompt + generated, deadline, cancellation, priority, fairness_key
+                        )
+                    except (GenerationCancelled, GenerationDeadlineExceeded):
+                        raise
+                    except Exception as e:
+                        # Timeout del cliente HTTP al vencer el plazo: no cuenta como fallo del modelo
+                        if deadline.expired:
+                            raise deadline.exceeded() from e
+                        raise
+                    if cancellation:
+                        cancellation.attach(response)
+                    
+                    watchdog = StallWatchdog(lambda: abort_stream(response), self.stall_timeout, deadline)
+                    # El stream queda cubierto por la key y el turno de la solicitud que lo abrió
+                    with stream_turn, stream_key:
+                        with watchdog:
+                            try:
+                                # Yield cada chunk generado
+                                for chunk in response:
+                                    watchdog.chunk_received()
+                                    deadline.stage = "el stream de Gemini"
+                                    if cancellation and cancellation.cancelled:
+                                        raise GenerationCancelled("Generación cancelada")
+                                    if chunk.text:
+                                        yield chunk.text
+                            except GenerationCancelled:
+                                raise
+                            except Exception as e:
+                                if watchdog.reason or deadline.expired:
+                                    raise self._stream_timeout(watchdog, deadline) from e
+                                raise
+                        if watchdog.reason:
+                            raise self._stream_timeout(watchdog, deadline)
+                        stream_turn.record_usage(getattr(response, "usage_metadata", None))
+                    outcome["response"] = response
+        
+        text = ""
+        for piece in range(self.max_continuations + 1):
+            if piece:
+                self._log_continuation(kind, piece, text)
+            outcome = {}
+            stitcher = SeamStitcher(text)
+            for chunk in stream_with_retry(
+                lambda: attempt(stitcher.previous, outcome), self.retry_policy, retry_record, cancellation,
+                label=f"Gemini ({kind})", deadline=deadline
+            ):
+                chunk = stitcher.feed(chunk)
+                if chunk:
+                    text += chunk
+                    yield chunk
+            chunk = stitcher.flush()
+            if chunk:
+                text += chunk
+                yield chunk
+            if not hit_max_tokens(outcome.get("response")):
+                return
+        print(f"Gemini ({kind}): la respuesta sigue cortada tras {self.max_continuations} continuaciones")
+    
+    def _open_stream(
+        self,
+        open_call,
+        key,
+        turn,
+        model_name: str,
+        full_prompt: str,
+        deadline: Deadline,
+        cancellation: Optional[StreamCancellation],
+        priority: int,
+        fairness_key: Optional[str]
+    ):
+        """
+        Abre el stream de Gemini (generate_content bloquea hasta el primer chunk).
+        Con hedging, si el primer chunk tarda más que el percentil configurado se
+        lanza una segunda solicitud idéntica (con otra API key si hay): gana la
+        primera que responde y la otra se corta en cuanto llega. La key y el
+        turno de la perdedora se devuelven enseguida; los de la ganadora siguen
+        ocupados mientras dura el stream
+        
+        Args:
+            open_call: Función que abre el stream con una key (KeyLease)
+            key: Key de la solicitud original
+            turn: Turno del planificador de la solicitud original (GeminiGrant)
+            full_prompt: Texto de la solicitud, para estimar sus tokens en el planificador
+        
+        Returns:
+            tuple: (respuesta en streaming ganadora, su KeyLease, su GeminiGrant)
+        
+        Raises:
+            GenerationCancelled: Si se canceló la generación mientras esperaba
+            GenerationDeadlineExceeded: Si vence el plazo antes del primer chunk
+        """
+        if self.hedging is None:
+            return open_call(key), key, turn
+        
+        results = queue.Queue()
+        lock = threading.Lock()
+        decided = [False]
+        
+        def run(index: int, lease):
+            launched_at = time.monotonic()
+            try:
+                value, ok = open_call(lease), True
+            except Exception as e:
+                lease.report(e)
+                value, ok = e, False
+            with lock:
+                if not decided[0]:
+                    results.put((index, ok, value, time.monotonic() - launched_at))
+                    return
+            if ok:
+                abort_stream(value)  # llegó después de la ganadora
+        
+        def launch(index: int, lease):
+            threading.Thread(target=run, args=(index, lease), name=f"gemini-hedge-{index}", daemon=True).start()
+        
+        started = time.monotonic()
+        hedge_at = started + self.hedging.delay(model_name)
+        hedge_grant = None
+        hedge_key = None
+        launched = 1
+        failures = []
+        winner = None
+        launch(0, key)
+        
+        try:
+            while True:
+                if cancellation and cancellation.cancelled:
+                    raise GenerationCancelled("Generación cancelada")
+                deadline.check()
+                
+                now = time.monotonic()
+                if hedge_at is not None and now >= hedge_at:
+                    hedge_at = None
+                    hedge_grant = self._hedge_turn(model_name, full_prompt, priority, fairness_key)
+                    if hedge_grant is not None:
+                        hedge_key = self.keys.lease(avoid=key)
+                        launched = 2
+                        launch(1, hedge_key)
+                
+                wait = 0.5 if hedge_at is None else min(0.5, max(0.01, hedge_at - now))
+                try:
+                    index, ok, value, elapsed = results.get(timeout=wait)
+                except queue.Empty:
+                    continue
+                
+                if not ok:
+                    # Si la otra solicitud sigue en curso, se la espera
+                    failures.append(value)
+                    if len(failures) >= launched:
+                        raise failures[0]
+                    continue
+                
+                self.hedging.record(model_name, elapsed)
+                winner = index
+                if index == 1:
+                    # La original sigue sin responder: su tiempo real es al menos éste
+                    self.hedging.record(model_name, time.monotonic() - started)
+                    metrics.increment("gemini_hedge_wins")
+                    print(f"Gemini ({model_name}): la solicitud de respaldo respondió primero")
+                    return value, hedge_key, hedge_grant
+                return value, key, turn
+        finally:
+            with lock:
+                decided[0] = True
+                leftovers = []
+                while not results.empty():
+                    leftovers.append(results.get_nowait())
+            for _, ok, value, _ in leftovers:
+                if ok:
+                    abort_stream(value)
+            # Se devuelven la key y el turno de la solicitud que no quedó a cargo del stream
+            if winner == 1:
+                turn.__exit__(None, None, None)
+                key.release()
+            elif hedge_grant is not None:
+                hedge_grant.__exit__(None, None, None)
+                hedge_key.release()
+    
+    def _generate_content(self, model, key, model_name: str, full_prompt: str, generated: str, **kwargs):
+        """
+        Llama a generate_content con la key de la llamada. Si hay caché de
+        contexto y el prompt empieza con un prefijo estable, el prefijo va en la
+        caché y solo se envía el resto; si Gemini ya no tiene la caché, se olvida
+        y la llamada se repite con el prompt completo
+        
+        Args:
+            model: GenerativeModel elegido
+            key: Key de la llamada (KeyLease)
+            model_name: Nombre del modelo
+            full_prompt: Prompt completo
+            generated: Texto ya generado, si la llamada continúa una respuesta cortada
+            **kwargs: Argumentos de generate_content (stream, request_options)
+        
+        Returns:
+            GenerateContentResponse: Respuesta de Gemini
+        """
+        bound = key.bind(model)
+        prefix = self._stable_prompt_prefix(full_prompt) if self.context_cache is not None else None
+        if prefix:
+            cached_model, prompt, cached = self.context_cache.apply(
+                bound, key, model_name, prefix, full_prompt[len(prefix):]
+            )
+            if cached:
+                try:
+                    return cached_model.generate_content(
+                        continuation_request(prompt, generated) if generated else prompt, **kwargs
+                    )
+                except CACHE_MISSING_ERRORS:
+                    self.context_cache.invalidate(key, model_name, prefix)
+        
+        return bound.generate_content(
+            continuation_request(full_prompt, generated) if generated else full_prompt, **kwargs
+        )
+    
+    def _hedge_turn(self, model_name: str, full_prompt: str, priority: int, fairness_key: Optional[str]):
+        """
+        Reserva un turno inmediato y presupuesto para una solicitud de respaldo
+        
+        Returns:
+            GeminiGrant: Turno de la solicitud de respaldo, o None si no se debe lanzar
+        """
+        try:
+            grant = gemini_turn(self.scheduler, model_name, full_prompt, priority, fairness_key, max_wait=0)
+        except GeminiQueueTimeout:
+            return None
+        if not self.hedging.try_spend():
+            grant.__exit__(None, None, None)
+            return None
+        metrics.increment("gemini_hedges")
+        print(f"Gemini ({model_name}): sin primer chunk tras la espera de hedging, se lanza una solicitud de respaldo")
+        return grant
+    
+    def _choose_model(self, kind: str, retry_record: Optional[RetryRecord]):
+        """
+        Elige el modelo del intento: el principal, o el primero de respaldo con
+        el circuito cerrado
+        
+        Args:
+            kind: 'declaration', 'cover' o 'facts' (cada uno con su configuración de generación)
+            retry_record: Registro donde se anota el modelo elegido (opcional)
+        
+        Returns:
+            tuple: (nombre del modelo, GenerativeModel, token de prueba del circuito para track())
+        
+        Raises:
+            CircuitOpenError: Si todos los modelos tienen el circuito abierto
+        """
+        model_name, probe = self.breakers.choose([self.model_name] + [
+            name for name in self.fallback_models if name != self.model_name
+        ])
+        if retry_record is not None:
+            retry_record.model = model_name
+        
+        if kind == "facts":
+            primary_model, generation_config = self.case_facts_model, self.case_facts_generation_config
+        elif kind == "declaration":
+            primary_model, generation_config = self.model, self.generation_config
+        else:
+            primary_model, generation_config = self.cover_letter_model, self.cover_letter_generation_config
+        
+        if model_name == self.model_name:
+            return model_name, primary_model, probe
+        
+        model = self._fallback_clients.get((kind, model_name))
+        if model is None:
+            model = genai.GenerativeModel(
+                model_name=model_name,
+                generation_config=generation_config,
+                safety_settings=self.safety_settings
+            )
+            self._fallback_clients[(kind, model_name)] = model
+        print(f"Usando modelo de respaldo {model_name}: el circuito de {self.model_name} está abierto")
+        return model_name, model, probe
+    
+    def _turn(
+        self,
+        model_name: str,
+        full_prompt: str,
+        priority: int,
+        fairness_key: Optional[str],
+        deadline: Deadline,
+        cancelled=None
+    ):
+        """
+        Espera turno en el planificador sin pasar del plazo de la generación
+        
+        Returns:
+            GeminiGrant: Turno concedido (usar con with)
+        """
+        deadline.enter("la espera de turno en Gemini")
+        try:
+            return gemini_turn(
+                self.scheduler, model_name, full_prompt, priority, fairness_key, cancelled,
+                max_wait=deadline.remaining()
+            )
+        except GeminiQueueTimeout:
+            if deadline.expired:
+                raise deadline.exceeded() from None
+            raise
+    
+    def _stream_timeout(self, watchdog: StallWatchdog, deadline: Deadline) -> GenerationDeadlineExceeded:
+        """
+        Construye el error de un stream cortado por el watchdog o por el plazo
+        """
+        if watchdog.reason and watchdog.reason != "deadline":
+            return GenerationDeadlineExceeded(f"Stream cortado: {watchdog.reason}", stalled=True)
+        return deadline.exceeded()
     
     def validate_api_key(self) -> bool:
         """
@@ -509,7 +1566,8 @@ Genera el Cover Letter ahora:
         try:
             # Intenta generar un texto simple para validar
             test_model = genai.GenerativeModel(model_name=self.model_name)
-            response = test_model.generate_content("Hello")
+            with self.keys.lease() as key:
+                response = key.bind(test_model).generate_content("Hello")
             return response is not None
         except Exception as e:
             print(f"Error al validar API key: {e}")
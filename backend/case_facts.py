@@ -0,0 +1,241 @@
+"""
+Hechos del caso extraídos del cuestionario
+Primera etapa de la generación: una llamada a Gemini resume el cuestionario en
+un JSON compacto y estructurado (aplicante, personas, cronología, daños,
+cooperación con las autoridades...). Se guarda por documento y lo usan la
+Declaration Letter, sus regeneraciones y el chat en lugar del cuestionario
+completo; solo se extrae de nuevo si el cuestionario o el prompt de extracción
+cambian.
+"""
+
+import hashlib
+import json
+import re
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from backend.database import DatabaseManager, CaseFactsRepository
+from backend.generation_cache import normalize_source_text
+from backend.metrics import metrics
+
+
+# Instrucciones de la extracción (el esquema usa claves en inglés, como las cartas)
+EXTRACTION_INSTRUCTIONS = """
+Extrae del cuestionario los hechos del caso en un único objeto JSON con esta estructura:
+
+{
+  "applicant": {"full_name": "", "other_names": [], "date_of_birth": "", "place_of_birth": "", "nationality": "", "gender": "", "languages": [], "education": "", "family": []},
+  "people": [{"name": "", "role": "", "relationship": "", "details": ""}],
+  "timeline": [{"date": "", "place": "", "event": "", "details": ""}],
+  "trafficking": {"type": "", "recruitment": "", "deception": "", "force_fraud_coercion": [], "work_conditions": "", "payments_and_debts": "", "threats": [], "escape": ""},
+  "harms": [{"type": "", "description": "", "date": "", "ongoing": false}],
+  "arrival_and_presence": {"entry_date": "", "entry_place": "", "manner_of_entry": "", "reason_still_in_us": ""},
+  "law_enforcement": [{"date": "", "agency": "", "cooperation": "", "case_number": ""}],
+  "current_situation": "",
+  "hardship_if_removed": [],
+  "immigration_history": [],
+  "quotes": [],
+  "missing_information": []
+}
+
+REGLAS:
+1. Usa SOLO información del cuestionario; no inventes ni supongas nada. Lo que no aparezca queda como "" o []
+2. Conserva TODOS los detalles concretos (fechas, lugares, nombres, cantidades, duraciones, palabras exactas de las amenazas): la Declaration Letter se redactará únicamente a partir de este JSON
+3. "timeline" va en orden cronológico y cada evento incluye en "details" lo que el afectado contó de él
+4. "quotes" son frases textuales del afectado que vale la pena citar
+5. "missing_information" lista los datos importantes para una T-Visa que el cuestionario no responde
+6. Escribe los valores en el idioma del cuestionario
+7. Responde SOLO con el JSON, sin texto adicional ni bloques de código
+"""
+
+# Locks de extracción compartidos por documento (cantidad fija, no crece con los documentos)
+_LOCK_STRIPES = 64
+
+# Bloque de código Markdown alrededor del JSON (```json ... ```)
+_CODE_FENCE = re.compile(r"^```(?:json)?\s*(.*?)\s*```$", re.DOTALL | re.IGNORECASE)
+
+
+def parse_case_facts(text: str) -> Dict:
+    """
+    Convierte la respuesta de la extracción en un diccionario
+
+    Args:
+        text: Respuesta de Gemini
+
+    Returns:
+        dict: Hechos del caso
+
+    Raises:
+        ValueError: Si la respuesta no es un objeto JSON
+    """
+    text = (text or "").strip()
+    match = _CODE_FENCE.match(text)
+    if match:
+        text = match.group(1)
+    try:
+        facts = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"La extracción de hechos no devolvió JSON válido: {e}") from e
+    if not isinstance(facts, dict) or not facts:
+        raise ValueError("La extracción de hechos no devolvió un objeto JSON")
+    return facts
+
+
+def format_case_facts(facts: Dict) -> str:
+    """
+    Serializa los hechos del caso para incluirlos en un prompt (JSON sin espacios)
+
+    Args:
+        facts: Hechos del caso
+
+    Returns:
+        str: JSON compacto
+    """
+    return json.dumps(facts, ensure_ascii=False, separators=(",", ":"))
+
+
+def source_sha256(source_text: str) -> str:
+    """
+    Calcula el hash del cuestionario normalizado (las diferencias de formato no fuerzan otra extracción)
+
+    Args:
+        source_text: Texto del cuestionario
+
+    Returns:
+        str: Hash en hexadecimal
+    """
+    return hashlib.sha256(normalize_source_text(source_text).encode("utf-8")).hexdigest()
+
+
+class CaseFactStore:
+    """
+    Hechos del caso de cada documento, persistidos y compartidos entre generaciones
+    """
+
+    def __init__(self, db_manager: DatabaseManager):
+        """
+        Inicializa el almacén
+
+        Args:
+            db_manager: Gestor de base de datos
+        """
+        self.db_manager = db_manager
+        self._locks: List[threading.Lock] = [threading.Lock() for _ in range(_LOCK_STRIPES)]
+
+    def get_or_extract(
+        self,
+        document_id: int,
+        source_text: str,
+        fingerprint: str,
+        extractor: Callable[[str], Dict]
+    ) -> Dict:
+        """
+        Devuelve los hechos guardados del documento o los extrae y los guarda
+
+        Es bloqueante: se llama desde un hilo. Si dos generaciones del mismo
+        documento los piden a la vez, la segunda espera a la primera en lugar
+        de extraer otra vez.
+
+        Args:
+            document_id: ID del documento
+            source_text: Texto del cuestionario
+            fingerprint: Huella de la extracción (AIProcessor.generation_fingerprint('facts'))
+            extractor: Función que extrae los hechos (AIProcessor.extract_case_facts)
+
+        Returns:
+            dict: Hechos del caso
+
+        Raises:
+            Exception: El error de la extracción
+        """
+        source_hash = source_sha256(source_text)
+
+        with self._lock_for(document_id):
+            facts = self._load(document_id, source_hash, fingerprint)
+            if facts is not None:
+                metrics.increment("case_facts_hits")
+                return facts
+
+            metrics.increment("case_facts_misses")
+            start_time = time.time()
+            facts = extractor(source_text)
+            elapsed_time = time.time() - start_time
+
+            facts_json = format_case_facts(facts)
+            self._save(document_id, source_hash, fingerprint, facts_json, len(source_text), elapsed_time)
+            print(
+                f"Hechos del caso extraídos en {elapsed_time:.2f} segundos "
+                f"({len(facts_json)} caracteres en lugar de {len(source_text)})"
+            )
+            return facts
+
+    def get(self, document_id: int) -> Optional[Dict]:
+        """
+        Obtiene los últimos hechos guardados del documento, sin comprobar si siguen vigentes
+
+        Args:
+            document_id: ID del documento
+
+        Returns:
+            dict: Hechos del caso o None si no se han extraído
+        """
+        return self._load(document_id)
+
+    def _lock_for(self, document_id: int) -> threading.Lock:
+        """
+        Obtiene el lock de extracción de un documento (compartido con otros documentos)
+        """
+        return self._locks[document_id % len(self._locks)]
+
+    def _load(
+        self,
+        document_id: int,
+        source_hash: Optional[str] = None,
+        fingerprint: Optional[str] = None
+    ) -> Optional[Dict]:
+        """
+        Lee los hechos guardados; None si no existen o se extrajeron de otro cuestionario o con otro prompt
+        """
+        db = self.db_manager.get_session()
+        try:
+            stored = CaseFactsRepository(db).get_facts(document_id)
+            if not stored:
+                return None
+            if source_hash is not None and stored.source_sha256 != source_hash:
+                return None
+            if fingerprint is not None and stored.fingerprint != fingerprint:
+                return None
+            return json.loads(stored.facts_json)
+        except Exception as e:
+            print(f"Error al leer los hechos del caso guardados: {e}")
+            return None
+        finally:
+            db.close()
+
+    def _save(
+        self,
+        document_id: int,
+        source_hash: str,
+        fingerprint: str,
+        facts_json: str,
+        source_length: int,
+        extraction_seconds: float
+    ):
+        """
+        Guarda los hechos extraídos
+        """
+        db = self.db_manager.get_session()
+        try:
+            CaseFactsRepository(db).save_facts(
+                document_id=document_id,
+                source_sha256=source_hash,
+                fingerprint=fingerprint,
+                facts_json=facts_json,
+                source_length=source_length,
+                extraction_seconds=extraction_seconds
+            )
+        except Exception as e:
+            print(f"Error al guardar los hechos del caso: {e}")
+        finally:
+            db.close()
@@ -9,6 +9,15 @@ from typing import List, Dict, Optional
 import google.generativeai as genai
 from mem0 import MemoryClient
 
+from backend.ai_processor import StreamCancellation
+from backend.gemini_scheduler import PRIORITY_CHAT, gemini_turn
+from backend.gemini_retry import RetryPolicy, call_with_retry, stream_with_retry
+from backend.circuit_breaker import CircuitBreakerRegistry
+from backend.gemini_keys import GeminiKeyPool
+from backend.continuation import SeamStitcher, continuation_request, hit_max_tokens, response_text, trim_overlap
+from backend.case_facts import format_case_facts
+from backend.metrics import metrics
+
 
 class ChatMemorySystem:
     """
@@ -29,8 +38,9 @@ class ChatMemorySystem:
         # Inicializar mem0
         self.memory_client = MemoryClient(api_key=mem0_api_key)
         
-        # Configurar Gemini
-        genai.configure(api_key=google_api_key)
+        # API keys de Gemini: cada llamada usa el cliente de una key del pool, sin
+        # configuración global (la aplicación asigna el pool compartido)
+        self.keys = GeminiKeyPool([google_api_key])
         
         # Configuración del modelo
         self.generation_config = {
@@ -40,11 +50,31 @@ class ChatMemorySystem:
             "max_output_tokens": 8000,  # Aumentado para permitir documentos completos
         }
         
+        self.model_name = "gemini-2.0-flash-exp"  # Modelo correcto con mayor capacidad
         self.model = genai.GenerativeModel(
-            model_name="gemini-2.0-flash-exp",  # Modelo correcto con mayor capacidad
+            model_name=self.model_name,
             generation_config=self.generation_config
         )
         
+        # Planificador compartido de llamadas a Gemini (opcional, lo asigna la aplicación);
+        # el chat tiene prioridad sobre las generaciones de documentos
+        self.scheduler = None
+        
+        # Reintentos ante errores transitorios (429, 503...)
+        self.retry_policy = RetryPolicy()
+        
+        # Timeout en segundos de cada llamada a Gemini
+        self.request_timeout = 300
+        
+        # Continuaciones automáticas si la respuesta se corta por max_output_tokens
+        # (las reescrituras devuelven el documento completo)
+        self.max_continuations = 3
+        
+        # Circuit breaker por modelo y modelos de respaldo (la aplicación asigna el registro compartido)
+        self.breakers = CircuitBreakerRegistry()
+        self.fallback_models: List[str] = []
+        self._fallback_clients: Dict[str, genai.GenerativeModel] = {}
+        
         # Prompt del sistema
         self.system_prompt = """You are an intelligent assistant helping users edit and improve their Declaration Letters and Cover Letters for T-Visa petitions.
 
@@ -147,7 +177,8 @@ Current document context will be provided with each query."""
         user_message: str, 
         user_id: str,
         document_content: Optional[str] = None,
-        document_type: str = "declaration"
+        document_type: str = "declaration",
+        case_facts: Optional[Dict] = None
     ) -> str:
         """
         Genera una respuesta usando Gemini con contexto de memoria y documento
@@ -157,19 +188,41 @@ Current document context will be provided with each query."""
             user_id: ID del usuario
             document_content: Contenido del documento actual (opcional)
             document_type: Tipo de documento ('declaration' o 'cover')
+            case_facts: Hechos del caso extraídos del cuestionario (opcional)
             
         Returns:
             Respuesta generada por la IA
         """
         try:
             # Construir prompt completo
-            full_prompt = self._build_prompt(user_message, user_id, document_content, document_type)
+            full_prompt = self._build_prompt(user_message, user_id, document_content, document_type, case_facts)
             
             # Generar respuesta
-            response = self.model.generate_content(full_prompt)
+            def attempt(generated: str):
+                request = continuation_request(full_prompt, generated) if generated else full_prompt
+                model_name, model, probe = self._choose_model()
+                with self.breakers.track(model_name, probe) as call, gemini_turn(
+                    self.scheduler, model_name, full_prompt + generated, PRIORITY_CHAT, f"user:{user_id}"
+                ) as turn, self.keys.lease() as key:
+                    call.start()
+                    response = key.bind(model).generate_content(
+                        request, request_options={"timeout": self.request_timeout}
+                    )
+                    turn.record_usage(getattr(response, "usage_metadata", None))
+                    return response
             
-            if response and response.text:
-                return response.text
+            # Si la respuesta se corta por max_output_tokens, se piden continuaciones y se unen
+            text = ""
+            for piece in range(self.max_continuations + 1):
+                if piece:
+                    self._log_continuation(piece, text)
+                response = call_with_retry(lambda: attempt(text), self.retry_policy, label="Chat")
+                text += trim_overlap(text, response_text(response)) if text else response_text(response)
+                if not hit_max_tokens(response):
+                    break
+            
+            if text:
+                return text
             else:
                 return "I apologize, but I couldn't generate a response. Please try rephrasing your question."
                 
@@ -182,7 +235,9 @@ Current document context will be provided with each query."""
         user_message: str, 
         user_id: str,
         document_content: Optional[str] = None,
-        document_type: str = "declaration"
+        document_type: str = "declaration",
+        cancellation: Optional[StreamCancellation] = None,
+        case_facts: Optional[Dict] = None
     ):
         """
         Genera una respuesta usando Gemini con streaming (para respuestas en tiempo real)
@@ -192,31 +247,108 @@ Current document context will be provided with each query."""
             user_id: ID del usuario
             document_content: Contenido del documento actual (opcional)
             document_type: Tipo de documento ('declaration' o 'cover')
+            cancellation: Permite detener la generación desde otro hilo (opcional)
+            case_facts: Hechos del caso extraídos del cuestionario (opcional)
             
         Yields:
             str: Chunks de texto generados en tiempo real
         """
         try:
             # Construir prompt completo
-            full_prompt = self._build_prompt(user_message, user_id, document_content, document_type)
+            full_prompt = self._build_prompt(user_message, user_id, document_content, document_type, case_facts)
             
             # Generar respuesta con streaming
-            response = self.model.generate_content(full_prompt, stream=True)
+            cancelled = (lambda: cancellation.cancelled) if cancellation else None
+            
+            def attempt(generated: str, outcome: Dict):
+                request = continuation_request(full_prompt, generated) if generated else full_prompt
+                model_name, model, probe = self._choose_model()
+                with self.breakers.track(model_name, probe) as call, gemini_turn(
+                    self.scheduler, model_name, full_prompt + generated, PRIORITY_CHAT, f"user:{user_id}", cancelled
+                ) as turn, self.keys.lease() as key:
+                    call.start()
+                    response = key.bind(model).generate_content(
+                        request, stream=True, request_options={"timeout": self.request_timeout}
+                    )
+                    if cancellation:
+                        cancellation.attach(response)
+                    
+                    for chunk in response:
+                        if cancellation and cancellation.cancelled:
+                            return
+                        if chunk.text:
+                            yield chunk.text
+                    turn.record_usage(getattr(response, "usage_metadata", None))
+                    outcome["response"] = response
             
-            for chunk in response:
-                if chunk.text:
-                    yield chunk.text
+            # Si la respuesta se corta por max_output_tokens, las continuaciones siguen en el mismo stream
+            text = ""
+            for piece in range(self.max_continuations + 1):
+                if piece:
+                    self._log_continuation(piece, text)
+                outcome = {}
+                stitcher = SeamStitcher(text)
+                for chunk in stream_with_retry(
+                    lambda: attempt(stitcher.previous, outcome), self.retry_policy,
+                    cancellation=cancellation, label="Chat"
+                ):
+                    chunk = stitcher.feed(chunk)
+                    if chunk:
+                        text += chunk
+                        yield chunk
+                chunk = stitcher.flush()
+                if chunk:
+                    text += chunk
+                    yield chunk
+                if not hit_max_tokens(outcome.get("response")):
+                    break
                     
         except Exception as e:
+            if cancellation and cancellation.cancelled:
+                print("Chat stream cancelled by client")
+                return
             print(f"Error generating response stream: {e}")
             yield f"I encountered an error while processing your request. Please try again."
     
+    def _log_continuation(self, piece: int, text: str):
+        """
+        Registra una continuación de una respuesta cortada por max_output_tokens
+        """
+        metrics.increment("gemini_continuations")
+        print(
+            f"Chat: respuesta cortada por max_output_tokens tras {len(text)} caracteres; "
+            f"pidiendo continuación {piece}/{self.max_continuations}"
+        )
+    
+    def _choose_model(self):
+        """
+        Elige el modelo del intento: el principal, o el primero de respaldo con el circuito cerrado
+        
+        Returns:
+            tuple: (nombre del modelo, GenerativeModel, token de prueba del circuito para track())
+        
+        Raises:
+            CircuitOpenError: Si todos los modelos tienen el circuito abierto
+        """
+        model_name, probe = self.breakers.choose([self.model_name] + [
+            name for name in self.fallback_models if name != self.model_name
+        ])
+        if model_name == self.model_name:
+            return model_name, self.model, probe
+        
+        model = self._fallback_clients.get(model_name)
+        if model is None:
+            model = genai.GenerativeModel(model_name=model_name, generation_config=self.generation_config)
+            self._fallback_clients[model_name] = model
+        return model_name, model, probe
+    
     def _build_prompt(
         self,
         user_message: str,
         user_id: str,
         document_content: Optional[str] = None,
-        document_type: str = "declaration"
+        document_type: str = "declaration",
+        case_facts: Optional[Dict] = None
     ) -> str:
         """
         Construye el prompt completo para el modelo
@@ -226,6 +358,7 @@ Current document context will be provided with each query."""
             user_id: ID del usuario
             document_content: Contenido del documento actual
             document_type: Tipo de documento
+            case_facts: Hechos del caso extraídos del cuestionario
             
         Returns:
             Prompt completo formateado
@@ -250,6 +383,13 @@ Current {document_type.title()} Letter content:
 ---
 {document_content}
 ---
+"""
+        
+        # Hechos del caso: permiten responder y completar el documento sin enviar el cuestionario
+        facts_context = ""
+        if case_facts:
+            facts_context = f"""Case facts extracted from the applicant's questionnaire (JSON). Use them to answer questions about the case and to add details, never invent facts beyond them:
+{format_case_facts(case_facts)}
 """
         
         # Construir prompt completo
@@ -259,6 +399,8 @@ Current {document_type.title()} Letter content:
 
 {document_context}
 
+{facts_context}
+
 Current Time: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
 
 User Question: {user_message}
@@ -288,7 +430,8 @@ CRITICAL RULES:
         user_id: str,
         document_content: Optional[str] = None,
         document_type: str = "declaration",
-        save_to_memory: bool = True
+        save_to_memory: bool = True,
+        case_facts: Optional[Dict] = None
     ) -> str:
         """
         Procesa un mensaje de chat completo (genera respuesta y guarda en memoria)
@@ -299,6 +442,7 @@ CRITICAL RULES:
             document_content: Contenido del documento actual
             document_type: Tipo de documento
             save_to_memory: Si guardar la conversación en memoria
+            case_facts: Hechos del caso extraídos del cuestionario (opcional)
             
         Returns:
             Respuesta del asistente
@@ -308,7 +452,8 @@ CRITICAL RULES:
             user_message=user_message,
             user_id=user_id,
             document_content=document_content,
-            document_type=document_type
+            document_type=document_type,
+            case_facts=case_facts
         )
         
         # Guardar en memoria
@@ -0,0 +1,222 @@
+"""
+Circuit breaker por modelo de Gemini
+Tras varios fallos transitorios seguidos (429, 503, timeouts) el circuito del
+modelo se abre y las llamadas dejan de esperar su propio fallo: pasan al
+siguiente modelo de la cadena de respaldo (por ejemplo pro -> flash), o fallan
+enseguida si no queda ninguno disponible. Pasado reset_seconds se deja pasar
+una llamada de prueba; si responde bien, el circuito se cierra de nuevo.
+"""
+
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from backend.gemini_retry import is_retryable
+from backend.metrics import metrics
+
+
+# Estados del circuito
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """
+    Se lanza cuando todos los modelos de la cadena tienen el circuito abierto
+    """
+    pass
+
+
+class CircuitBreaker:
+    """
+    Estado del circuito de un modelo
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        """
+        Args:
+            failure_threshold: Fallos seguidos que abren el circuito
+            reset_seconds: Segundos abierto antes de dejar pasar una llamada de prueba
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_token: Optional[int] = None  # llamada de prueba en curso
+        self.probes = 0
+        self.times_opened = 0
+
+    def allow(self, now: float) -> Tuple[bool, Optional[int]]:
+        """
+        Indica si una llamada puede usar el modelo (reserva la prueba si está medio abierto)
+
+        Returns:
+            tuple: (True si puede, token de la prueba si esta llamada es la prueba)
+        """
+        if self.state == OPEN and now - self.opened_at >= self.reset_seconds:
+            self.state = HALF_OPEN
+            self.probe_token = None
+        if self.state == CLOSED:
+            return True, None
+        if self.state == HALF_OPEN and self.probe_token is None:
+            self.probes += 1
+            self.probe_token = self.probes
+            return True, self.probe_token
+        return False, None
+
+
+class CircuitBreakerRegistry:
+    """
+    Circuitos de todos los modelos del proceso (compartidos por AIProcessor y ChatMemorySystem)
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 60):
+        """
+        Inicializa el registro
+
+        Args:
+            failure_threshold: Fallos transitorios seguidos que abren el circuito (0 = desactivado)
+            reset_seconds: Segundos abierto antes de probar de nuevo el modelo
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def choose(self, model_names: List[str]) -> Tuple[str, Optional[int]]:
+        """
+        Elige el primer modelo de la cadena con el circuito cerrado (o en prueba)
+
+        Args:
+            model_names: Modelo principal seguido de los de respaldo
+
+        Returns:
+            tuple: (modelo a usar, token de prueba o None); la llamada debe hacerse
+                dentro de track(modelo, token)
+
+        Raises:
+            CircuitOpenError: Si todos los circuitos están abiertos
+        """
+        if not self.failure_threshold:
+            return model_names[0], None
+        with self._lock:
+            now = time.monotonic()
+            for position, name in enumerate(model_names):
+                allowed, probe = self._breaker(name).allow(now)
+                if allowed:
+                    if position > 0:
+                        metrics.increment("gemini_fallbacks")
+                    return name, probe
+        metrics.increment("gemini_circuit_rejections")
+        raise CircuitOpenError(
+            f"Modelos de Gemini no disponibles temporalmente ({', '.join(model_names)}): "
+            f"demasiados errores seguidos"
+        )
+
+    def track(self, model_name: str, probe: Optional[int] = None) -> "_TrackedCall":
+        """
+        Registra el resultado de una llamada al salir del bloque with: éxito,
+        fallo transitorio (cuenta para abrir el circuito) u otro error (no cuenta).
+        Solo cuenta si se llamó a start() justo antes de la llamada a Gemini: una
+        espera de turno que falla no dice nada del modelo
+
+        Args:
+            model_name: Modelo elegido con choose()
+            probe: Token de prueba devuelto por choose()
+
+        Returns:
+            Context manager de la llamada
+        """
+        return _TrackedCall(self, model_name, probe)
+
+    def stats(self) -> Dict[str, Dict]:
+        """
+        Obtiene el estado del circuito de cada modelo
+
+        Returns:
+            dict: {modelo: {'state', 'consecutive_failures', 'times_opened'}}
+        """
+        with self._lock:
+            return {
+                name: {
+                    "state": breaker.state,
+                    "consecutive_failures": breaker.consecutive_failures,
+                    "times_opened": breaker.times_opened,
+                }
+                for name, breaker in self._breakers.items()
+            }
+
+    def _breaker(self, model_name: str) -> CircuitBreaker:
+        breaker = self._breakers.get(model_name)
+        if breaker is None:
+            breaker = self._breakers[model_name] = CircuitBreaker(self.failure_threshold, self.reset_seconds)
+        return breaker
+
+    def _record(self, model_name: str, outcome: Optional[bool], probe: Optional[int] = None):
+        """
+        Aplica el resultado de una llamada: True = éxito, False = fallo transitorio, None = no cuenta.
+        Con el circuito abierto o en prueba solo decide la llamada de prueba; las que
+        empezaron antes de que se abriera no lo cierran ni lo vuelven a abrir
+        """
+        if not self.failure_threshold:
+            return
+        with self._lock:
+            breaker = self._breaker(model_name)
+            was_probe = probe is not None and probe == breaker.probe_token
+            if was_probe:
+                breaker.probe_token = None
+            if outcome is None:
+                return
+            if breaker.state != CLOSED and not was_probe:
+                return
+            if outcome:
+                if breaker.state != CLOSED:
+                    print(f"Circuito de {model_name} cerrado: el modelo volvió a responder")
+                breaker.state = CLOSED
+                breaker.consecutive_failures = 0
+                return
+            breaker.consecutive_failures += 1
+            if was_probe or (breaker.state == CLOSED and breaker.consecutive_failures >= self.failure_threshold):
+                breaker.state = OPEN
+                breaker.opened_at = time.monotonic()
+                breaker.times_opened += 1
+                metrics.increment("gemini_circuit_opened")
+                print(
+                    f"Circuito de {model_name} abierto tras {breaker.consecutive_failures} fallos seguidos; "
+                    f"se reintenta en {self.reset_seconds:.0f}s"
+                )
+
+
+class _TrackedCall:
+    """
+    Llamada en curso a un modelo elegido por el registro
+    """
+
+    def __init__(self, registry: CircuitBreakerRegistry, model_name: str, probe: Optional[int] = None):
+        self.registry = registry
+        self.model_name = model_name
+        self.probe = probe
+        self.started = False
+
+    def start(self):
+        """
+        Marca el inicio de la llamada a Gemini
+        """
+        self.started = True
+
+    def __enter__(self) -> "_TrackedCall":
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if not self.started:
+            self.registry._record(self.model_name, None, self.probe)
+        elif exc is None:
+            self.registry._record(self.model_name, True, self.probe)
+        elif isinstance(exc, Exception) and is_retryable(exc):
+            self.registry._record(self.model_name, False, self.probe)
+        else:
+            # Cancelación, error del prompt o de la cola local: no dice nada del modelo
+            self.registry._record(self.model_name, None, self.probe)
+        return False
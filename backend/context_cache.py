@@ -0,0 +1,302 @@
+"""
+Caché de contexto para el prefijo estable de los prompts
+Los prompts de la Declaration Letter y del Cover Letter empiezan con los mismos
+20-30 KB de XML (System Prompt, Declaration Guide, estructura del Cover Letter)
+en cada llamada. Con la caché explícita de Gemini (cachedContents) ese prefijo
+se sube una vez por API key y modelo, y las llamadas solo envían la parte del
+caso; Gemini cobra los tokens cacheados a tarifa reducida y los informa en
+usage_metadata.cached_content_token_count. La caché se renueva (TTL) mientras
+se usa y deja de usarse sola cuando los prompts cambian. LocalCacheBackend es
+un sustituto local para pruebas y desarrollo: lleva la misma contabilidad pero
+envía el prompt completo.
+"""
+
+import copy
+import hashlib
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import google.ai.generativelanguage as glm
+from google.api_core import exceptions as google_exceptions
+from google.protobuf import duration_pb2, field_mask_pb2
+
+from backend.gemini_scheduler import estimate_tokens
+from backend.metrics import metrics
+
+
+# Errores de una llamada que indican que la caché ya no existe en Gemini (expiró, se borró, otro proyecto)
+CACHE_MISSING_ERRORS = (google_exceptions.NotFound, google_exceptions.PermissionDenied)
+
+
+class GeminiCacheBackend:
+    """
+    Caché explícita de Gemini: el prefijo queda guardado en el proyecto de cada API key
+    """
+
+    name = "gemini"
+
+    def create(self, lease, model_name: str, prefix: str, ttl_seconds: int) -> str:
+        """
+        Crea la caché del prefijo
+
+        Args:
+            lease: Key de la llamada (KeyLease); las cachés son de su proyecto
+            model_name: Modelo con el que se usará la caché
+            prefix: Prefijo estable del prompt
+            ttl_seconds: Vida de la caché
+
+        Returns:
+            str: Nombre de la caché (cachedContents/...)
+        """
+        model = model_name if "/" in model_name else f"models/{model_name}"
+        digest = hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+        response = lease.cache_client().create_cached_content(glm.CreateCachedContentRequest(
+            cached_content=glm.CachedContent(
+                model=model,
+                display_name=f"declarationletter-prefix-{digest[:16]}",
+                contents=[glm.Content(role="user", parts=[glm.Part(text=prefix)])],
+                ttl=duration_pb2.Duration(seconds=int(ttl_seconds)),
+            )
+        ))
+        return response.name
+
+    def refresh(self, lease, name: str, ttl_seconds: int):
+        """
+        Extiende la vida de la caché
+
+        Args:
+            lease: Key con la que se creó
+            name: Nombre de la caché
+            ttl_seconds: Nueva vida a partir de ahora
+        """
+        lease.cache_client().update_cached_content(glm.UpdateCachedContentRequest(
+            cached_content=glm.CachedContent(name=name, ttl=duration_pb2.Duration(seconds=int(ttl_seconds))),
+            update_mask=field_mask_pb2.FieldMask(paths=["ttl"]),
+        ))
+
+    def bind(self, model, name: str):
+        """
+        Devuelve una copia del modelo que usa la caché como contexto
+
+        Args:
+            model: GenerativeModel ya ligado a la key
+            name: Nombre de la caché
+
+        Returns:
+            GenerativeModel: Copia para esta llamada
+        """
+        bound = copy.copy(model)
+        # Lo mismo que hace GenerativeModel.from_cached_content, sin volver a pedir la caché a la API
+        bound._cached_content = name
+        return bound
+
+    def request(self, prefix: str, suffix: str) -> str:
+        """
+        Devuelve lo que se envía en la llamada: solo la parte del caso
+        """
+        return suffix
+
+
+class LocalCacheBackend:
+    """
+    Sustituto local de la caché de Gemini (pruebas y desarrollo): guarda el
+    prefijo en memoria con la misma vida y renovación, y envía el prompt completo
+    """
+
+    name = "local"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._contents: Dict[str, Tuple[str, float]] = {}  # nombre: (prefijo, expira)
+        self._sequence = 0
+
+    def create(self, lease, model_name: str, prefix: str, ttl_seconds: int) -> str:
+        with self._lock:
+            self._sequence += 1
+            name = f"local/cachedContents/{self._sequence}"
+            self._contents[name] = (prefix, time.monotonic() + ttl_seconds)
+        return name
+
+    def refresh(self, lease, name: str, ttl_seconds: int):
+        with self._lock:
+            stored = self._contents.get(name)
+            if stored is None or stored[1] <= time.monotonic():
+                self._contents.pop(name, None)
+                raise google_exceptions.NotFound(f"CachedContent not found: {name}")
+            self._contents[name] = (stored[0], time.monotonic() + ttl_seconds)
+
+    def bind(self, model, name: str):
+        return model
+
+    def request(self, prefix: str, suffix: str) -> str:
+        return prefix + suffix
+
+
+class _CacheEntry:
+    """
+    Caché de un prefijo para una key y un modelo
+    """
+
+    def __init__(self, prefix_tokens: int):
+        self.name: Optional[str] = None
+        self.expires_at = 0.0
+        self.failed_until = 0.0
+        self.prefix_tokens = prefix_tokens
+        self.hits = 0
+        self.lock = threading.Lock()  # una sola creación o renovación a la vez
+
+
+class ContextCache:
+    """
+    Cachés de los prefijos estables por API key, modelo y contenido
+    (compartida por las llamadas de AIProcessor)
+    """
+
+    def __init__(
+        self,
+        backend,
+        ttl_seconds: int = 3600,
+        refresh_margin_seconds: int = 300,
+        min_prefix_tokens: int = 1024,
+        failure_retry_seconds: int = 3600
+    ):
+        """
+        Inicializa la caché
+
+        Args:
+            backend: GeminiCacheBackend o LocalCacheBackend
+            ttl_seconds: Vida de cada caché al crearla o renovarla
+            refresh_margin_seconds: Se renueva al usarla si le queda menos que esto
+            min_prefix_tokens: Prefijos más cortos no se cachean (Gemini exige un mínimo por modelo)
+            failure_retry_seconds: Tras un error al crear la caché, se envía el prompt completo durante este tiempo
+        """
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.refresh_margin_seconds = min(refresh_margin_seconds, ttl_seconds // 2)
+        self.min_prefix_tokens = min_prefix_tokens
+        self.failure_retry_seconds = failure_retry_seconds
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[str, str, str], _CacheEntry] = {}
+
+        print(
+            f"Caché de contexto de Gemini ({backend.name}): TTL {ttl_seconds}s, "
+            f"prefijos desde {min_prefix_tokens} tokens"
+        )
+
+    def apply(self, model, lease, model_name: str, prefix: str, suffix: str):
+        """
+        Prepara una llamada con el prefijo en la caché, creándola o renovándola si hace falta
+
+        Args:
+            model: GenerativeModel ya ligado a la key
+            lease: Key de la llamada
+            model_name: Modelo de la llamada
+            prefix: Prefijo estable del prompt
+            suffix: Resto del prompt (la parte del caso)
+
+        Returns:
+            tuple: (modelo, prompt a enviar, True si se usó la caché)
+        """
+        name = self._cached_name(lease, model_name, prefix)
+        if name is None:
+            return model, prefix + suffix, False
+        return self.backend.bind(model, name), self.backend.request(prefix, suffix), True
+
+    def invalidate(self, lease, model_name: str, prefix: str):
+        """
+        Olvida la caché de un prefijo que Gemini ya no tiene (la próxima llamada crea otra)
+
+        Args:
+            lease: Key de la llamada
+            model_name: Modelo de la llamada
+            prefix: Prefijo estable del prompt
+        """
+        with self._lock:
+            entry = self._entries.get(self._key(lease, model_name, prefix))
+            if entry is not None:
+                entry.name = None
+                entry.expires_at = 0.0
+        metrics.increment("context_cache_invalidated")
+        print(f"Caché de contexto de {model_name} ({lease.label}) no encontrada en Gemini; se creará de nuevo")
+
+    def stats(self) -> Dict:
+        """
+        Obtiene el estado de las cachés
+
+        Returns:
+            dict: {'backend', 'ttl_seconds', 'caches': [{'key', 'model', 'prefix', 'prefix_tokens', 'hits', 'expires_in_seconds'}]}
+        """
+        with self._lock:
+            now = time.monotonic()
+            caches: List[Dict] = [
+                {
+                    "key": key_label,
+                    "model": model_name,
+                    "prefix": digest[:12],
+                    "prefix_tokens": entry.prefix_tokens,
+                    "hits": entry.hits,
+                    "expires_in_seconds": round(max(0.0, entry.expires_at - now)) if entry.name else None,
+                }
+                for (key_label, model_name, digest), entry in self._entries.items()
+            ]
+        return {"backend": self.backend.name, "ttl_seconds": self.ttl_seconds, "caches": caches}
+
+    @staticmethod
+    def _key(lease, model_name: str, prefix: str) -> Tuple[str, str, str]:
+        return lease.label, model_name, hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+
+    def _cached_name(self, lease, model_name: str, prefix: str) -> Optional[str]:
+        """
+        Devuelve el nombre de una caché vigente del prefijo, o None si se debe enviar el prompt completo
+        """
+        prefix_tokens = estimate_tokens(prefix)
+        if prefix_tokens < self.min_prefix_tokens:
+            return None
+
+        key = self._key(lease, model_name, prefix)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _CacheEntry(prefix_tokens)
+
+        with entry.lock:
+            now = time.monotonic()
+            if entry.failed_until > now:
+                return None
+
+            if entry.name and entry.expires_at - now > self.refresh_margin_seconds:
+                return self._hit(entry)
+
+            if entry.name and entry.expires_at > now:
+                # En uso y a punto de expirar: se extiende su vida
+                try:
+                    self.backend.refresh(lease, entry.name, self.ttl_seconds)
+                    entry.expires_at = time.monotonic() + self.ttl_seconds
+                    metrics.increment("context_cache_refreshed")
+                    return self._hit(entry)
+                except Exception as e:
+                    print(f"No se pudo renovar la caché de contexto de {model_name} ({lease.label}): {e}")
+                    entry.name = None
+
+            try:
+                entry.name = self.backend.create(lease, model_name, prefix, self.ttl_seconds)
+            except Exception as e:
+                entry.name = None
+                entry.failed_until = time.monotonic() + self.failure_retry_seconds
+                metrics.increment("context_cache_failures")
+                print(
+                    f"No se pudo crear la caché de contexto de {model_name} ({lease.label}), "
+                    f"se envía el prompt completo durante {self.failure_retry_seconds}s: {e}"
+                )
+                return None
+            entry.expires_at = time.monotonic() + self.ttl_seconds
+            metrics.increment("context_cache_created")
+            print(f"Caché de contexto creada para {model_name} ({lease.label}): ~{prefix_tokens} tokens, {entry.name}")
+            return self._hit(entry)
+
+    @staticmethod
+    def _hit(entry: _CacheEntry) -> str:
+        entry.hits += 1
+        metrics.increment("context_cache_hits")
+        return entry.name
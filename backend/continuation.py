@@ -0,0 +1,137 @@
+"""
+Continuación automática de respuestas truncadas
+Cuando Gemini corta una respuesta por max_output_tokens (finish_reason =
+MAX_TOKENS), se pide una continuación con la conversación hecha hasta ahí
+(prompt original + texto ya generado) y se une al texto anterior. El modelo a
+veces repite las últimas palabras antes de seguir; ese solape se recorta para
+que la unión no se note.
+"""
+
+from typing import List
+
+
+# Instrucción del turno de continuación
+CONTINUE_INSTRUCTION = (
+    "Tu respuesta anterior se cortó porque alcanzó el límite de longitud. "
+    "Continúa exactamente desde donde se cortó, empezando por el carácter siguiente. "
+    "No repitas nada de lo ya escrito, no añadas introducciones ni comentarios y "
+    "mantén el mismo idioma y formato."
+)
+
+# Caracteres del final del texto anterior en los que se busca el solape
+OVERLAP_WINDOW = 300
+
+# Solape mínimo que se recorta (por debajo puede ser una coincidencia legítima)
+MIN_OVERLAP = 12
+
+
+def hit_max_tokens(response) -> bool:
+    """
+    Indica si Gemini cortó la respuesta por max_output_tokens
+
+    Args:
+        response: GenerateContentResponse (en streaming, ya consumido)
+
+    Returns:
+        bool: True si finish_reason es MAX_TOKENS
+    """
+    candidates = getattr(response, "candidates", None) or ()
+    if not candidates:
+        return False
+    reason = getattr(candidates[0], "finish_reason", None)
+    return getattr(reason, "name", reason) in ("MAX_TOKENS", 2)
+
+
+def response_text(response) -> str:
+    """
+    Obtiene el texto de una respuesta sin fallar si el corte la dejó sin partes
+
+    Args:
+        response: GenerateContentResponse
+
+    Returns:
+        str: Texto de la respuesta ('' si no tiene)
+    """
+    try:
+        return response.text or ""
+    except ValueError:
+        return ""
+
+
+def continuation_request(prompt: str, generated: str) -> List[dict]:
+    """
+    Construye la solicitud que continúa una respuesta cortada
+
+    Args:
+        prompt: Prompt original
+        generated: Texto generado hasta ahora
+
+    Returns:
+        list: Contenido multi-turno para generate_content
+    """
+    return [
+        {"role": "user", "parts": [prompt]},
+        {"role": "model", "parts": [generated]},
+        {"role": "user", "parts": [CONTINUE_INSTRUCTION]},
+    ]
+
+
+def trim_overlap(previous: str, text: str) -> str:
+    """
+    Quita del inicio de la continuación lo que repite el final del texto anterior
+
+    Args:
+        previous: Texto generado hasta ahora
+        text: Inicio de la continuación
+
+    Returns:
+        str: Continuación sin el solape
+    """
+    tail = previous[-OVERLAP_WINDOW:]
+    for size in range(min(len(tail), len(text)), MIN_OVERLAP - 1, -1):
+        if tail.endswith(text[:size]):
+            return text[size:]
+    return text
+
+
+class SeamStitcher:
+    """
+    Une en streaming una continuación al texto anterior: retiene el inicio de
+    la continuación hasta poder comprobar el solape y después deja pasar los chunks
+    """
+
+    def __init__(self, previous: str):
+        """
+        Args:
+            previous: Texto generado hasta ahora ('' = primera parte, sin solape posible)
+        """
+        self.previous = previous
+        self._buffer = ""
+        self._checked = not previous
+
+    def feed(self, text: str) -> str:
+        """
+        Recibe un chunk de la continuación
+
+        Returns:
+            str: Texto que ya se puede enviar ('' mientras se retiene el inicio)
+        """
+        if self._checked:
+            return text
+        self._buffer += text
+        if len(self._buffer) < OVERLAP_WINDOW:
+            return ""
+        return self.flush()
+
+    def flush(self) -> str:
+        """
+        Devuelve lo retenido al terminar la continuación
+
+        Returns:
+            str: Texto pendiente sin el solape
+        """
+        if self._checked:
+            return ""
+        self._checked = True
+        text, self._buffer = trim_overlap(self.previous, self._buffer), ""
+        return text
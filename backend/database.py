@@ -3,12 +3,12 @@ Configuración y gestión de la base de datos SQLite
 Maneja la conexión, creación de tablas y operaciones CRUD
 """
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, func, or_, and_
 from sqlalchemy.orm import sessionmaker, Session
 from sqlalchemy.pool import StaticPool
-from backend.models import Base, Document, ProcessingLog
-from datetime import datetime
-from typing import Optional, List
+from backend.models import Base, Document, ProcessingLog, GenerationEvent, GenerationCacheEntry, ExtractedText, CaseFacts, OCRPageCache, ProcessingBatch, BatchItem, GenerationJob, GenerationPipeline
+from datetime import datetime, timedelta
+from typing import Optional, List, Tuple, Dict, Set
 import os
 
 
@@ -29,13 +29,28 @@ class DatabaseManager:
         self.database_url = database_url
         
         # Configuración especial para SQLite
+        engine_options = {}
+        if database_url in ("sqlite://", "sqlite:///:memory:"):
+            # Una base en memoria solo existe dentro de su conexión: se comparte una sola
+            engine_options["poolclass"] = StaticPool
+        
         self.engine = create_engine(
             database_url,
             connect_args={"check_same_thread": False},
-            poolclass=StaticPool,
-            echo=False  # Cambiar a True para depuración
+            echo=False,  # Cambiar a True para depuración
+            **engine_options
         )
         
+        # Con una conexión por sesión, las generaciones y tareas en segundo plano
+        # (hilos) no comparten transacciones; WAL permite leer mientras otra escribe
+        if database_url.startswith("sqlite") and "poolclass" not in engine_options:
+            @event.listens_for(self.engine, "connect")
+            def configure_sqlite(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                cursor.execute("PRAGMA journal_mode=WAL")
+                cursor.execute("PRAGMA busy_timeout=30000")
+                cursor.close()
+        
         self.SessionLocal = sessionmaker(
             autocommit=False,
             autoflush=False,
@@ -230,6 +245,27 @@ class DocumentRepository:
             self.db.commit()
             return True
         return False
+    
+    def count_documents_by_filename(self, filename: str) -> int:
+        """
+        Cuenta los documentos que usan un archivo subido (referencias al archivo)
+        
+        Args:
+            filename: Nombre del archivo en la carpeta de subidas
+        
+        Returns:
+            int: Número de documentos
+        """
+        return self.db.query(Document).filter(Document.filename == filename).count()
+    
+    def get_referenced_filenames(self) -> Set[str]:
+        """
+        Obtiene los nombres de todos los archivos subidos que usa algún documento
+        
+        Returns:
+            Set[str]: Nombres de archivo referenciados
+        """
+        return {row[0] for row in self.db.query(Document.filename).distinct().all()}
 
 
 class LogRepository:
@@ -286,6 +322,909 @@ class LogRepository:
         ).order_by(ProcessingLog.timestamp.desc()).all()
 
 
+class GenerationEventRepository:
+    """
+    Repositorio para los eventos SSE vaciados de memoria
+    """
+    
+    def __init__(self, db: Session):
+        self.db = db
+    
+    def save_events(self, generation_id: str, events: List[Tuple[int, str]]):
+        """
+        Guarda un bloque de eventos de una generación
+        
+        Args:
+            generation_id: ID de la generación
+            events: Lista de tuplas (seq, payload JSON)
+        """
+        now = datetime.utcnow()
+        self.db.add_all([
+            GenerationEvent(generation_id=generation_id, seq=seq, payload=payload, created_at=now)
+            for seq, payload in events
+        ])
+        self.db.commit()
+    
+    def get_events(self, generation_id: str, after_seq: int, before_seq: int) -> List[Tuple[int, str]]:
+        """
+        Obtiene los eventos guardados con after_seq < seq < before_seq
+        
+        Args:
+            generation_id: ID de la generación
+            after_seq: Último seq ya recibido por el cliente
+            before_seq: Primer seq que sigue en memoria
+        
+        Returns:
+            List[Tuple[int, str]]: Eventos (seq, payload JSON) en orden
+        """
+        rows = self.db.query(GenerationEvent).filter(
+            GenerationEvent.generation_id == generation_id,
+            GenerationEvent.seq > after_seq,
+            GenerationEvent.seq < before_seq
+        ).order_by(GenerationEvent.seq).all()
+        return [(row.seq, row.payload) for row in rows]
+    
+    def delete_events(self, generation_id: str) -> int:
+        """
+        Elimina los eventos guardados de una generación
+        
+        Args:
+            generation_id: ID de la generación
+        
+        Returns:
+            int: Número de eventos eliminados
+        """
+        deleted = self.db.query(GenerationEvent).filter(
+            GenerationEvent.generation_id == generation_id
+        ).delete()
+        self.db.commit()
+        return deleted
+    
+    def delete_events_older_than(self, cutoff: datetime, active_job_statuses: Tuple[str, ...] = ()) -> int:
+        """
+        Elimina los eventos de generaciones ya olvidadas (p. ej. tras un reinicio)
+        
+        Args:
+            cutoff: Fecha límite; se eliminan los eventos anteriores
+            active_job_statuses: Estados de trabajo cuyas generaciones se conservan
+                (una generación larga de otro proceso sigue usando sus primeros eventos)
+        
+        Returns:
+            int: Número de eventos eliminados
+        """
+        query = self.db.query(GenerationEvent).filter(GenerationEvent.created_at < cutoff)
+        if active_job_statuses:
+            active_generations = self.db.query(GenerationJob.generation_id).filter(
+                GenerationJob.status.in_(active_job_statuses),
+                GenerationJob.generation_id.isnot(None)
+            )
+            query = query.filter(GenerationEvent.generation_id.notin_(active_generations))
+        deleted = query.delete(synchronize_session=False)
+        self.db.commit()
+        return deleted
+
+
+class GenerationCacheRepository:
+    """
+    Repositorio para la caché de resultados de generación
+    """
+    
+    def __init__(self, db: Session):
+        self.db = db
+    
+    def get_entry(self, cache_key: str) -> Optional[GenerationCacheEntry]:
+        """
+        Obtiene una entrada y registra el acceso
+        
+        Args:
+            cache_key: Clave de la entrada
+        
+        Returns:
+            GenerationCacheEntry o None si no existe
+        """
+        entry = self.db.query(GenerationCacheEntry).filter(
+            GenerationCacheEntry.cache_key == cache_key
+        ).first()
+        if entry:
+            entry.last_accessed_at = datetime.utcnow()
+            entry.hit_count = (entry.hit_count or 0) + 1
+            self.db.commit()
+        return entry
+    
+    def save_entry(self, cache_key: str, kind: str, content: str) -> GenerationCacheEntry:
+        """
+        Guarda o reemplaza una entrada
+        
+        Args:
+            cache_key: Clave de la entrada
+            kind: Tipo de generación ('declaration' o 'cover')
+            content: Contenido generado
+        
+        Returns:
+            GenerationCacheEntry: Entrada guardada
+        """
+        now = datetime.utcnow()
+        entry = self.db.query(GenerationCacheEntry).filter(
+            GenerationCacheEntry.cache_key == cache_key
+        ).first()
+        if not entry:
+            entry = GenerationCacheEntry(cache_key=cache_key, hit_count=0)
+            self.db.add(entry)
+        entry.kind = kind
+        entry.content = content
+        entry.content_size = len(content.encode("utf-8"))
+        entry.created_at = now
+        entry.last_accessed_at = now
+        self.db.commit()
+        return entry
+    
+    def delete_entry(self, cache_key: str) -> bool:
+        """
+        Elimina una entrada
+        
+        Args:
+            cache_key: Clave de la entrada
+        
+        Returns:
+            bool: True si se eliminó
+        """
+        deleted = self.db.query(GenerationCacheEntry).filter(
+            GenerationCacheEntry.cache_key == cache_key
+        ).delete()
+        self.db.commit()
+        return deleted > 0
+    
+    def delete_expired(self, cutoff: datetime) -> int:
+        """
+        Elimina las entradas creadas antes de la fecha límite
+        
+        Args:
+            cutoff: Fecha límite
+        
+        Returns:
+            int: Número de entradas eliminadas
+        """
+        deleted = self.db.query(GenerationCacheEntry).filter(
+            GenerationCacheEntry.created_at < cutoff
+        ).delete()
+        self.db.commit()
+        return deleted
+    
+    def evict_to_size(self, max_bytes: int) -> int:
+        """
+        Elimina las entradas menos usadas recientemente hasta quedar bajo el límite
+        
+        Args:
+            max_bytes: Tamaño total máximo del contenido en caché
+        
+        Returns:
+            int: Número de entradas eliminadas
+        """
+        total = self.db.query(func.coalesce(func.sum(GenerationCacheEntry.content_size), 0)).scalar()
+        if total <= max_bytes:
+            return 0
+        
+        evicted = 0
+        entries = self.db.query(GenerationCacheEntry).order_by(
+            GenerationCacheEntry.last_accessed_at.asc()
+        ).all()
+        for entry in entries:
+            if total <= max_bytes:
+                break
+            total -= entry.content_size
+            self.db.delete(entry)
+            evicted += 1
+        self.db.commit()
+        return evicted
+
+
+class ExtractedTextRepository:
+    """
+    Repositorio para el texto extraído de los archivos subidos
+    """
+    
+    def __init__(self, db: Session):
+        self.db = db
+    
+    def get_by_file_hash(self, file_sha256: str) -> Optional[ExtractedText]:
+        """
+        Obtiene el texto extraído de un archivo
+        
+        Args:
+            file_sha256: SHA-256 del archivo
+        
+        Returns:
+            ExtractedText o None si no existe
+        """
+        return self.db.query(ExtractedText).filter(
+            ExtractedText.file_sha256 == file_sha256
+        ).first()
+    
+    def save_text(
+        self,
+        file_sha256: str,
+        text_sha256: str,
+        text_compressed: bytes,
+        text_length: int,
+        extraction_seconds: Optional[float] = None
+    ) -> ExtractedText:
+        """
+        Guarda o reemplaza el texto extraído de un archivo
+        
+        Args:
+            file_sha256: SHA-256 del archivo
+            text_sha256: SHA-256 del texto extraído
+            text_compressed: Texto comprimido
+            text_length: Longitud del texto sin comprimir
+            extraction_seconds: Tiempo que tomó la extracción
+        
+        Returns:
+            ExtractedText: Registro guardado
+        """
+        extracted = self.get_by_file_hash(file_sha256)
+        if not extracted:
+            extracted = ExtractedText(file_sha256=file_sha256)
+            self.db.add(extracted)
+        extracted.text_sha256 = text_sha256
+        extracted.text_compressed = text_compressed
+        extracted.text_length = text_length
+        extracted.extraction_seconds = extraction_seconds
+        extracted.created_at = datetime.utcnow()
+        self.db.commit()
+        self.db.refresh(extracted)
+        return extracted
+    
+    def delete_by_file_hash(self, file_sha256: str) -> bool:
+        """
+        Elimina el texto extraído de un archivo
+        
+        Args:
+            file_sha256: SHA-256 del archivo
+        
+        Returns:
+            bool: True si se eliminó
+        """
+        deleted = self.db.query(ExtractedText).filter(
+            ExtractedText.file_sha256 == file_sha256
+        ).delete()
+        self.db.commit()
+        return deleted > 0
+
+
+class CaseFactsRepository:
+    """
+    Repositorio para los hechos del caso extraídos de los cuestionarios
+    """
+    
+    def __init__(self, db: Session):
+        self.db = db
+    
+    def get_facts(self, document_id: int) -> Optional[CaseFacts]:
+        """
+        Obtiene los hechos del caso de un documento
+        
+        Args:
+            document_id: ID del documento
+        
+        Returns:
+            CaseFacts o None si no se han extraído
+        """
+        return self.db.query(CaseFacts).filter(
+            CaseFacts.document_id == document_id
+        ).first()
+    
+    def save_facts(
+        self,
+        document_id: int,
+        source_sha256: str,
+        fingerprint: str,
+        facts_json: str,
+        source_length: int,
+        extraction_seconds: Optional[float] = None
+    ) -> CaseFacts:
+        """
+        Guarda o reemplaza los hechos del caso de un documento
+        
+        Args:
+            document_id: ID del documento
+            source_sha256: SHA-256 del cuestionario normalizado
+            fingerprint: Huella del modelo, la configuración y el prompt de extracción
+            facts_json: Hechos del caso en JSON
+            source_length: Longitud del cuestionario
+            extraction_seconds: Tiempo que tomó la extracción
+        
+        Returns:
+            CaseFacts: Registro guardado
+        """
+        facts = self.get_facts(document_id)
+        if not facts:
+            facts = CaseFacts(document_id=document_id)
+            self.db.add(facts)
+        facts.source_sha256 = source_sha256
+        facts.fingerprint = fingerprint
+        facts.facts_json = facts_json
+        facts.source_length = source_length
+        facts.facts_length = len(facts_json)
+        facts.extraction_seconds = extraction_seconds
+        facts.created_at = datetime.utcnow()
+        self.db.commit()
+        self.db.refresh(facts)
+        return facts
+
+
+class OCRPageCacheRepository:
+    """
+    Repositorio para el texto reconocido por OCR
+    """
+    
+    def __init__(self, db: Session):
+        self.db = db
+    
+    def get_texts(self, image_hashes: List[str]) -> Dict[str, str]:
+        """
+        Obtiene el texto ya reconocido de varias imágenes
+        
+        Args:
+            image_hashes: SHA-256 de las imágenes
+        
+        Returns:
+            dict: {image_sha256: texto} solo para las imágenes encontradas
+        """
+        if not image_hashes:
+            return {}
+        entries = self.db.query(OCRPageCache).filter(
+            OCRPageCache.image_sha256.in_(image_hashes)
+        ).all()
+        return {entry.image_sha256: entry.text for entry in entries}
+    
+    def save_text(self, image_sha256: str, text: str, ocr_seconds: Optional[float] = None):
+        """
+        Guarda el texto reconocido de una imagen
+        
+        Args:
+            image_sha256: SHA-256 de la imagen
+            text: Texto reconocido
+            ocr_seconds: Tiempo que tomó el OCR
+        """
+        entry = self.db.query(OCRPageCache).filter(
+            OCRPageCache.image_sha256 == image_sha256
+        ).first()
+        if not entry:
+            entry = OCRPageCache(image_sha256=image_sha256)
+            self.db.add(entry)
+        entry.text = text
+        entry.ocr_seconds = ocr_seconds
+        self.db.commit()
+
+
+class BatchRepository:
+    """
+    Repositorio para los lotes de documentos
+    """
+    
+    def __init__(self, db: Session):
+        self.db = db
+    
+    def create_batch(self, batch_id: str, files: List[Dict], status: str = "uploaded") -> List[Document]:
+        """
+        Crea el lote con todos sus documentos y logs de subida en una sola transacción
+        
+        Args:
+            batch_id: ID del lote
+            files: Datos de cada archivo (filename, original_filename, file_size, file_type)
+            status: Estado inicial de los documentos ('uploaded' o 'queued')
+        
+        Returns:
+            List[Document]: Documentos creados, en el orden recibido
+        """
+        now = datetime.utcnow()
+        documents = [
+            Document(
+                filename=file_data["filename"],
+                original_filename=file_data["original_filename"],
+                file_size=file_data["file_size"],
+                file_type=file_data["file_type"],
+                status=status,
+                upload_date=now
+            )
+            for file_data in files
+        ]
+        try:
+            self.db.add_all(documents)
+            self.db.flush()  # asigna los IDs sin confirmar la transacción
+            
+            self.db.add(ProcessingBatch(batch_id=batch_id, document_count=len(documents), created_at=now))
+            for position, document in enumerate(documents):
+                self.db.add(BatchItem(batch_id=batch_id, document_id=document.id, position=position))
+                self.db.add(ProcessingLog(
+                    document_id=document.id,
+                    action="upload",
+                    details=f"Archivo subido en el lote {batch_id}: {document.original_filename}",
+                    success=True
+                ))
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        
+        for document in documents:
+            self.db.refresh(document)
+        return documents
+    
+    def get_batch(self, batch_id: str) -> Optional[ProcessingBatch]:
+        """
+        Obtiene un lote por su ID
+        
+        Args:
+            batch_id: ID del lote
+        
+        Returns:
+            ProcessingBatch o None si no existe
+        """
+        return self.db.query(ProcessingBatch).filter(ProcessingBatch.batch_id == batch_id).first()
+    
+    def get_batch_documents(self, batch_id: str) -> List[Document]:
+        """
+        Obtiene los documentos de un lote en el orden en que se subieron
+        
+        Args:
+            batch_id: ID del lote
+        
+        Returns:
+            List[Document]: Documentos del lote
+        """
+        return self.db.query(Document).join(
+            BatchItem, BatchItem.document_id == Document.id
+        ).filter(
+            BatchItem.batch_id == batch_id
+        ).order_by(BatchItem.position).all()
+
+
+class JobRepository:
+    """
+    Repositorio para la cola persistente de trabajos de generación
+
+    Las transiciones de estado usan el número de intentos como versión: un
+    UPDATE que no encuentra la fila con el valor esperado significa que otro
+    worker la tomó antes, así que varios procesos pueden compartir la cola.
+    """
+    
+    def __init__(self, db: Session):
+        self.db = db
+    
+    def create_job(
+        self,
+        kind: str,
+        document_id: int,
+        use_cache: bool = True,
+        source: str = "interactive",
+        priority: int = 0,
+        max_attempts: int = 3
+    ) -> GenerationJob:
+        """
+        Crea un trabajo en la cola
+        
+        Args:
+            kind: Tipo de generación ('declaration' o 'cover')
+            document_id: ID del documento
+            use_cache: False para ignorar la caché de generaciones
+            source: Origen ('interactive', 'batch' o 'recovery')
+            priority: Prioridad (menor número = se toma antes)
+            max_attempts: Intentos antes de marcarlo como fallido
+        
+        Returns:
+            GenerationJob: Trabajo creado
+        """
+        now = datetime.utcnow()
+        job = GenerationJob(
+            kind=kind,
+            document_id=document_id,
+            use_cache=use_cache,
+            source=source,
+            priority=priority,
+            max_attempts=max_attempts,
+            status="queued",
+            attempts=0,
+            available_at=now,
+            created_at=now,
+            updated_at=now
+        )
+        self.db.add(job)
+        self.db.commit()
+        self.db.refresh(job)
+        return job
+    
+    def get_job(self, job_id: int) -> Optional[GenerationJob]:
+        """
+        Obtiene un trabajo por su ID
+        
+        Args:
+            job_id: ID del trabajo
+        
+        Returns:
+            GenerationJob o None si no existe
+        """
+        return self.db.query(GenerationJob).filter(GenerationJob.id == job_id).first()
+    
+    def get_active_job(self, kind: str, document_id: int) -> Optional[GenerationJob]:
+        """
+        Obtiene el trabajo pendiente o en curso de un documento y tipo
+        
+        Args:
+            kind: Tipo de generación
+            document_id: ID del documento
+        
+        Returns:
+            GenerationJob o None si no hay ninguno activo
+        """
+        return self.db.query(GenerationJob).filter(
+            GenerationJob.kind == kind,
+            GenerationJob.document_id == document_id,
+            GenerationJob.status.in_(("queued", "running"))
+        ).order_by(GenerationJob.id).first()
+    
+    def get_job_by_generation(self, generation_id: str) -> Optional[GenerationJob]:
+        """
+        Obtiene el trabajo cuyo intento actual publica en una generación
+        
+        Args:
+            generation_id: ID de la generación
+        
+        Returns:
+            GenerationJob o None si no existe
+        """
+        return self.db.query(GenerationJob).filter(GenerationJob.generation_id == generation_id).first()
+    
+    def count_running_by_source(self, now: datetime) -> Dict[str, int]:
+        """
+        Cuenta los trabajos en curso (con lease vigente) por origen
+        
+        Args:
+            now: Fecha actual
+        
+        Returns:
+            dict: {origen: trabajos en curso}
+        """
+        rows = self.db.query(GenerationJob.source, func.count(GenerationJob.id)).filter(
+            GenerationJob.status == "running",
+            GenerationJob.lease_expires_at >= now
+        ).group_by(GenerationJob.source).all()
+        return {source: count for source, count in rows}
+    
+    def find_claimable(self, now: datetime, excluded_sources: List[str]) -> Optional[GenerationJob]:
+        """
+        Busca el próximo trabajo a tomar: pendiente y disponible, o en curso con
+        el lease vencido (su worker se detuvo sin terminarlo)
+        
+        Args:
+            now: Fecha actual
+            excluded_sources: Orígenes que ya alcanzaron su límite de trabajos en curso
+        
+        Returns:
+            GenerationJob o None si no hay trabajos para tomar
+        """
+        query = self.db.query(GenerationJob).filter(or_(
+            and_(GenerationJob.status == "queued", GenerationJob.available_at <= now),
+            and_(GenerationJob.status == "running", GenerationJob.lease_expires_at < now)
+        ))
+        if excluded_sources:
+            query = query.filter(GenerationJob.source.notin_(excluded_sources))
+        return query.order_by(GenerationJob.priority, GenerationJob.id).first()
+    
+    def try_claim(self, job: GenerationJob, owner: str, lease_seconds: float) -> bool:
+        """
+        Toma un trabajo si nadie lo tomó desde que se leyó
+        
+        Args:
+            job: Trabajo leído con find_claimable
+            owner: ID del worker
+            lease_seconds: Duración del lease
+        
+        Returns:
+            bool: True si el trabajo quedó tomado por este worker
+        """
+        now = datetime.utcnow()
+        claimed = self.db.query(GenerationJob).filter(
+            GenerationJob.id == job.id,
+            GenerationJob.status == job.status,
+            GenerationJob.attempts == job.attempts
+        ).update({
+            GenerationJob.status: "running",
+            GenerationJob.attempts: job.attempts + 1,
+            GenerationJob.lease_owner: owner,
+            GenerationJob.lease_expires_at: now + timedelta(seconds=lease_seconds),
+            GenerationJob.generation_id: None,
+            GenerationJob.updated_at: now
+        }, synchronize_session=False)
+        self.db.commit()
+        if claimed:
+            self.db.refresh(job)
+        return bool(claimed)
+    
+    def renew_lease(self, job_id: int, owner: str, lease_seconds: float) -> bool:
+        """
+        Extiende el lease de un trabajo en curso (heartbeat)
+        
+        Args:
+            job_id: ID del trabajo
+            owner: ID del worker
+            lease_seconds: Duración del lease desde ahora
+        
+        Returns:
+            bool: False si el trabajo ya no pertenece a este worker
+        """
+        now = datetime.utcnow()
+        renewed = self.db.query(GenerationJob).filter(
+            GenerationJob.id == job_id,
+            GenerationJob.status == "running",
+            GenerationJob.lease_owner == owner
+        ).update({
+            GenerationJob.lease_expires_at: now + timedelta(seconds=lease_seconds),
+            GenerationJob.updated_at: now
+        }, synchronize_session=False)
+        self.db.commit()
+        return bool(renewed)
+    
+    def set_generation(self, job_id: int, owner: str, generation_id: str) -> bool:
+        """
+        Registra la generación en la que publica el intento actual
+        
+        Args:
+            job_id: ID del trabajo
+            owner: ID del worker
+            generation_id: ID de la generación
+        
+        Returns:
+            bool: False si el trabajo ya no pertenece a este worker
+        """
+        updated = self.db.query(GenerationJob).filter(
+            GenerationJob.id == job_id,
+            GenerationJob.lease_owner == owner
+        ).update({
+            GenerationJob.generation_id: generation_id,
+            GenerationJob.updated_at: datetime.utcnow()
+        }, synchronize_session=False)
+        self.db.commit()
+        return bool(updated)
+    
+    def finish_job(self, job_id: int, owner: Optional[str], status: str, result: str) -> bool:
+        """
+        Marca un trabajo como terminado ('completed' o 'failed')
+        
+        Args:
+            job_id: ID del trabajo
+            owner: ID del worker (None para no verificarlo)
+            status: Estado final
+            result: Evento final en JSON
+        
+        Returns:
+            bool: False si el trabajo ya no pertenece a este worker
+        """
+        now = datetime.utcnow()
+        query = self.db.query(GenerationJob).filter(GenerationJob.id == job_id)
+        if owner is not None:
+            query = query.filter(GenerationJob.lease_owner == owner)
+        updated = query.update({
+            GenerationJob.status: status,
+            GenerationJob.result: result,
+            GenerationJob.lease_owner: None,
+            GenerationJob.lease_expires_at: None,
+            GenerationJob.updated_at: now,
+            GenerationJob.finished_at: now
+        }, synchronize_session=False)
+        self.db.commit()
+        return bool(updated)
+    
+    def requeue_job(self, job_id: int, owner: str, delay_seconds: float = 0, result: Optional[str] = None, count_attempt: bool = True) -> bool:
+        """
+        Devuelve un trabajo en curso a la cola
+        
+        Args:
+            job_id: ID del trabajo
+            owner: ID del worker
+            delay_seconds: Espera antes de que se pueda tomar de nuevo
+            result: Evento de error del intento fallido en JSON
+            count_attempt: False si el intento no llegó a fallar (p. ej. al apagar)
+        
+        Returns:
+            bool: False si el trabajo ya no pertenece a este worker
+        """
+        now = datetime.utcnow()
+        values = {
+            GenerationJob.status: "queued",
+            GenerationJob.available_at: now + timedelta(seconds=delay_seconds),
+            GenerationJob.lease_owner: None,
+            GenerationJob.lease_expires_at: None,
+            GenerationJob.updated_at: now
+        }
+        if result is not None:
+            values[GenerationJob.result] = result
+        if not count_attempt:
+            values[GenerationJob.attempts] = GenerationJob.attempts - 1
+        updated = self.db.query(GenerationJob).filter(
+            GenerationJob.id == job_id,
+            GenerationJob.status == "running",
+            GenerationJob.lease_owner == owner
+        ).update(values, synchronize_session=False)
+        self.db.commit()
+        return bool(updated)
+    
+    def count_by_status(self) -> Dict[str, int]:
+        """
+        Cuenta los trabajos por estado
+        
+        Returns:
+            dict: {estado: número de trabajos}
+        """
+        rows = self.db.query(GenerationJob.status, func.count(GenerationJob.id)).group_by(GenerationJob.status).all()
+        return {status: count for status, count in rows}
+    
+    def get_queue_position(self, job: GenerationJob) -> int:
+        """
+        Calcula cuántos trabajos pendientes se tomarán antes que uno dado
+        
+        Args:
+            job: Trabajo pendiente
+        
+        Returns:
+            int: Trabajos por delante en la cola
+        """
+        return self.db.query(func.count(GenerationJob.id)).filter(
+            GenerationJob.status == "queued",
+            or_(
+                GenerationJob.priority < job.priority,
+                and_(GenerationJob.priority == job.priority, GenerationJob.id < job.id)
+            )
+        ).scalar() or 0
+    
+    def get_documents_without_active_job(self, statuses: Tuple[str, ...]) -> List[Document]:
+        """
+        Obtiene los documentos que figuran en los estados dados sin un trabajo
+        de declaration letter pendiente o en curso (quedaron huérfanos)
+        
+        Args:
+            statuses: Estados del documento a revisar (p. ej. 'queued', 'processing')
+        
+        Returns:
+            List[Document]: Documentos huérfanos
+        """
+        active = self.db.query(GenerationJob.document_id).filter(
+            GenerationJob.kind == "declaration",
+            GenerationJob.status.in_(("queued", "running"))
+        )
+        return self.db.query(Document).filter(
+            Document.status.in_(statuses),
+            Document.id.notin_(active)
+        ).order_by(Document.id).all()
+
+
+
+class PipelineRepository:
+    """
+    Repositorio para las cadenas declaration letter -> cover letter
+    """
+    
+    def __init__(self, db: Session):
+        self.db = db
+    
+    def create_pipeline(self, document_id: int, declaration_job_id: int) -> GenerationPipeline:
+        """
+        Crea una cadena que espera al trabajo de la declaration letter
+        
+        Args:
+            document_id: ID del documento
+            declaration_job_id: Trabajo de la declaration letter
+        
+        Returns:
+            GenerationPipeline: Cadena creada
+        """
+        now = datetime.utcnow()
+        pipeline = GenerationPipeline(
+            document_id=document_id,
+            declaration_job_id=declaration_job_id,
+            status="declaration",
+            created_at=now,
+            updated_at=now
+        )
+        self.db.add(pipeline)
+        self.db.commit()
+        self.db.refresh(pipeline)
+        return pipeline
+    
+    def get_pipeline(self, pipeline_id: int) -> Optional[GenerationPipeline]:
+        """
+        Obtiene una cadena por su ID
+        
+        Args:
+            pipeline_id: ID de la cadena
+        
+        Returns:
+            GenerationPipeline o None si no existe
+        """
+        return self.db.query(GenerationPipeline).filter(GenerationPipeline.id == pipeline_id).first()
+    
+    def get_by_declaration_job(self, declaration_job_id: int) -> Optional[GenerationPipeline]:
+        """
+        Obtiene la cadena que sigue a un trabajo de declaration letter
+        
+        Args:
+            declaration_job_id: Trabajo de la declaration letter
+        
+        Returns:
+            GenerationPipeline o None si el trabajo no tiene cadena
+        """
+        return self.db.query(GenerationPipeline).filter(
+            GenerationPipeline.declaration_job_id == declaration_job_id
+        ).order_by(GenerationPipeline.id).first()
+    
+    def get_by_job(self, job_id: int) -> Optional[GenerationPipeline]:
+        """
+        Obtiene la cadena más reciente en la que participa un trabajo (en cualquier estado)
+        
+        Args:
+            job_id: Trabajo de declaration letter o de cover letter
+        
+        Returns:
+            GenerationPipeline o None si el trabajo no forma parte de ninguna cadena
+        """
+        return self.db.query(GenerationPipeline).filter(
+            (GenerationPipeline.declaration_job_id == job_id) | (GenerationPipeline.cover_job_id == job_id)
+        ).order_by(GenerationPipeline.id.desc()).first()
+    
+    def get_pipelines_for_job(self, job_id: int) -> List[GenerationPipeline]:
+        """
+        Obtiene las cadenas sin terminar en las que participa un trabajo
+        
+        Args:
+            job_id: Trabajo de declaration letter o de cover letter
+        
+        Returns:
+            List[GenerationPipeline]: Cadenas en curso
+        """
+        return self.db.query(GenerationPipeline).filter(
+            (GenerationPipeline.declaration_job_id == job_id) | (GenerationPipeline.cover_job_id == job_id),
+            GenerationPipeline.status.in_(("declaration", "cover"))
+        ).all()
+    
+    def get_stalled_pipelines(self) -> List[GenerationPipeline]:
+        """
+        Obtiene las cadenas que esperan a una declaration letter que ya terminó
+        (el proceso se detuvo antes de encolar el cover letter)
+        
+        Returns:
+            List[GenerationPipeline]: Cadenas detenidas
+        """
+        finished = self.db.query(GenerationJob.id).filter(GenerationJob.status.in_(("completed", "failed")))
+        return self.db.query(GenerationPipeline).filter(
+            GenerationPipeline.status == "declaration",
+            GenerationPipeline.declaration_job_id.in_(finished)
+        ).order_by(GenerationPipeline.id).all()
+    
+    def advance(self, pipeline_id: int, from_status: str, status: str, cover_job_id: Optional[int] = None) -> bool:
+        """
+        Cambia el estado de una cadena si sigue en el estado esperado
+        (varios procesos pueden intentar avanzarla a la vez)
+        
+        Args:
+            pipeline_id: ID de la cadena
+            from_status: Estado esperado
+            status: Nuevo estado
+            cover_job_id: Trabajo del cover letter (al pasar a 'cover')
+        
+        Returns:
+            bool: True si se cambió
+        """
+        values = {"status": status, "updated_at": datetime.utcnow()}
+        if cover_job_id is not None:
+            values["cover_job_id"] = cover_job_id
+        updated = self.db.query(GenerationPipeline).filter(
+            GenerationPipeline.id == pipeline_id,
+            GenerationPipeline.status == from_status
+        ).update(values, synchronize_session=False)
+        self.db.commit()
+        return updated == 1
+
+
 # ==================== FUNCIONES DE UTILIDAD ====================
 
 def init_database(database_url: str = "sqlite:///./declaration_letters.db"):
@@ -0,0 +1,146 @@
+"""
+Plazo total de una generación
+Cada generación recibe un presupuesto de tiempo (GEMINI_TIMEOUT) que cubre
+todas sus etapas: extracción del texto, espera de turno en Gemini, primer
+chunk y stream completo. Las etapas consultan el tiempo restante en lugar de
+usar cada una su propio timeout, así una generación no puede tardar la suma
+de todos ellos.
+"""
+
+import threading
+import time
+from typing import Callable, Optional
+
+
+class GenerationDeadlineExceeded(TimeoutError):
+    """
+    Se lanza cuando una generación agota su plazo o su stream deja de recibir chunks
+    """
+
+    def __init__(self, message: str, stalled: bool = False):
+        """
+        Args:
+            message: Descripción del corte
+            stalled: True si el stream dejó de enviar chunks (falla del modelo);
+                False si se agotó el plazo de la generación (documento extenso)
+        """
+        super().__init__(message)
+        self.stalled = stalled
+
+
+class Deadline:
+    """
+    Presupuesto de tiempo de una generación
+    """
+
+    def __init__(self, seconds: float):
+        """
+        Args:
+            seconds: Plazo total en segundos
+        """
+        self.seconds = seconds
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + seconds
+        self.stage = "inicio"  # etapa en curso, para el mensaje de error
+
+    def remaining(self) -> float:
+        """
+        Segundos que quedan del plazo (0 si ya venció)
+        """
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        """
+        Indica si el plazo ya venció
+        """
+        return time.monotonic() >= self.expires_at
+
+    def elapsed(self) -> float:
+        """
+        Segundos transcurridos desde el inicio
+        """
+        return time.monotonic() - self.started_at
+
+    def enter(self, stage: str):
+        """
+        Marca el inicio de una etapa
+
+        Raises:
+            GenerationDeadlineExceeded: Si el plazo ya venció
+        """
+        self.stage = stage
+        self.check()
+
+    def check(self):
+        """
+        Raises:
+            GenerationDeadlineExceeded: Si el plazo ya venció
+        """
+        if self.expired:
+            raise self.exceeded()
+
+    def exceeded(self) -> GenerationDeadlineExceeded:
+        """
+        Construye el error de plazo vencido en la etapa actual
+        """
+        return GenerationDeadlineExceeded(
+            f"Plazo de {self.seconds:.0f} segundos agotado durante {self.stage} "
+            f"(transcurridos {self.elapsed():.1f} s)"
+        )
+
+
+class StallWatchdog:
+    """
+    Vigila un stream desde un hilo aparte: si pasan stall_seconds sin chunks, o
+    vence el plazo, llama a abort para cortar la conexión que está bloqueada
+    """
+
+    def __init__(
+        self,
+        abort: Callable[[], None],
+        stall_seconds: float,
+        deadline: Optional[Deadline] = None,
+        poll_seconds: float = 1.0
+    ):
+        """
+        Args:
+            abort: Corta el stream (se llama una sola vez, desde el hilo del watchdog)
+            stall_seconds: Segundos máximos sin chunks (0 = sin límite)
+            deadline: Plazo total de la generación (opcional)
+            poll_seconds: Cada cuánto se revisa
+        """
+        self.abort = abort
+        self.stall_seconds = stall_seconds
+        self.deadline = deadline
+        self.poll_seconds = poll_seconds
+        self.reason: Optional[str] = None  # motivo del corte, si se cortó
+        self._last_chunk_at = time.monotonic()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._watch, name="gemini-stall-watchdog", daemon=True)
+
+    def __enter__(self) -> "StallWatchdog":
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self._stopped.set()
+        return False
+
+    def chunk_received(self):
+        """
+        Reinicia la cuenta de inactividad
+        """
+        self._last_chunk_at = time.monotonic()
+
+    def _watch(self):
+        while not self._stopped.wait(self.poll_seconds):
+            idle = time.monotonic() - self._last_chunk_at
+            if self.stall_seconds and idle >= self.stall_seconds:
+                self.reason = f"el stream de Gemini no envió datos durante {idle:.0f} segundos"
+            elif self.deadline and self.deadline.expired:
+                self.reason = "deadline"
+            else:
+                continue
+            self.abort()
+            return
@@ -0,0 +1,238 @@
+"""
+Pool de API keys de Gemini
+Con una sola configuración global (genai.configure) todo el tráfico consume la
+cuota de una única key. El pool reparte las llamadas entre varias keys (de
+proyectos distintos): cada key tiene su propio cliente, cada llamada usa una
+copia del modelo ligada al cliente de la key elegida, y una key que recibe un
+429 queda en pausa durante un tiempo mientras las demás siguen atendiendo.
+"""
+
+import copy
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+import google.ai.generativelanguage as glm
+from google.api_core import exceptions as google_exceptions
+
+from backend.gemini_retry import retry_after_seconds
+from backend.metrics import metrics
+
+
+# Estrategias de selección de key
+LEAST_LOADED = "least_loaded"
+ROUND_ROBIN = "round_robin"
+
+# Errores que indican que la cuota de la key se agotó
+QUOTA_ERRORS = (google_exceptions.TooManyRequests, google_exceptions.ResourceExhausted)
+
+
+class _KeyState:
+    """
+    Cliente y contadores de una API key
+    """
+
+    def __init__(self, api_key: str, index: int):
+        self.api_key = api_key
+        self.label = f"key{index + 1}(...{api_key[-4:]})"  # nunca se muestra la key completa
+        self.client = None  # se crea con la primera llamada
+        self.cache_client = None  # cachés de contexto del proyecto de la key, se crea al usarlas
+        self.active = 0
+        self.total_requests = 0
+        self.rate_limited = 0
+        self.cooldown_until = 0.0
+        self.recent: Deque[float] = deque()  # inicio de las llamadas del último minuto
+
+    def requests_last_minute(self, now: float) -> int:
+        while self.recent and now - self.recent[0] >= 60:
+            self.recent.popleft()
+        return len(self.recent)
+
+
+class GeminiKeyPool:
+    """
+    Reparte las llamadas a Gemini entre varias API keys (compartido por AIProcessor y ChatMemorySystem)
+    """
+
+    def __init__(self, api_keys: List[str], strategy: str = LEAST_LOADED, cooldown_seconds: float = 60):
+        """
+        Inicializa el pool
+
+        Args:
+            api_keys: API keys disponibles (se ignoran las vacías y las repetidas)
+            strategy: 'least_loaded' (menos llamadas en curso) o 'round_robin'
+            cooldown_seconds: Pausa mínima de una key tras recibir un 429
+
+        Raises:
+            ValueError: Si no hay ninguna key o la estrategia no existe
+        """
+        keys = list(dict.fromkeys(key.strip() for key in api_keys if key and key.strip()))
+        if not keys:
+            raise ValueError("Se necesita al menos una API key de Gemini")
+        if strategy not in (LEAST_LOADED, ROUND_ROBIN):
+            raise ValueError(f"Estrategia de API keys desconocida: {strategy}")
+
+        self.strategy = strategy
+        self.cooldown_seconds = cooldown_seconds
+        self._lock = threading.Lock()
+        self._keys = [_KeyState(key, index) for index, key in enumerate(keys)]
+        self._next = 0
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def lease(self, avoid: Optional["KeyLease"] = None) -> "KeyLease":
+        """
+        Elige la key de una llamada
+
+        Args:
+            avoid: Lease de otra llamada de la misma generación (por ejemplo la
+                solicitud original de un hedging), para usar otra key si hay
+
+        Returns:
+            KeyLease: Key elegida (usar con with alrededor de la llamada)
+        """
+        with self._lock:
+            now = time.monotonic()
+            candidates = [state for state in self._keys if state.cooldown_until <= now]
+            if avoid is not None and len(candidates) > 1:
+                candidates = [state for state in candidates if state is not avoid._state] or candidates
+
+            if not candidates:
+                # Todas en pausa: la que antes termina su pausa (el reintento esperará lo que pida la API)
+                state = min(self._keys, key=lambda key_state: key_state.cooldown_until)
+            elif self.strategy == ROUND_ROBIN:
+                state = self._round_robin(candidates)
+            else:
+                state = min(
+                    candidates,
+                    key=lambda key_state: (key_state.active, key_state.requests_last_minute(now))
+                )
+
+            if state.client is None:
+                state.client = glm.GenerativeServiceClient(client_options={"api_key": state.api_key})
+            state.active += 1
+            state.total_requests += 1
+            state.recent.append(now)
+        return KeyLease(self, state)
+
+    def stats(self) -> List[Dict]:
+        """
+        Obtiene el uso de cada key
+
+        Returns:
+            list: [{'key', 'active', 'requests_last_minute', 'total_requests', 'rate_limited', 'cooldown_seconds'}]
+        """
+        with self._lock:
+            now = time.monotonic()
+            return [
+                {
+                    "key": state.label,
+                    "active": state.active,
+                    "requests_last_minute": state.requests_last_minute(now),
+                    "total_requests": state.total_requests,
+                    "rate_limited": state.rate_limited,
+                    "cooldown_seconds": round(max(0.0, state.cooldown_until - now), 1),
+                }
+                for state in self._keys
+            ]
+
+    def _round_robin(self, candidates: List[_KeyState]) -> _KeyState:
+        for _ in range(len(self._keys)):
+            state = self._keys[self._next % len(self._keys)]
+            self._next += 1
+            if state in candidates:
+                return state
+        return candidates[0]
+
+    def _cache_client(self, state: _KeyState):
+        with self._lock:
+            if state.cache_client is None:
+                state.cache_client = glm.CacheServiceClient(client_options={"api_key": state.api_key})
+            return state.cache_client
+
+    def _release(self, state: _KeyState):
+        with self._lock:
+            state.active -= 1
+
+    def _cooldown(self, state: _KeyState, error: BaseException):
+        with self._lock:
+            state.rate_limited += 1
+            pause = max(self.cooldown_seconds, retry_after_seconds(error) or 0)
+            state.cooldown_until = max(state.cooldown_until, time.monotonic() + pause)
+        metrics.increment("gemini_key_cooldowns")
+        print(f"API key {state.label} sin cuota (429): en pausa {pause:.0f}s")
+
+
+class KeyLease:
+    """
+    Key asignada a una llamada a Gemini
+    """
+
+    def __init__(self, pool: GeminiKeyPool, state: _KeyState):
+        self._pool = pool
+        self._state = state
+        self._released = False
+        self._reported = False
+
+    @property
+    def label(self) -> str:
+        return self._state.label
+
+    def bind(self, model):
+        """
+        Devuelve una copia del modelo que llama con el cliente de esta key
+
+        Args:
+            model: GenerativeModel configurado (nombre, generation_config, safety_settings)
+
+        Returns:
+            GenerativeModel: Copia ligada a la key, solo para esta llamada
+        """
+        bound = copy.copy(model)
+        # GenerativeModel crea su cliente con la configuración global si _client es None
+        bound._client = self._state.client
+        return bound
+
+    def cache_client(self):
+        """
+        Cliente de las cachés de contexto de esta key (cada caché pertenece al proyecto de la key)
+
+        Returns:
+            CacheServiceClient: Cliente de cachedContents
+        """
+        return self._pool._cache_client(self._state)
+
+    def report(self, error: BaseException):
+        """
+        Anota el error de una llamada con esta key; un 429 la deja en pausa (una sola vez por lease)
+
+        Args:
+            error: Error de la llamada
+        """
+        if self._reported or not isinstance(error, QUOTA_ERRORS):
+            return
+        self._reported = True
+        self._pool._cooldown(self._state, error)
+
+    def release(self, error: Optional[BaseException] = None):
+        """
+        Libera la key (solo la primera vez)
+
+        Args:
+            error: Error de la llamada, si falló
+        """
+        if self._released:
+            return
+        if error is not None:
+            self.report(error)
+        self._released = True
+        self._pool._release(self._state)
+
+    def __enter__(self) -> "KeyLease":
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.release(exc)
+        return False
@@ -0,0 +1,303 @@
+"""
+Reintentos de las llamadas a Gemini
+Repite las llamadas que fallan por errores transitorios (429, 500, 503, 504,
+conexión cortada) con espera exponencial y jitter, respetando la espera que
+sugiere la API (RetryInfo / Retry-After) y sin pasar de un plazo total. Los
+streams solo se reintentan si fallan antes del primer chunk: después, repetir
+la llamada duplicaría el texto ya enviado al cliente.
+"""
+
+import random
+import re
+import time
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from google.api_core import exceptions as google_exceptions
+
+from backend.deadline import Deadline, GenerationDeadlineExceeded
+from backend.metrics import metrics
+
+
+# Errores de la API que vale la pena repetir
+RETRYABLE_API_ERRORS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.InternalServerError,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.GatewayTimeout,
+)
+
+# Errores de transporte (REST) que no heredan de ConnectionError/TimeoutError
+RETRYABLE_ERROR_NAMES = {"ReadTimeout", "ConnectTimeout", "ConnectionError", "RemoteDisconnected", "ProtocolError"}
+
+# Espera sugerida en el texto del error ("Please retry in 12.5s", "retry_delay { seconds: 12 }")
+_RETRY_HINT_PATTERNS = (
+    re.compile(r"retry in (\d+(?:\.\d+)?)\s*s", re.IGNORECASE),
+    re.compile(r"retry_delay\s*\{\s*seconds:\s*(\d+)"),
+    re.compile(r"\"retryDelay\":\s*\"(\d+(?:\.\d+)?)s\""),
+)
+
+
+def is_retryable(error: Optional[BaseException]) -> bool:
+    """
+    Indica si un error de Gemini es transitorio
+
+    Args:
+        error: Excepción lanzada por generate_content
+
+    Returns:
+        bool: True si la llamada se puede repetir
+    """
+    if error is None:
+        return False
+    if isinstance(error, GenerationDeadlineExceeded):
+        # Un stream trabado es transitorio; el plazo agotado no lo es ni culpa del modelo
+        return error.stalled
+    if isinstance(error, RETRYABLE_API_ERRORS):
+        return True
+    if isinstance(error, google_exceptions.GoogleAPICallError):
+        return False
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    return type(error).__name__ in RETRYABLE_ERROR_NAMES
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """
+    Obtiene la espera que sugiere la API antes de repetir la llamada
+
+    Args:
+        error: Excepción lanzada por generate_content
+
+    Returns:
+        float: Segundos sugeridos, o None si el error no trae la sugerencia
+    """
+    # RetryInfo en los detalles del error (gRPC)
+    for detail in getattr(error, "details", None) or ():
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None and hasattr(delay, "seconds"):
+            return delay.seconds + getattr(delay, "nanos", 0) / 1e9
+
+    # Encabezado Retry-After (REST)
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    retry_after = headers.get("Retry-After") or headers.get("retry-after")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+
+    message = str(error)
+    for pattern in _RETRY_HINT_PATTERNS:
+        match = pattern.search(message)
+        if match:
+            return float(match.group(1))
+    return None
+
+
+class RetryPolicy:
+    """
+    Política de reintentos de las llamadas a Gemini
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 4,
+        base_seconds: float = 2,
+        max_backoff_seconds: float = 30,
+        deadline_seconds: float = 300
+    ):
+        """
+        Args:
+            max_attempts: Intentos por llamada, incluido el primero (1 = sin reintentos)
+            base_seconds: Espera antes del primer reintento (se duplica en cada uno)
+            max_backoff_seconds: Espera máxima calculada (la que sugiere la API puede ser mayor)
+            deadline_seconds: Plazo total de la llamada con todos sus intentos
+        """
+        self.max_attempts = max_attempts
+        self.base_seconds = base_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.deadline_seconds = deadline_seconds
+
+    def backoff(self, attempt: int, error: BaseException) -> float:
+        """
+        Calcula la espera antes del siguiente intento
+
+        Args:
+            attempt: Intento que acaba de fallar (desde 1)
+            error: Error del intento
+
+        Returns:
+            float: Segundos de espera
+        """
+        delay = min(self.max_backoff_seconds, self.base_seconds * (2 ** (attempt - 1)))
+        delay = random.uniform(delay / 2, delay)  # jitter: los reintentos simultáneos no coinciden
+        hint = retry_after_seconds(error)
+        if hint is not None:
+            delay = max(delay, hint)
+        return delay
+
+
+class RetryRecord:
+    """
+    Intentos de una llamada a Gemini, para dejarlos en el historial del documento
+    """
+
+    def __init__(self):
+        self.attempts = 0
+        self.retries: List[Tuple[str, float]] = []  # (error, segundos de espera)
+        self.model: Optional[str] = None  # modelo que atendió el último intento
+
+    def merge(self, other: "RetryRecord"):
+        """
+        Suma los intentos de otra llamada de la misma generación (p. ej. una
+        sección del Cover Letter)
+
+        Args:
+            other: Registro de la otra llamada
+        """
+        self.attempts += other.attempts
+        self.retries.extend(other.retries)
+        if other.model:
+            self.model = other.model
+
+    def summary(self) -> str:
+        """
+        Resume los intentos en una línea para ProcessingLog
+
+        Returns:
+            str: Resumen legible
+        """
+        details = "; ".join(f"{error} (espera {delay:.1f}s)" for error, delay in self.retries)
+        return f"Gemini: {self.attempts} intentos. Reintentos: {details}"
+
+
+def _next_delay(
+    policy: RetryPolicy,
+    attempt: int,
+    error: BaseException,
+    started_at: float,
+    deadline: Optional[Deadline]
+) -> Optional[float]:
+    """
+    Devuelve la espera antes de repetir la llamada, o None si no se debe repetir
+    """
+    if not is_retryable(error) or attempt >= policy.max_attempts:
+        return None
+    delay = policy.backoff(attempt, error)
+    if deadline is not None:
+        if delay >= deadline.remaining():
+            return None
+    elif time.monotonic() - started_at + delay >= policy.deadline_seconds:
+        return None
+    return delay
+
+
+def _wait(delay: float, cancellation=None) -> bool:
+    """
+    Espera antes del siguiente intento; devuelve True si se canceló mientras esperaba
+    """
+    if cancellation is not None:
+        return cancellation.wait(delay)
+    time.sleep(delay)
+    return False
+
+
+def _record(record: Optional[RetryRecord], error: BaseException, delay: float, label: str, attempt: int):
+    """
+    Registra un reintento
+    """
+    print(f"{label}: intento {attempt} falló ({error}); reintentando en {delay:.1f}s")
+    metrics.increment("gemini_retries")
+    if record is not None:
+        record.retries.append((str(error)[:200], delay))
+
+
+def call_with_retry(
+    call: Callable,
+    policy: Optional[RetryPolicy],
+    record: Optional[RetryRecord] = None,
+    cancellation=None,
+    label: str = "Gemini",
+    deadline: Optional[Deadline] = None
+):
+    """
+    Ejecuta una llamada no streaming con reintentos
+
+    Args:
+        call: Función sin argumentos que hace la llamada
+        policy: Política de reintentos (None = un solo intento)
+        record: Registro de intentos (opcional)
+        cancellation: Objeto con wait(segundos) para cortar la espera (opcional)
+        label: Nombre de la llamada para los mensajes
+        deadline: Plazo total de la generación (reemplaza a policy.deadline_seconds)
+
+    Returns:
+        Resultado de la llamada
+
+    Raises:
+        Exception: El error del último intento
+    """
+    started_at = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        if record is not None:
+            record.attempts = attempt
+        try:
+            return call()
+        except Exception as error:
+            delay = _next_delay(policy, attempt, error, started_at, deadline) if policy else None
+            if delay is None:
+                raise
+            _record(record, error, delay, label, attempt)
+            if _wait(delay, cancellation):
+                raise
+
+
+def stream_with_retry(
+    open_stream: Callable[[], Iterable],
+    policy: Optional[RetryPolicy],
+    record: Optional[RetryRecord] = None,
+    cancellation=None,
+    label: str = "Gemini",
+    deadline: Optional[Deadline] = None
+) -> Iterator:
+    """
+    Consume un stream con reintentos mientras no haya producido ningún chunk
+
+    Args:
+        open_stream: Función sin argumentos que devuelve el iterador del stream
+        policy: Política de reintentos (None = un solo intento)
+        record: Registro de intentos (opcional)
+        cancellation: Objeto con wait(segundos) para cortar la espera (opcional)
+        label: Nombre de la llamada para los mensajes
+        deadline: Plazo total de la generación (reemplaza a policy.deadline_seconds)
+
+    Yields:
+        Los chunks del stream
+
+    Raises:
+        Exception: El error del último intento, o cualquier error tras el primer chunk
+    """
+    started_at = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        if record is not None:
+            record.attempts = attempt
+        produced = False
+        try:
+            for item in open_stream():
+                produced = True
+                yield item
+            return
+        except Exception as error:
+            delay = _next_delay(policy, attempt, error, started_at, deadline) if policy and not produced else None
+            if delay is None:
+                raise
+            _record(record, error, delay, label, attempt)
+            if _wait(delay, cancellation):
+                raise
@@ -0,0 +1,395 @@
+"""
+Planificador global de llamadas a Gemini
+Limita por modelo las llamadas simultáneas, las solicitudes por minuto (RPM) y
+los tokens por minuto (TPM), para que una ráfaga de generaciones no choque con
+los 429 de la API y falle todo a la vez. Las llamadas esperan su turno en el
+hilo que las hace: primero el chat interactivo, luego las generaciones
+interactivas y al final los lotes; dentro de cada prioridad se alterna entre
+usuarios/documentos para que ninguno acapare el modelo.
+"""
+
+import itertools
+import json
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional
+
+from backend.metrics import metrics
+
+
+# Prioridades (menor número = se atiende antes)
+PRIORITY_CHAT = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BATCH = 2
+
+PRIORITY_NAMES = {PRIORITY_CHAT: "chat", PRIORITY_INTERACTIVE: "interactive", PRIORITY_BATCH: "batch"}
+
+# Ventana de los límites por minuto
+_WINDOW_SECONDS = 60.0
+
+# Cada cuánto revisa un hilo en espera si su llamada se canceló
+_WAIT_POLL_SECONDS = 0.5
+
+
+class GeminiQueueTimeout(Exception):
+    """
+    Se lanza cuando una llamada espera turno más tiempo del permitido
+    """
+    pass
+
+
+class ModelLimits:
+    """
+    Límites de uso de un modelo
+    """
+
+    def __init__(self, max_concurrent: int = 4, rpm: int = 0, tpm: int = 0):
+        """
+        Args:
+            max_concurrent: Llamadas simultáneas (0 = sin límite)
+            rpm: Solicitudes por minuto (0 = sin límite)
+            tpm: Tokens por minuto, entrada + salida (0 = sin límite)
+        """
+        self.max_concurrent = max_concurrent
+        self.rpm = rpm
+        self.tpm = tpm
+
+
+def parse_model_limits(raw: str, default_limits: ModelLimits) -> Dict[str, ModelLimits]:
+    """
+    Lee los límites por modelo de un JSON como
+    {"gemini-2.0-flash-exp": {"max_concurrent": 8, "rpm": 60, "tpm": 1000000}};
+    los campos omitidos toman el valor por defecto
+
+    Args:
+        raw: JSON de configuración (vacío = sin límites propios)
+        default_limits: Límites por defecto
+
+    Returns:
+        dict: {modelo: ModelLimits}
+    """
+    if not raw.strip():
+        return {}
+    try:
+        config = json.loads(raw)
+        return {
+            model: ModelLimits(
+                max_concurrent=int(values.get("max_concurrent", default_limits.max_concurrent)),
+                rpm=int(values.get("rpm", default_limits.rpm)),
+                tpm=int(values.get("tpm", default_limits.tpm))
+            )
+            for model, values in config.items()
+        }
+    except (ValueError, TypeError, AttributeError) as e:
+        print(f"Advertencia: límites por modelo de Gemini inválidos, se ignoran: {e}")
+        return {}
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estima los tokens de un texto (aprox. 4 caracteres por token)
+
+    Args:
+        text: Texto del prompt
+
+    Returns:
+        int: Tokens estimados
+    """
+    return max(1, len(text) // 4)
+
+
+class _Waiter:
+    """
+    Llamada esperando turno
+    """
+
+    def __init__(self, seq: int, model: str, priority: int, key: str, tokens: int):
+        self.seq = seq
+        self.model = model
+        self.priority = priority
+        self.key = key
+        self.tokens = tokens
+        self.enqueued_at = time.monotonic()
+
+
+class _ModelState:
+    """
+    Uso actual de un modelo
+    """
+
+    def __init__(self, limits: ModelLimits):
+        self.limits = limits
+        self.active = 0
+        self.window: Deque[List] = deque()  # [instante, tokens] de cada solicitud del último minuto
+
+    def prune(self, now: float):
+        while self.window and now - self.window[0][0] >= _WINDOW_SECONDS:
+            self.window.popleft()
+
+    def window_tokens(self) -> int:
+        return sum(entry[1] for entry in self.window)
+
+    def seconds_until_fits(self, tokens: int, now: float) -> float:
+        """
+        0 si una solicitud de tokens cabe ahora; si no, segundos hasta que se libere la ventana
+        """
+        limits = self.limits
+        if limits.max_concurrent and self.active >= limits.max_concurrent:
+            return float("inf")  # se libera al terminar otra llamada
+        if limits.rpm and len(self.window) >= limits.rpm:
+            return _WINDOW_SECONDS - (now - self.window[0][0])
+        # Una solicitud más grande que el límite pasa sola, con la ventana vacía
+        if limits.tpm and self.window and self.window_tokens() + tokens > limits.tpm:
+            return _WINDOW_SECONDS - (now - self.window[0][0])
+        return 0.0
+
+
+class GeminiGrant:
+    """
+    Turno concedido a una llamada; se devuelve al salir del bloque with
+    """
+
+    def __init__(self, scheduler: Optional["GeminiScheduler"], model: str, entry: Optional[List]):
+        self._scheduler = scheduler
+        self._model = model
+        self._entry = entry
+        self._released = False
+
+    def record_usage(self, usage_metadata):
+        """
+        Corrige los tokens reservados con el uso real que informa Gemini y
+        cuenta los tokens de entrada servidos desde la caché de contexto y los demás
+
+        Args:
+            usage_metadata: response.usage_metadata (puede ser None)
+        """
+        prompt_tokens = getattr(usage_metadata, "prompt_token_count", None)
+        if prompt_tokens:
+            # prompt_token_count incluye los tokens que vienen de la caché
+            cached_tokens = getattr(usage_metadata, "cached_content_token_count", None) or 0
+            metrics.increment("gemini_input_tokens_cached", cached_tokens)
+            metrics.increment("gemini_input_tokens_uncached", prompt_tokens - cached_tokens)
+
+        total = getattr(usage_metadata, "total_token_count", None)
+        if self._scheduler and self._entry is not None and total:
+            with self._scheduler._condition:
+                self._entry[1] = total
+            metrics.increment("gemini_tokens_used", total)
+
+    def __enter__(self) -> "GeminiGrant":
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        # Solo la primera vez: el turno pudo devolverse antes (solicitud perdedora de un hedging)
+        if self._scheduler and not self._released:
+            self._released = True
+            self._scheduler._release(self._model)
+        return False
+
+
+class GeminiScheduler:
+    """
+    Cola de prioridad con límites por modelo, compartida por todas las llamadas
+    a Gemini del proceso (AIProcessor y ChatMemorySystem)
+    """
+
+    def __init__(
+        self,
+        default_limits: ModelLimits,
+        model_limits: Optional[Dict[str, ModelLimits]] = None,
+        max_wait_seconds: float = 300
+    ):
+        """
+        Inicializa el planificador
+
+        Args:
+            default_limits: Límites de los modelos sin configuración propia
+            model_limits: Límites por nombre de modelo
+            max_wait_seconds: Espera máxima por turno antes de fallar la llamada
+        """
+        self.default_limits = default_limits
+        self.model_limits = model_limits or {}
+        self.max_wait_seconds = max_wait_seconds
+
+        self._condition = threading.Condition()
+        self._models: Dict[str, _ModelState] = {}
+        self._waiters: List[_Waiter] = []
+        self._sequence = itertools.count()
+        self._last_served: Dict[str, int] = {}  # clave de equidad -> orden del último turno
+        self._wait_stats: Dict[int, List[float]] = {}  # prioridad -> [turnos, segundos totales, máximo]
+
+    def acquire(
+        self,
+        model: str,
+        prompt: str = "",
+        priority: int = PRIORITY_INTERACTIVE,
+        fairness_key: Optional[str] = None,
+        cancelled: Optional[Callable[[], bool]] = None,
+        max_wait: Optional[float] = None
+    ) -> GeminiGrant:
+        """
+        Espera turno para una llamada (bloqueante, se usa desde los hilos de IA)
+
+        Args:
+            model: Nombre del modelo
+            prompt: Prompt, para estimar los tokens de entrada
+            priority: PRIORITY_CHAT, PRIORITY_INTERACTIVE o PRIORITY_BATCH
+            fairness_key: Usuario o documento que hace la llamada
+            cancelled: Devuelve True si la llamada se canceló mientras esperaba
+            max_wait: Espera máxima de esta llamada, si es menor que max_wait_seconds
+
+        Returns:
+            GeminiGrant: Turno concedido (usar con with)
+
+        Raises:
+            GeminiQueueTimeout: Si la espera supera max_wait_seconds o max_wait
+        """
+        wait_limit = self.max_wait_seconds if max_wait is None else min(self.max_wait_seconds, max_wait)
+        with self._condition:
+            state = self._state(model)
+            waiter = _Waiter(next(self._sequence), model, priority, fairness_key or "", estimate_tokens(prompt))
+            self._waiters.append(waiter)
+            self._publish_gauges()
+            try:
+                while True:
+                    now = time.monotonic()
+                    state.prune(now)
+                    delay = state.seconds_until_fits(waiter.tokens, now)
+                    if delay == 0 and self._next_waiter(model) is waiter:
+                        break
+
+                    waited = now - waiter.enqueued_at
+                    if waited >= wait_limit:
+                        metrics.increment("gemini_queue_timeouts")
+                        raise GeminiQueueTimeout(
+                            f"Gemini ({model}) sin turno disponible tras {waited:.1f} segundos de espera"
+                        )
+                    if cancelled and cancelled():
+                        raise GeminiQueueTimeout("Llamada cancelada mientras esperaba turno")
+
+                    timeout = min(delay, wait_limit - waited)
+                    if cancelled:
+                        timeout = min(timeout, _WAIT_POLL_SECONDS)
+                    self._condition.wait(timeout=max(timeout, 0.01))
+            finally:
+                self._waiters.remove(waiter)
+                # El siguiente en la cola puede ser otro hilo
+                self._condition.notify_all()
+
+            entry = [now, waiter.tokens]
+            state.window.append(entry)
+            state.active += 1
+            self._last_served[waiter.key] = waiter.seq
+            self._record_wait(priority, now - waiter.enqueued_at)
+            self._publish_gauges()
+
+        return GeminiGrant(self, model, entry)
+
+    def stats(self) -> Dict:
+        """
+        Obtiene el uso de cada modelo y los tiempos de espera por prioridad
+
+        Returns:
+            dict: {'models': {...}, 'wait_seconds': {...}}
+        """
+        with self._condition:
+            now = time.monotonic()
+            models = {}
+            for model, state in self._models.items():
+                state.prune(now)
+                models[model] = {
+                    "active": state.active,
+                    "waiting": sum(1 for waiter in self._waiters if waiter.model == model),
+                    "requests_last_minute": len(state.window),
+                    "tokens_last_minute": state.window_tokens(),
+                    "max_concurrent": state.limits.max_concurrent,
+                    "rpm": state.limits.rpm,
+                    "tpm": state.limits.tpm,
+                }
+            wait_seconds = {
+                PRIORITY_NAMES.get(priority, str(priority)): {
+                    "admitted": int(count),
+                    "avg": round(total / count, 3) if count else 0.0,
+                    "max": round(maximum, 3),
+                }
+                for priority, (count, total, maximum) in sorted(self._wait_stats.items())
+            }
+            return {"models": models, "wait_seconds": wait_seconds}
+
+    def _state(self, model: str) -> _ModelState:
+        """
+        Obtiene (o crea) el estado de un modelo
+        """
+        state = self._models.get(model)
+        if state is None:
+            state = self._models[model] = _ModelState(self.model_limits.get(model, self.default_limits))
+        return state
+
+    def _next_waiter(self, model: str) -> Optional[_Waiter]:
+        """
+        Elige la próxima llamada de un modelo: mayor prioridad, luego la clave
+        atendida hace más tiempo, luego orden de llegada
+        """
+        candidates = [waiter for waiter in self._waiters if waiter.model == model]
+        if not candidates:
+            return None
+        return min(
+            candidates,
+            key=lambda waiter: (waiter.priority, self._last_served.get(waiter.key, -1), waiter.seq)
+        )
+
+    def _release(self, model: str):
+        """
+        Libera el lugar de una llamada terminada
+        """
+        with self._condition:
+            self._models[model].active -= 1
+            self._publish_gauges()
+            self._condition.notify_all()
+
+    def _record_wait(self, priority: int, waited: float):
+        """
+        Acumula el tiempo de espera de una llamada admitida
+        """
+        stats = self._wait_stats.setdefault(priority, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += waited
+        stats[2] = max(stats[2], waited)
+        metrics.increment(f"gemini_admitted_{PRIORITY_NAMES.get(priority, priority)}")
+
+    def _publish_gauges(self):
+        """
+        Publica las llamadas en curso y en espera
+        """
+        metrics.set_gauge("gemini_active_calls", sum(state.active for state in self._models.values()))
+        metrics.set_gauge("gemini_waiting_calls", len(self._waiters))
+
+
+def gemini_turn(
+    scheduler: Optional[GeminiScheduler],
+    model: str,
+    prompt: str = "",
+    priority: int = PRIORITY_INTERACTIVE,
+    fairness_key: Optional[str] = None,
+    cancelled: Optional[Callable[[], bool]] = None,
+    max_wait: Optional[float] = None
+) -> GeminiGrant:
+    """
+    Pide turno al planificador, o concede uno inmediato si no hay planificador
+
+    Args:
+        scheduler: Planificador (None = sin límites)
+        model: Nombre del modelo
+        prompt: Prompt, para estimar los tokens de entrada
+        priority: Prioridad de la llamada
+        fairness_key: Usuario o documento que hace la llamada
+        cancelled: Devuelve True si la llamada se canceló mientras esperaba
+        max_wait: Espera máxima de esta llamada (opcional)
+
+    Returns:
+        GeminiGrant: Turno concedido (usar con with)
+    """
+    if scheduler is None:
+        return GeminiGrant(None, model, None)
+    return scheduler.acquire(model, prompt, priority, fairness_key, cancelled, max_wait)
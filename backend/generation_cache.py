@@ -0,0 +1,126 @@
+"""
+Caché de resultados de generación en SQLite
+Un cuestionario idéntico (o una Declaration Letter idéntica, para el Cover Letter)
+con los mismos prompts, modelo y configuración devuelve el resultado guardado
+sin volver a llamar a Gemini
+"""
+
+import hashlib
+import re
+import unicodedata
+from datetime import datetime, timedelta
+from typing import Optional
+
+from backend.database import DatabaseManager, GenerationCacheRepository
+from backend.metrics import metrics
+
+
+def normalize_source_text(text: str) -> str:
+    """
+    Normaliza el texto de entrada para que diferencias irrelevantes
+    (saltos de línea de Windows, espacios finales, líneas en blanco extra)
+    no cambien la clave de caché
+
+    Args:
+        text: Texto de entrada
+
+    Returns:
+        str: Texto normalizado
+    """
+    text = unicodedata.normalize("NFC", text)
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    text = "\n".join(line.rstrip() for line in text.split("\n"))
+    text = re.sub(r"\n{3,}", "\n\n", text)
+    return text.strip()
+
+
+class GenerationCache:
+    """
+    Caché de generaciones con expiración por antigüedad y límite de tamaño (LRU)
+    """
+
+    def __init__(self, db_manager: DatabaseManager, ttl_hours: float = 168, max_bytes: int = 50 * 1024 * 1024):
+        """
+        Inicializa la caché
+
+        Args:
+            db_manager: Gestor de base de datos
+            ttl_hours: Horas que una entrada sigue siendo válida
+            max_bytes: Tamaño total máximo del contenido guardado
+        """
+        self.db_manager = db_manager
+        self.ttl = timedelta(hours=ttl_hours)
+        self.max_bytes = max_bytes
+
+        print(f"Caché de generaciones inicializada: TTL {ttl_hours}h, máximo {max_bytes // (1024 * 1024)} MB")
+
+    @staticmethod
+    def build_key(kind: str, source_text: str, fingerprint: str) -> str:
+        """
+        Construye la clave de caché
+
+        Args:
+            kind: Tipo de generación ('declaration' o 'cover')
+            source_text: Cuestionario o Declaration Letter de entrada
+            fingerprint: Huella de modelo, configuración y prompts (AIProcessor.generation_fingerprint)
+
+        Returns:
+            str: Hash SHA-256 en hexadecimal
+        """
+        digest = hashlib.sha256()
+        for part in (kind, fingerprint, normalize_source_text(source_text)):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(self, cache_key: str) -> Optional[str]:
+        """
+        Busca un resultado guardado
+
+        Args:
+            cache_key: Clave de caché
+
+        Returns:
+            str: Contenido guardado o None si no existe o expiró
+        """
+        db = self.db_manager.get_session()
+        try:
+            repository = GenerationCacheRepository(db)
+            entry = repository.get_entry(cache_key)
+            if entry and entry.created_at < datetime.utcnow() - self.ttl:
+                repository.delete_entry(cache_key)
+                entry = None
+
+            if entry:
+                metrics.increment("generation_cache_hits")
+                return entry.content
+
+            metrics.increment("generation_cache_misses")
+            return None
+        except Exception as e:
+            print(f"Error al leer la caché de generaciones: {e}")
+            return None
+        finally:
+            db.close()
+
+    def put(self, cache_key: str, kind: str, content: str):
+        """
+        Guarda un resultado y aplica la expiración y el límite de tamaño
+
+        Args:
+            cache_key: Clave de caché
+            kind: Tipo de generación ('declaration' o 'cover')
+            content: Contenido generado
+        """
+        db = self.db_manager.get_session()
+        try:
+            repository = GenerationCacheRepository(db)
+            repository.save_entry(cache_key, kind, content)
+            expired = repository.delete_expired(datetime.utcnow() - self.ttl)
+            evicted = repository.evict_to_size(self.max_bytes)
+            if expired or evicted:
+                metrics.increment("generation_cache_evictions", expired + evicted)
+        except Exception as e:
+            print(f"Error al guardar en la caché de generaciones: {e}")
+        finally:
+            db.close()
@@ -0,0 +1,496 @@
+"""
+Registro de generaciones en curso para los endpoints SSE
+Desacopla la generación de la conexión HTTP: cada evento lleva un número de
+secuencia y un cliente que reconecta con Last-Event-ID recibe lo que se perdió
+y continúa en la generación en vivo, sin volver a llamar a Gemini
+"""
+
+import asyncio
+import json
+import sys
+import uuid
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from backend.database import DatabaseManager, GenerationEventRepository
+from backend.job_queue import ACTIVE_JOB_STATUSES
+from backend.metrics import metrics
+
+
+# Tiempo de reconexión sugerido al EventSource del navegador
+SSE_RETRY_MILLISECONDS = 3000
+
+
+class LiveGeneration:
+    """
+    Generación en curso con su buffer de eventos numerados
+    """
+
+    def __init__(self, hub: "GenerationHub", kind: str, document_id: int):
+        """
+        Inicializa la generación
+
+        Args:
+            hub: Registro al que pertenece
+            kind: Tipo de generación ('declaration' o 'cover')
+            document_id: ID del documento
+        """
+        self.hub = hub
+        self.kind = kind
+        self.document_id = document_id
+        self.generation_id = uuid.uuid4().hex
+        self.created_at = datetime.utcnow()
+        self.done = False
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        # False para generaciones que deben terminar aunque nadie las siga (lotes y cadenas de la cola)
+        self.cancel_when_abandoned = True
+        # True si se canceló porque ningún cliente la seguía
+        self.abandoned = False
+        # Último evento 'complete' o 'error' publicado
+        self.final_event: Optional[Dict] = None
+
+        self._events: List[Tuple[int, str]] = []  # (seq, payload JSON) en memoria
+        self._first_memory_seq = 1
+        self._last_seq = 0
+        self._persisted_seq = 0  # último seq guardado en SQLite
+        self._changed = asyncio.Event()
+        self._idle_handle: Optional[asyncio.TimerHandle] = None
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        # Tarea que guarda los eventos en SQLite fuera del event loop (una por generación)
+        self._writer: Optional[asyncio.Task] = None
+        self._write_requested = False
+
+    @property
+    def last_seq(self) -> int:
+        """
+        Último número de secuencia publicado
+        """
+        return self._last_seq
+
+    def publish(self, event: Dict) -> int:
+        """
+        Agrega un evento al buffer y despierta a los suscriptores
+
+        Args:
+            event: Evento a enviar (se serializa a JSON)
+
+        Returns:
+            int: Número de secuencia asignado
+        """
+        if self.done:
+            raise RuntimeError("La generación ya terminó")
+
+        self._last_seq += 1
+        self._events.append((self._last_seq, json.dumps(event)))
+        if event.get("type") in ("complete", "error"):
+            self.final_event = event
+
+        if len(self._events) > self.hub.max_memory_events:
+            self._request_write()
+        elif self.hub.persist_events and not self._flush_handle:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(self.hub.persist_interval_seconds, self._request_write)
+
+        self._notify()
+        return self._last_seq
+
+    def finish(self):
+        """
+        Marca la generación como terminada
+        """
+        self.done = True
+        if self.hub.persist_events:
+            self._request_write()
+        self._notify()
+        self.hub._release(self)
+
+    async def wait_saved(self):
+        """
+        Espera a que terminen los guardados en SQLite pendientes (el proceso
+        web lee de ahí los últimos eventos de un worker externo)
+        """
+        while self._writer and not self._writer.done():
+            await asyncio.shield(self._writer)
+
+    async def events_after(self, after_seq: int) -> AsyncIterator[Tuple[int, str]]:
+        """
+        Recorre los eventos posteriores a after_seq y luego los nuevos hasta terminar
+
+        Args:
+            after_seq: Último seq ya recibido por el cliente (0 para todos)
+
+        Yields:
+            Tuple[int, str]: (seq, payload JSON)
+        """
+        seq = after_seq
+        while True:
+            changed = self._changed
+
+            # Eventos que ya se vaciaron a SQLite
+            if seq + 1 < self._first_memory_seq:
+                first_memory_seq = self._first_memory_seq
+                spilled = await asyncio.to_thread(self.hub._load_spilled, self.generation_id, seq, first_memory_seq)
+                for event in spilled:
+                    seq = event[0]
+                    yield event
+                # Si faltan filas en SQLite se salta el hueco en lugar de reintentar sin fin
+                seq = max(seq, first_memory_seq - 1)
+                continue
+
+            # Eventos en memoria
+            index = seq + 1 - self._first_memory_seq
+            if index < len(self._events):
+                event = self._events[index]
+                seq = event[0]
+                yield event
+                continue
+
+            if self.done:
+                return
+
+            await changed.wait()
+
+    def _request_write(self):
+        """
+        Pide un guardado en SQLite sin bloquear al que publica: la tarea de
+        escritura corre la consulta en un hilo y junta en un solo lote lo que
+        se publique mientras tanto
+        """
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._write_requested = True
+        if not self._writer or self._writer.done():
+            self._writer = asyncio.create_task(self._write())
+
+    async def _write(self):
+        """
+        Guarda los eventos pendientes y vacía de memoria los ya guardados
+        """
+        while self._write_requested:
+            self._write_requested = False
+            batch = self._pending_batch()
+            if not batch:
+                continue
+            if not await asyncio.to_thread(self.hub._save_spilled, self.generation_id, batch):
+                # Se conservan en memoria; el próximo evento o guardado lo intenta de nuevo
+                return
+            self._persisted_seq = batch[-1][0]
+            self._trim_memory()
+
+    def _pending_batch(self) -> List[Tuple[int, str]]:
+        """
+        Eventos a guardar: todos los nuevos con persist_events, o la mitad más
+        antigua del buffer cuando se llena
+        """
+        if self.hub.persist_events:
+            return [event for event in self._events if event[0] > self._persisted_seq]
+        if len(self._events) <= self.hub.max_memory_events:
+            return []
+        return self._events[:len(self._events) - self.hub.max_memory_events // 2]
+
+    def _trim_memory(self):
+        """
+        Quita de memoria la mitad más antigua del buffer si ya está guardada en SQLite
+        """
+        if len(self._events) <= self.hub.max_memory_events:
+            return
+        count = len(self._events) - self.hub.max_memory_events // 2
+        saved = sum(1 for seq, _ in self._events[:count] if seq <= self._persisted_seq)
+        if saved:
+            self._events = self._events[saved:]
+            self._first_memory_seq = self._events[0][0] if self._events else self._last_seq + 1
+
+    def _notify(self):
+        """
+        Despierta a los suscriptores que esperan eventos nuevos
+        """
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _attach(self):
+        """
+        Registra un suscriptor y cancela el corte por inactividad pendiente
+        """
+        self.subscribers += 1
+        if self._idle_handle:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+
+    def _detach(self):
+        """
+        Quita un suscriptor; sin suscriptores, la generación se cancela tras el período de gracia
+        """
+        self.subscribers -= 1
+        if self.subscribers == 0 and not self.done and self.task and self.cancel_when_abandoned:
+            loop = asyncio.get_running_loop()
+            self._idle_handle = loop.call_later(self.hub.resume_grace_seconds, self._cancel_if_abandoned)
+
+    def _cancel_if_abandoned(self):
+        """
+        Cancela la tarea si nadie reconectó durante el período de gracia
+        """
+        self._idle_handle = None
+        if self.subscribers == 0 and not self.done and self.task and self.cancel_when_abandoned:
+            print(f"Generación {self.generation_id} abandonada por el cliente, cancelando")
+            self.abandoned = True
+            self.task.cancel()
+
+
+class GenerationHub:
+    """
+    Registro de generaciones en curso y recientes, indexado por generation_id
+
+    Funciona como single-flight: mientras haya una generación en curso para un
+    documento y tipo, las solicitudes nuevas se unen a ella en lugar de pagar
+    otra llamada idéntica a Gemini.
+    """
+
+    def __init__(
+        self,
+        db_manager: DatabaseManager,
+        max_memory_events: int = 200,
+        resume_grace_seconds: float = 30,
+        retention_seconds: float = 300,
+        persist_events: bool = False,
+        persist_interval_seconds: float = 0.25
+    ):
+        """
+        Inicializa el registro
+
+        Args:
+            db_manager: Gestor de base de datos para vaciar eventos a SQLite
+            max_memory_events: Eventos por generación antes de vaciar a SQLite
+            resume_grace_seconds: Tiempo que se espera una reconexión antes de cancelar
+            retention_seconds: Tiempo que se conserva una generación terminada
+            persist_events: True para guardar todos los eventos en SQLite mientras
+                se publican (el proceso worker, seguido desde el proceso web)
+            persist_interval_seconds: Intervalo entre guardados con persist_events
+        """
+        self.db_manager = db_manager
+        self.max_memory_events = max_memory_events
+        self.resume_grace_seconds = resume_grace_seconds
+        self.retention_seconds = retention_seconds
+        self.persist_events = persist_events
+        self.persist_interval_seconds = persist_interval_seconds
+        self._generations: Dict[str, LiveGeneration] = {}
+        self._in_flight: Dict[Tuple[str, int], LiveGeneration] = {}
+
+        self._purge_stale_events()
+
+    def start(
+        self,
+        kind: str,
+        document_id: int,
+        producer: Callable[[LiveGeneration], Awaitable[None]],
+        cancel_when_abandoned: bool = True
+    ) -> LiveGeneration:
+        """
+        Inicia una generación en segundo plano, o devuelve la que ya está en
+        curso para el mismo documento y tipo
+
+        Args:
+            kind: Tipo de generación ('declaration' o 'cover')
+            document_id: ID del documento
+            producer: Corrutina que publica los eventos en la generación
+            cancel_when_abandoned: False para que termine aunque ningún cliente la siga
+
+        Returns:
+            LiveGeneration: La generación iniciada o la existente
+        """
+        in_flight = self._in_flight.get((kind, document_id))
+        if in_flight and not in_flight.done:
+            if not cancel_when_abandoned:
+                in_flight.cancel_when_abandoned = False
+            metrics.increment("generations_coalesced")
+            print(f"Solicitud duplicada para {kind} del documento {document_id}: se une a la generación {in_flight.generation_id}")
+            return in_flight
+
+        generation = LiveGeneration(self, kind, document_id)
+        generation.cancel_when_abandoned = cancel_when_abandoned
+        self._generations[generation.generation_id] = generation
+        self._in_flight[(kind, document_id)] = generation
+        generation.task = asyncio.create_task(self._run(generation, producer))
+        metrics.set_gauge("live_generations", self._count_running())
+        return generation
+
+    def get(self, generation_id: Optional[str]) -> Optional[LiveGeneration]:
+        """
+        Obtiene una generación en curso o reciente por su ID
+
+        Args:
+            generation_id: ID de la generación
+
+        Returns:
+            LiveGeneration o None si no existe (o ya se olvidó)
+        """
+        return self._generations.get(generation_id) if generation_id else None
+
+    def resume(self, last_event_id: Optional[str], kind: str, document_id: int) -> Optional[Tuple[LiveGeneration, int]]:
+        """
+        Busca la generación indicada por un Last-Event-ID
+
+        Args:
+            last_event_id: Valor del header Last-Event-ID ('<generation_id>:<seq>')
+            kind: Tipo de generación esperado
+            document_id: ID del documento esperado
+
+        Returns:
+            (LiveGeneration, seq) o None si no existe o no corresponde al documento
+        """
+        if not last_event_id or ":" not in last_event_id:
+            return None
+
+        generation_id, _, seq_text = last_event_id.partition(":")
+        generation = self._generations.get(generation_id)
+        if not generation or generation.kind != kind or generation.document_id != document_id:
+            return None
+
+        try:
+            seq = int(seq_text)
+        except ValueError:
+            return None
+
+        metrics.increment("sse_resumed")
+        return generation, max(0, min(seq, generation.last_seq))
+
+    async def sse_events(self, generation: LiveGeneration, after_seq: int = 0) -> AsyncIterator[str]:
+        """
+        Genera los eventos SSE (con id) de una generación para un suscriptor
+
+        Args:
+            generation: Generación a seguir
+            after_seq: Último seq ya recibido por el cliente
+
+        Yields:
+            str: Eventos en formato Server-Sent Events
+        """
+        yield f"retry: {SSE_RETRY_MILLISECONDS}\n\n"
+        async for seq, payload in self.follow(generation, after_seq):
+            yield f"id: {generation.generation_id}:{seq}\ndata: {payload}\n\n"
+
+    async def follow(self, generation: LiveGeneration, after_seq: int = 0) -> AsyncIterator[Tuple[int, str]]:
+        """
+        Recorre los eventos de una generación como suscriptor hasta que termina
+
+        Args:
+            generation: Generación a seguir
+            after_seq: Último seq ya recibido por el cliente
+
+        Yields:
+            Tuple[int, str]: (seq, payload JSON)
+        """
+        generation._attach()
+        try:
+            async for event in generation.events_after(after_seq):
+                yield event
+        finally:
+            generation._detach()
+
+    async def _run(self, generation: LiveGeneration, producer: Callable[[LiveGeneration], Awaitable[None]]):
+        """
+        Ejecuta el productor y cierra la generación pase lo que pase
+        """
+        try:
+            await producer(generation)
+        except asyncio.CancelledError:
+            if generation.abandoned:
+                # Nadie la sigue: no es un error transitorio que valga la pena reintentar
+                generation.publish({"type": "error", "error": "Generación abandonada por el cliente", "status_code": 499})
+            else:
+                generation.publish({"type": "error", "error": "Generación cancelada", "status_code": 503})
+        except Exception as e:
+            print(f"Error inesperado en la generación {generation.generation_id}: {e}")
+            generation.publish({"type": "error", "error": f"Error inesperado: {str(e)}", "status_code": 500})
+        finally:
+            generation.finish()
+            metrics.set_gauge("live_generations", self._count_running())
+            # Quien espera la tarea (el worker de la cola) ve los eventos ya guardados
+            await generation.wait_saved()
+
+    def _count_running(self) -> int:
+        """
+        Cuenta las generaciones que siguen en curso
+        """
+        return sum(1 for generation in self._generations.values() if not generation.done)
+
+    def _release(self, generation: LiveGeneration):
+        """
+        Libera el lugar single-flight de una generación terminada y programa
+        su olvido tras el período de retención
+        """
+        key = (generation.kind, generation.document_id)
+        if self._in_flight.get(key) is generation:
+            del self._in_flight[key]
+
+        loop = asyncio.get_running_loop()
+        loop.call_later(self.retention_seconds, self._forget, generation.generation_id)
+
+    def _forget(self, generation_id: str):
+        """
+        Elimina una generación terminada y sus eventos vaciados a SQLite
+        """
+        generation = self._generations.pop(generation_id, None)
+        if generation and (generation._first_memory_seq > 1 or generation._persisted_seq):
+            db = self.db_manager.get_session()
+            try:
+                GenerationEventRepository(db).delete_events(generation_id)
+            except Exception as e:
+                print(f"Error al eliminar eventos de la generación {generation_id}: {e}")
+            finally:
+                db.close()
+
+    def load_persisted(self, generation_id: str, after_seq: int) -> List[Tuple[int, str]]:
+        """
+        Lee de SQLite los eventos de una generación que corre en otro proceso
+
+        Args:
+            generation_id: ID de la generación
+            after_seq: Último seq ya recibido
+
+        Returns:
+            List[Tuple[int, str]]: Eventos (seq, payload JSON) guardados hasta ahora
+        """
+        return self._load_spilled(generation_id, after_seq, sys.maxsize)
+
+    def _save_spilled(self, generation_id: str, events: List[Tuple[int, str]]) -> bool:
+        """
+        Guarda eventos en SQLite; si falla, se conservan en memoria
+        """
+        db = self.db_manager.get_session()
+        try:
+            GenerationEventRepository(db).save_events(generation_id, events)
+            metrics.increment("sse_events_spilled", len(events))
+            return True
+        except Exception as e:
+            print(f"Error al vaciar eventos de la generación {generation_id}: {e}")
+            return False
+        finally:
+            db.close()
+
+    def _load_spilled(self, generation_id: str, after_seq: int, before_seq: int) -> List[Tuple[int, str]]:
+        """
+        Lee de SQLite los eventos vaciados entre after_seq y before_seq
+        """
+        db = self.db_manager.get_session()
+        try:
+            return GenerationEventRepository(db).get_events(generation_id, after_seq, before_seq)
+        finally:
+            db.close()
+
+    def _purge_stale_events(self):
+        """
+        Elimina eventos de generaciones de ejecuciones anteriores, salvo los de
+        trabajos que siguen en la cola o en curso (el proceso worker puede estar
+        publicando una generación larga mientras el proceso web se reinicia)
+        """
+        db = self.db_manager.get_session()
+        try:
+            cutoff = datetime.utcnow() - timedelta(seconds=self.retention_seconds)
+            GenerationEventRepository(db).delete_events_older_than(cutoff, ACTIVE_JOB_STATUSES)
+        except Exception as e:
+            print(f"Error al limpiar eventos antiguos: {e}")
+        finally:
+            db.close()
+
@@ -0,0 +1,115 @@
+"""
+Solicitudes de respaldo (hedging) para el primer chunk de Gemini
+Algunas llamadas quedan esperando mucho antes del primer token y disparan la
+latencia p99. Si una generación no recibe su primer chunk en el percentil
+configurado del tiempo al primer token, se lanza una segunda solicitud
+idéntica y se usa la que responda primero (la otra se cancela). Un
+presupuesto de solicitudes de respaldo por minuto evita duplicar la carga
+cuando Gemini está lento para todos.
+"""
+
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict
+
+from backend.metrics import metrics
+
+
+# Muestras de tiempo al primer token que se conservan por modelo
+_SAMPLES_PER_MODEL = 200
+
+# Muestras mínimas antes de calcular el percentil (antes se usa default_delay_seconds)
+_MIN_SAMPLES = 20
+
+
+class HedgePolicy:
+    """
+    Cuándo y cuántas solicitudes de respaldo lanzar
+    """
+
+    def __init__(
+        self,
+        percentile: float = 95,
+        min_delay_seconds: float = 3,
+        default_delay_seconds: float = 15,
+        max_per_minute: int = 10
+    ):
+        """
+        Args:
+            percentile: Percentil del tiempo al primer token tras el que se lanza el respaldo
+            min_delay_seconds: Espera mínima antes de lanzar un respaldo
+            default_delay_seconds: Espera mientras no hay suficientes muestras
+            max_per_minute: Solicitudes de respaldo permitidas por minuto (en todo el proceso)
+        """
+        self.percentile = percentile
+        self.min_delay_seconds = min_delay_seconds
+        self.default_delay_seconds = default_delay_seconds
+        self.max_per_minute = max_per_minute
+
+        self._lock = threading.Lock()
+        self._samples: Dict[str, Deque[float]] = {}
+        self._spent: Deque[float] = deque()
+
+    def delay(self, model_name: str) -> float:
+        """
+        Calcula cuánto esperar el primer chunk antes de lanzar el respaldo
+
+        Args:
+            model_name: Modelo de la llamada
+
+        Returns:
+            float: Segundos de espera
+        """
+        with self._lock:
+            samples = sorted(self._samples.get(model_name, ()))
+        if len(samples) < _MIN_SAMPLES:
+            return max(self.min_delay_seconds, self.default_delay_seconds)
+        index = min(len(samples) - 1, int(len(samples) * self.percentile / 100))
+        return max(self.min_delay_seconds, samples[index])
+
+    def record(self, model_name: str, seconds: float):
+        """
+        Guarda una muestra de tiempo al primer token
+
+        Args:
+            model_name: Modelo de la llamada
+            seconds: Segundos hasta el primer chunk
+        """
+        with self._lock:
+            samples = self._samples.setdefault(model_name, deque(maxlen=_SAMPLES_PER_MODEL))
+            samples.append(seconds)
+
+    def try_spend(self) -> bool:
+        """
+        Reserva una solicitud de respaldo del presupuesto del último minuto
+
+        Returns:
+            bool: True si queda presupuesto
+        """
+        with self._lock:
+            now = time.monotonic()
+            while self._spent and now - self._spent[0] >= 60:
+                self._spent.popleft()
+            if len(self._spent) >= self.max_per_minute:
+                metrics.increment("gemini_hedges_over_budget")
+                return False
+            self._spent.append(now)
+            return True
+
+    def stats(self) -> Dict:
+        """
+        Obtiene la espera actual por modelo y el presupuesto usado
+
+        Returns:
+            dict: {'delay_seconds': {...}, 'hedges_last_minute': n, 'max_per_minute': n}
+        """
+        with self._lock:
+            models = list(self._samples)
+            now = time.monotonic()
+            spent = sum(1 for spent_at in self._spent if now - spent_at < 60)
+        return {
+            "delay_seconds": {model: round(self.delay(model), 2) for model in models},
+            "hedges_last_minute": spent,
+            "max_per_minute": self.max_per_minute,
+        }
@@ -0,0 +1,660 @@
+"""
+Cola persistente de trabajos de generación en SQLite
+Las generaciones ya no dependen de la solicitud HTTP que las pidió: cada una es
+un trabajo en la tabla generation_jobs que un worker toma con un lease y
+mantiene con heartbeats. Si el proceso se reinicia, el lease vence y otro worker
+retoma el trabajo; los errores transitorios se reintentan con espera creciente.
+"""
+
+import asyncio
+import json
+import os
+import random
+import socket
+import uuid
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from backend.database import DatabaseManager, DocumentRepository, JobRepository, LogRepository, PipelineRepository
+from backend.metrics import metrics
+from backend.models import GenerationJob, GenerationPipeline
+
+
+# Códigos de error transitorios (Gemini saturado o sin respuesta) que vale la pena reintentar;
+# un 500 es un error de la aplicación o del documento y se repetiría igual
+RETRYABLE_STATUS_CODES = (503, 504)
+
+# Estados de un trabajo que todavía no terminó
+ACTIVE_JOB_STATUSES = ("queued", "running")
+
+# Ejecuta un trabajo y devuelve su evento final ('complete' o 'error')
+JobHandler = Callable[[GenerationJob], Awaitable[Dict]]
+
+
+class JobQueue:
+    """
+    Cola de trabajos de generación compartida por todos los procesos que usan
+    la misma base de datos
+    """
+
+    def __init__(
+        self,
+        db_manager: DatabaseManager,
+        lease_seconds: float = 60,
+        max_attempts: int = 3,
+        retry_base_seconds: float = 10,
+        source_limits: Optional[Dict[str, int]] = None
+    ):
+        """
+        Inicializa la cola
+
+        Args:
+            db_manager: Gestor de base de datos
+            lease_seconds: Tiempo sin heartbeat tras el cual otro worker retoma un trabajo
+            max_attempts: Intentos por trabajo antes de marcarlo como fallido
+            retry_base_seconds: Espera antes del primer reintento (se duplica en cada uno)
+            source_limits: Máximo de trabajos en curso por origen (p. ej. {'batch': 3})
+        """
+        self.db_manager = db_manager
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.source_limits = source_limits or {}
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self._changed = asyncio.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    # ---------- Envío y consulta ----------
+
+    def submit(
+        self,
+        kind: str,
+        document_id: int,
+        use_cache: bool = True,
+        source: str = "interactive",
+        priority: int = 0
+    ) -> GenerationJob:
+        """
+        Encola una generación, o devuelve el trabajo pendiente o en curso del
+        mismo documento y tipo (doble clic, reintento del navegador)
+
+        Args:
+            kind: Tipo de generación ('declaration' o 'cover')
+            document_id: ID del documento
+            use_cache: False para ignorar la caché de generaciones
+            source: Origen del trabajo ('interactive', 'batch' o 'recovery')
+            priority: Prioridad (menor número = se toma antes)
+
+        Returns:
+            GenerationJob: Trabajo encolado o existente
+        """
+        db = self.db_manager.get_session()
+        try:
+            repository = JobRepository(db)
+            job = repository.get_active_job(kind, document_id)
+            if job:
+                db.expunge(job)
+                metrics.increment("jobs_coalesced")
+                return job
+
+            job = repository.create_job(
+                kind,
+                document_id,
+                use_cache=use_cache,
+                source=source,
+                priority=priority,
+                max_attempts=self.max_attempts
+            )
+            db.expunge(job)
+            if kind == "declaration":
+                DocumentRepository(db).update_document_status(document_id, "queued")
+            metrics.increment("jobs_submitted")
+            self._notify()
+            return job
+        finally:
+            db.close()
+
+    def submit_pipeline(
+        self,
+        document_id: int,
+        use_cache: bool = True,
+        source: str = "interactive",
+        priority: int = 0
+    ) -> GenerationPipeline:
+        """
+        Encola la declaration letter de un documento y, en cuanto se complete,
+        su cover letter (lo hace el worker que termina la declaration, sin
+        depender del cliente). Si la declaration ya tenía trabajo activo con su
+        cadena, se devuelve esa cadena
+
+        Args:
+            document_id: ID del documento
+            use_cache: False para ignorar la caché de generaciones (en las dos)
+            source: Origen de los trabajos
+            priority: Prioridad de los trabajos
+
+        Returns:
+            GenerationPipeline: Cadena creada o existente
+        """
+        job = self.submit("declaration", document_id, use_cache=use_cache, source=source, priority=priority)
+        db = self.db_manager.get_session()
+        try:
+            repository = PipelineRepository(db)
+            pipeline = repository.get_by_declaration_job(job.id)
+            if not pipeline:
+                pipeline = repository.create_pipeline(document_id, job.id)
+                metrics.increment("pipelines_submitted")
+            db.expunge(pipeline)
+        finally:
+            db.close()
+
+        # La declaration pudo terminar (caché) antes de que existiera la cadena
+        current = self.get(job.id)
+        if current and current.status not in ACTIVE_JOB_STATUSES:
+            self._advance_pipelines(current)
+        return pipeline
+
+    def get_pipeline(self, pipeline_id: int) -> Optional[GenerationPipeline]:
+        """
+        Obtiene una cadena declaration -> cover letter por su ID
+
+        Args:
+            pipeline_id: ID de la cadena
+
+        Returns:
+            GenerationPipeline o None si no existe
+        """
+        db = self.db_manager.get_session()
+        try:
+            pipeline = PipelineRepository(db).get_pipeline(pipeline_id)
+            if pipeline:
+                db.expunge(pipeline)
+            return pipeline
+        finally:
+            db.close()
+
+    def get_pipeline_for_job(self, job_id: int) -> Optional[GenerationPipeline]:
+        """
+        Obtiene la cadena más reciente en la que participa un trabajo
+
+        Args:
+            job_id: ID del trabajo
+
+        Returns:
+            GenerationPipeline o None si el trabajo no forma parte de ninguna cadena
+        """
+        db = self.db_manager.get_session()
+        try:
+            pipeline = PipelineRepository(db).get_by_job(job_id)
+            if pipeline:
+                db.expunge(pipeline)
+            return pipeline
+        finally:
+            db.close()
+
+    def get(self, job_id: int) -> Optional[GenerationJob]:
+        """
+        Obtiene un trabajo por su ID
+
+        Args:
+            job_id: ID del trabajo
+
+        Returns:
+            GenerationJob o None si no existe
+        """
+        db = self.db_manager.get_session()
+        try:
+            return JobRepository(db).get_job(job_id)
+        finally:
+            db.close()
+
+    def get_by_generation(self, generation_id: str) -> Optional[GenerationJob]:
+        """
+        Obtiene el trabajo que publica en una generación
+
+        Args:
+            generation_id: ID de la generación
+
+        Returns:
+            GenerationJob o None si no existe
+        """
+        db = self.db_manager.get_session()
+        try:
+            return JobRepository(db).get_job_by_generation(generation_id)
+        finally:
+            db.close()
+
+    def position(self, job: GenerationJob) -> Optional[int]:
+        """
+        Calcula la posición de un trabajo pendiente en la cola
+
+        Args:
+            job: Trabajo
+
+        Returns:
+            int: Trabajos por delante, o None si no está pendiente
+        """
+        if job.status != "queued":
+            return None
+        db = self.db_manager.get_session()
+        try:
+            return JobRepository(db).get_queue_position(job)
+        finally:
+            db.close()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Cuenta los trabajos de la cola por estado (de todos los procesos)
+
+        Returns:
+            dict: {estado: número de trabajos}
+        """
+        db = self.db_manager.get_session()
+        try:
+            return JobRepository(db).count_by_status()
+        finally:
+            db.close()
+
+    def will_retry(self, job: GenerationJob, final_event: Dict) -> bool:
+        """
+        Indica si el evento final de un intento hace que el trabajo se reintente
+
+        Args:
+            job: Trabajo (con los intentos ya contados)
+            final_event: Evento 'complete' o 'error' del intento
+
+        Returns:
+            bool: True si el error es transitorio y quedan intentos
+        """
+        return (
+            final_event.get("type") == "error"
+            and final_event.get("status_code", 500) in RETRYABLE_STATUS_CODES
+            and job.attempts < job.max_attempts
+        )
+
+    async def wait_for_change(self, timeout: float):
+        """
+        Espera a que cambie algún trabajo de este proceso, o hasta timeout
+        (los cambios hechos por otros procesos se ven al volver a consultar)
+
+        Args:
+            timeout: Segundos máximos de espera
+        """
+        self._loop = asyncio.get_running_loop()
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def recover(self) -> int:
+        """
+        Vuelve a encolar los documentos que quedaron en 'queued' o 'processing'
+        sin un trabajo activo (p. ej. generaciones de antes de la cola o
+        perdidas en un reinicio). Los trabajos con lease vencido no necesitan
+        recuperación: cualquier worker los retoma.
+
+        Returns:
+            int: Documentos encolados de nuevo
+        """
+        db = self.db_manager.get_session()
+        try:
+            orphaned = [
+                (document.id, document.status)
+                for document in JobRepository(db).get_documents_without_active_job(("queued", "processing"))
+            ]
+            log_repo = LogRepository(db)
+            for document_id, status in orphaned:
+                log_repo.create_log(
+                    document_id,
+                    "process_recovered",
+                    f"Generación interrumpida (estado '{status}'), encolada de nuevo"
+                )
+        finally:
+            db.close()
+
+        for document_id, _ in orphaned:
+            self.submit("declaration", document_id, source="recovery")
+
+        if orphaned:
+            metrics.increment("jobs_recovered", len(orphaned))
+            print(f"Cola de generaciones: {len(orphaned)} documentos huérfanos encolados de nuevo")
+
+        # Cadenas cuya declaration terminó sin que se encolara el cover letter
+        db = self.db_manager.get_session()
+        try:
+            stalled = [pipeline.declaration_job_id for pipeline in PipelineRepository(db).get_stalled_pipelines()]
+        finally:
+            db.close()
+        for job_id in stalled:
+            job = self.get(job_id)
+            if job:
+                self._advance_pipelines(job)
+        return len(orphaned)
+
+    # ---------- Lado del worker ----------
+
+    def claim(self) -> Optional[GenerationJob]:
+        """
+        Toma el próximo trabajo disponible respetando la prioridad y los
+        límites por origen
+
+        Returns:
+            GenerationJob tomado o None si no hay trabajos disponibles
+        """
+        db = self.db_manager.get_session()
+        try:
+            repository = JobRepository(db)
+            while True:
+                now = datetime.utcnow()
+                excluded_sources = []
+                if self.source_limits:
+                    running = repository.count_running_by_source(now)
+                    excluded_sources = [
+                        source for source, limit in self.source_limits.items()
+                        if running.get(source, 0) >= limit
+                    ]
+
+                job = repository.find_claimable(now, excluded_sources)
+                if not job:
+                    return None
+
+                if job.status == "running" and job.attempts >= job.max_attempts:
+                    # El worker se detuvo en el último intento: no se sigue reintentando
+                    self._finish_abandoned(db, job)
+                    continue
+
+                if job.status == "running":
+                    metrics.increment("jobs_lease_expired")
+                    print(f"Trabajo {job.id}: el lease de {job.lease_owner} venció, se retoma")
+
+                if repository.try_claim(job, self.worker_id, self.lease_seconds):
+                    db.expunge(job)
+                    self._notify()
+                    return job
+        finally:
+            db.close()
+
+    def heartbeat(self, job: GenerationJob) -> bool:
+        """
+        Extiende el lease de un trabajo en curso
+
+        Args:
+            job: Trabajo tomado por este worker
+
+        Returns:
+            bool: False si otro worker retomó el trabajo
+        """
+        db = self.db_manager.get_session()
+        try:
+            return JobRepository(db).renew_lease(job.id, self.worker_id, self.lease_seconds)
+        finally:
+            db.close()
+
+    def attach_generation(self, job: GenerationJob, generation_id: str):
+        """
+        Registra la generación del intento actual para que los clientes la sigan
+
+        Args:
+            job: Trabajo tomado por este worker
+            generation_id: ID de la generación
+        """
+        job.generation_id = generation_id
+        db = self.db_manager.get_session()
+        try:
+            JobRepository(db).set_generation(job.id, self.worker_id, generation_id)
+        finally:
+            db.close()
+        self._notify()
+
+    def finish(self, job: GenerationJob, final_event: Dict):
+        """
+        Registra el resultado de un intento: completa el trabajo, lo reintenta
+        más tarde o lo marca como fallido
+
+        Args:
+            job: Trabajo tomado por este worker
+            final_event: Evento 'complete' o 'error' del intento
+        """
+        result = json.dumps(final_event)
+        db = self.db_manager.get_session()
+        try:
+            repository = JobRepository(db)
+            if final_event.get("type") == "complete":
+                repository.finish_job(job.id, self.worker_id, "completed", result)
+                metrics.increment("jobs_completed")
+            elif self.will_retry(job, final_event):
+                delay = self._retry_delay(job.attempts)
+                if repository.requeue_job(job.id, self.worker_id, delay, result):
+                    if job.kind == "declaration":
+                        DocumentRepository(db).update_document_status(job.document_id, "queued")
+                    LogRepository(db).create_log(
+                        job.document_id,
+                        "job_retry",
+                        f"Intento {job.attempts}/{job.max_attempts} fallido ({final_event.get('error')}), "
+                        f"se reintenta en {delay:.0f}s",
+                        success=False
+                    )
+                metrics.increment("jobs_retried")
+                print(f"Trabajo {job.id}: intento {job.attempts} fallido, se reintenta en {delay:.0f}s")
+            else:
+                repository.finish_job(job.id, self.worker_id, "failed", result)
+                metrics.increment("jobs_failed")
+        finally:
+            db.close()
+
+        finished = self.get(job.id)
+        if finished and finished.status not in ACTIVE_JOB_STATUSES:
+            self._advance_pipelines(finished)
+        self._notify()
+
+    def release(self, job: GenerationJob):
+        """
+        Devuelve a la cola un trabajo interrumpido al apagar el worker, sin
+        contar el intento, para que se retome al reiniciar
+
+        Args:
+            job: Trabajo tomado por este worker
+        """
+        db = self.db_manager.get_session()
+        try:
+            if JobRepository(db).requeue_job(job.id, self.worker_id, count_attempt=False):
+                if job.kind == "declaration":
+                    DocumentRepository(db).update_document_status(job.document_id, "queued")
+                print(f"Trabajo {job.id} devuelto a la cola")
+        except Exception as e:
+            print(f"Error al devolver el trabajo {job.id} a la cola: {e}")
+        finally:
+            db.close()
+
+    def _finish_abandoned(self, db, job: GenerationJob):
+        """
+        Marca como fallido un trabajo cuyo último intento quedó sin worker
+        """
+        error_msg = f"El procesamiento se interrumpió {job.attempts} veces sin terminar"
+        result = json.dumps({"type": "error", "error": error_msg, "status_code": 500})
+        if JobRepository(db).finish_job(job.id, job.lease_owner, "failed", result):
+            if job.kind == "declaration":
+                DocumentRepository(db).update_document_status(job.document_id, "error", error_msg)
+            LogRepository(db).create_log(job.document_id, "error", error_msg, success=False)
+            metrics.increment("jobs_failed")
+            print(f"Trabajo {job.id}: {error_msg}")
+            finished = self.get(job.id)
+            if finished:
+                self._advance_pipelines(finished)
+
+    def _advance_pipelines(self, job: GenerationJob):
+        """
+        Avanza las cadenas de un trabajo terminado: una declaration completada
+        encola su cover letter (con el mismo origen y prioridad); un fallo
+        definitivo o el fin del cover letter cierran la cadena
+        """
+        db = self.db_manager.get_session()
+        try:
+            repository = PipelineRepository(db)
+            for pipeline in repository.get_pipelines_for_job(job.id):
+                if pipeline.status == "declaration" and job.id == pipeline.declaration_job_id:
+                    if job.status != "completed":
+                        repository.advance(pipeline.id, "declaration", "failed")
+                        metrics.increment("pipelines_failed")
+                        continue
+                    cover_job = self.submit(
+                        "cover", job.document_id, use_cache=job.use_cache, source=job.source, priority=job.priority
+                    )
+                    if repository.advance(pipeline.id, "declaration", "cover", cover_job_id=cover_job.id):
+                        LogRepository(db).create_log(
+                            job.document_id,
+                            "pipeline_cover_queued",
+                            f"Declaration letter completada: cover letter encolado (trabajo {cover_job.id})"
+                        )
+                        print(f"Cadena {pipeline.id}: declaration completada, cover letter en el trabajo {cover_job.id}")
+                elif pipeline.status == "cover" and job.id == pipeline.cover_job_id:
+                    status = "completed" if job.status == "completed" else "failed"
+                    repository.advance(pipeline.id, "cover", status)
+                    metrics.increment(f"pipelines_{status}")
+        except Exception as e:
+            print(f"Error al avanzar las cadenas del trabajo {job.id}: {e}")
+        finally:
+            db.close()
+
+    def _retry_delay(self, attempts: int) -> float:
+        """
+        Espera exponencial con jitter antes del siguiente intento
+        """
+        delay = self.retry_base_seconds * (2 ** max(0, attempts - 1))
+        return delay + random.uniform(0, self.retry_base_seconds)
+
+    def _notify(self):
+        """
+        Despierta a quienes esperan cambios en la cola (se puede llamar desde
+        los hilos donde corren las consultas a SQLite)
+        """
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if self._loop is not None and running is not self._loop:
+            self._loop.call_soon_threadsafe(self._wake)
+        else:
+            self._wake()
+
+    def _wake(self):
+        """
+        Marca el cambio en el event loop de quienes esperan
+        """
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+
+class JobWorker:
+    """
+    Toma trabajos de la cola y los ejecuta con una concurrencia fija
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        handler: JobHandler,
+        concurrency: int = 2,
+        poll_seconds: float = 1.0
+    ):
+        """
+        Inicializa el worker
+
+        Args:
+            queue: Cola de trabajos
+            handler: Corrutina que ejecuta un trabajo y devuelve su evento final
+            concurrency: Trabajos simultáneos
+            poll_seconds: Intervalo de consulta cuando la cola está vacía
+        """
+        self.queue = queue
+        self.handler = handler
+        self.concurrency = concurrency
+        self.poll_seconds = poll_seconds
+        self._tasks: List[asyncio.Task] = []
+        self._running = 0
+
+    def start(self):
+        """
+        Inicia los lazos de trabajo (se llama con el event loop en marcha)
+        """
+        self._tasks = [asyncio.create_task(self._work_loop(slot)) for slot in range(self.concurrency)]
+        print(f"Worker de generaciones {self.queue.worker_id}: {self.concurrency} trabajos simultáneos")
+
+    async def stop(self):
+        """
+        Detiene los lazos de trabajo; los trabajos en curso vuelven a la cola
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _work_loop(self, slot: int):
+        """
+        Toma y ejecuta trabajos hasta que se detiene el worker
+        """
+        while True:
+            try:
+                job = await asyncio.to_thread(self.queue.claim)
+            except Exception as e:
+                print(f"Error al tomar un trabajo de la cola: {e}")
+                job = None
+
+            if not job:
+                await self.queue.wait_for_change(self.poll_seconds)
+                continue
+
+            await self._run_job(job)
+
+    async def _run_job(self, job: GenerationJob):
+        """
+        Ejecuta un trabajo manteniendo su lease con heartbeats
+        """
+        self._running += 1
+        metrics.set_gauge("jobs_running", self._running)
+        print(f"Trabajo {job.id}: {job.kind} del documento {job.document_id} (intento {job.attempts}/{job.max_attempts})")
+
+        handler_task = asyncio.create_task(self.handler(job))
+        heartbeat_task = asyncio.create_task(self._heartbeat(job, handler_task))
+        try:
+            final_event = await handler_task
+        except asyncio.CancelledError:
+            if handler_task.cancelled() and not heartbeat_task.done():
+                # Se está apagando el worker: el trabajo se retoma al reiniciar
+                await asyncio.shield(asyncio.to_thread(self.queue.release, job))
+                raise
+            if heartbeat_task.done():
+                # Otro worker retomó el trabajo: su resultado es el que cuenta
+                return
+            raise
+        except Exception as e:
+            print(f"Error inesperado en el trabajo {job.id}: {e}")
+            final_event = {"type": "error", "error": f"Error inesperado: {str(e)}", "status_code": 500}
+        finally:
+            heartbeat_task.cancel()
+            self._running -= 1
+            metrics.set_gauge("jobs_running", self._running)
+
+        try:
+            await asyncio.to_thread(self.queue.finish, job, final_event)
+        except Exception as e:
+            print(f"Error al registrar el resultado del trabajo {job.id}: {e}")
+
+    async def _heartbeat(self, job: GenerationJob, handler_task: asyncio.Task):
+        """
+        Renueva el lease mientras el trabajo corre; si otro worker lo retomó,
+        cancela la ejecución local
+        """
+        interval = self.queue.lease_seconds / 3
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if await asyncio.to_thread(self.queue.heartbeat, job):
+                    continue
+            except Exception as e:
+                # Un fallo puntual de SQLite no debe cortar el trabajo
+                print(f"Error al renovar el lease del trabajo {job.id}: {e}")
+                continue
+            print(f"Trabajo {job.id}: el lease pasó a otro worker, se cancela")
+            handler_task.cancel()
+            return
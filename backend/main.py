@@ -7,16 +7,17 @@ import os
 import uuid
 from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import Optional, List, Dict
 from io import BytesIO
 
-from fastapi import FastAPI, File, UploadFile, HTTPException, Depends
+from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, Request, BackgroundTasks
 from fastapi.responses import FileResponse, JSONResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
 import json
 import asyncio
+import functools
 
 # Importaciones locales
 from backend.models import (
@@ -27,12 +28,38 @@ from backend.models import (
     HealthCheckResponse,
     CoverLetterGenerateResponse,
     ChatMessage,
-    ChatResponse
+    ChatResponse,
+    BatchDocumentInfo,
+    BatchUploadResponse,
+    BatchStatusResponse,
+    JobStatusResponse,
+    GenerationJob,
+    GenerationPipeline
 )
-from backend.database import DatabaseManager, DocumentRepository, LogRepository
-from backend.ai_processor import create_ai_processor, AIProcessor
+from backend.database import DatabaseManager, DocumentRepository, LogRepository, BatchRepository
+from backend.ai_processor import create_ai_processor, AIProcessor, StreamCancellation
 from backend.document_converter import convert_md_text_to_docx_binary
 from backend.chat_memory import ChatMemorySystem
+from backend.ai_executor import AIExecutor, AIExecutorSaturated
+from backend.gemini_retry import RetryPolicy, RetryRecord, is_retryable
+from backend.deadline import Deadline, GenerationDeadlineExceeded
+from backend.circuit_breaker import CircuitBreakerRegistry, CircuitOpenError
+from backend.hedging import HedgePolicy
+from backend.gemini_keys import GeminiKeyPool
+from backend.context_cache import ContextCache, GeminiCacheBackend, LocalCacheBackend
+from backend.gemini_scheduler import (
+    GeminiScheduler, GeminiQueueTimeout, ModelLimits, parse_model_limits, PRIORITY_INTERACTIVE, PRIORITY_BATCH
+)
+from backend.metrics import metrics
+from backend.generation_hub import GenerationHub, LiveGeneration, SSE_RETRY_MILLISECONDS
+from backend.job_queue import JobQueue, JobWorker, ACTIVE_JOB_STATUSES
+from backend.generation_cache import GenerationCache
+from backend.text_store import ExtractedTextStore
+from backend.case_facts import CaseFactStore
+from backend.pdf_extractor import PDFTextExtractor
+from backend.process_pool import LazyProcessPool
+from backend.ocr import LocalOCR
+from backend.uploads import save_upload, upload_file_hash, UploadTooLarge, UploadSizeLimitMiddleware, collect_unreferenced_uploads
 
 # Cargar variables de entorno
 from dotenv import load_dotenv
@@ -53,10 +80,102 @@ UPLOAD_FOLDER.mkdir(exist_ok=True)
 MAX_FILE_SIZE_MB = int(os.getenv("MAX_FILE_SIZE_MB", "10"))
 MAX_FILE_SIZE_BYTES = MAX_FILE_SIZE_MB * 1024 * 1024
 
+# Configuración de lotes (varios archivos en una sola solicitud)
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "50"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "3"))
+
+# Configuración de la cola persistente de generaciones
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))  # generaciones simultáneas del worker
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_BASE_SECONDS = float(os.getenv("JOB_RETRY_BASE_SECONDS", "10"))
+# 'embedded': el servidor web ejecuta los trabajos; 'external': solo los encola y
+# los ejecuta start_worker.py (mismo disco y base de datos)
+JOB_WORKER_MODE = os.getenv("JOB_WORKER_MODE", "embedded").lower()
+JOB_EVENTS_POLL_SECONDS = float(os.getenv("JOB_EVENTS_POLL_SECONDS", "0.5"))
+
+# Recolección de archivos subidos que ya no usa ningún documento
+UPLOAD_GC_INTERVAL_HOURS = float(os.getenv("UPLOAD_GC_INTERVAL_HOURS", "6"))
+UPLOAD_GC_GRACE_SECONDS = int(os.getenv("UPLOAD_GC_GRACE_SECONDS", "3600"))
+
 # Configuración de la API de Gemini
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
+# Varias API keys (de proyectos distintos) separadas por comas; por defecto solo GEMINI_API_KEY
+GEMINI_API_KEYS = [
+    key.strip() for key in os.getenv("GEMINI_API_KEYS", GEMINI_API_KEY).split(",")
+    if key.strip() and key.strip() != "tu_api_key_aqui"
+]
+GEMINI_KEY_STRATEGY = os.getenv("GEMINI_KEY_STRATEGY", "least_loaded")  # least_loaded o round_robin
+GEMINI_KEY_COOLDOWN_SECONDS = float(os.getenv("GEMINI_KEY_COOLDOWN_SECONDS", "60"))
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-pro")
-GEMINI_TIMEOUT = int(os.getenv("GEMINI_TIMEOUT", "300"))  # 5 minutos por defecto
+GEMINI_TIMEOUT = int(os.getenv("GEMINI_TIMEOUT", "300"))  # plazo total de cada generación, 5 minutos por defecto
+GEMINI_STALL_TIMEOUT_SECONDS = float(os.getenv("GEMINI_STALL_TIMEOUT_SECONDS", "60"))  # sin chunks = stream cortado
+
+# Límites compartidos de las llamadas a Gemini (por modelo; 0 = sin límite)
+GEMINI_MAX_CONCURRENT = int(os.getenv("GEMINI_MAX_CONCURRENT", "8"))
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "0"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "0"))
+GEMINI_MODEL_LIMITS = os.getenv("GEMINI_MODEL_LIMITS", "")  # JSON con límites propios por modelo
+GEMINI_QUEUE_MAX_WAIT_SECONDS = float(os.getenv("GEMINI_QUEUE_MAX_WAIT_SECONDS", str(GEMINI_TIMEOUT)))
+
+# Reintentos de las llamadas a Gemini ante errores transitorios (429, 500, 503, 504)
+GEMINI_RETRY_MAX_ATTEMPTS = int(os.getenv("GEMINI_RETRY_MAX_ATTEMPTS", "4"))
+GEMINI_RETRY_BASE_SECONDS = float(os.getenv("GEMINI_RETRY_BASE_SECONDS", "2"))
+GEMINI_RETRY_MAX_BACKOFF_SECONDS = float(os.getenv("GEMINI_RETRY_MAX_BACKOFF_SECONDS", "30"))
+
+# Circuit breaker por modelo y modelos de respaldo (separados por comas, en orden de preferencia)
+GEMINI_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("GEMINI_CIRCUIT_FAILURE_THRESHOLD", "5"))
+GEMINI_CIRCUIT_RESET_SECONDS = float(os.getenv("GEMINI_CIRCUIT_RESET_SECONDS", "60"))
+GEMINI_FALLBACK_MODELS = [name.strip() for name in os.getenv("GEMINI_FALLBACK_MODELS", "").split(",") if name.strip()]
+GEMINI_CHAT_FALLBACK_MODELS = [
+    name.strip() for name in os.getenv("GEMINI_CHAT_FALLBACK_MODELS", "").split(",") if name.strip()
+]
+
+# Solicitudes de respaldo cuando el primer chunk tarda más que el percentil habitual
+GEMINI_HEDGE_ENABLED = os.getenv("GEMINI_HEDGE_ENABLED", "false").lower() == "true"
+GEMINI_HEDGE_PERCENTILE = float(os.getenv("GEMINI_HEDGE_PERCENTILE", "95"))
+GEMINI_HEDGE_MIN_DELAY_SECONDS = float(os.getenv("GEMINI_HEDGE_MIN_DELAY_SECONDS", "3"))
+GEMINI_HEDGE_DEFAULT_DELAY_SECONDS = float(os.getenv("GEMINI_HEDGE_DEFAULT_DELAY_SECONDS", "15"))
+GEMINI_HEDGE_MAX_PER_MINUTE = int(os.getenv("GEMINI_HEDGE_MAX_PER_MINUTE", "10"))
+
+# Continuaciones automáticas cuando una respuesta se corta por max_output_tokens (0 = ninguna)
+GEMINI_MAX_CONTINUATIONS = int(os.getenv("GEMINI_MAX_CONTINUATIONS", "3"))
+
+# Caché de contexto del prefijo estable de los prompts: off, gemini (caché explícita) o local (sustituto para pruebas)
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "off").lower()
+GEMINI_CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL_SECONDS", "3600"))
+GEMINI_CONTEXT_CACHE_REFRESH_SECONDS = int(os.getenv("GEMINI_CONTEXT_CACHE_REFRESH_SECONDS", "300"))
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "1024"))
+
+# Cover Letter por secciones en paralelo (encabezado y secciones I-VI a la vez)
+COVER_LETTER_PARALLEL_SECTIONS = os.getenv("COVER_LETTER_PARALLEL_SECTIONS", "false").lower() == "true"
+COVER_LETTER_SECTION_WORKERS = int(os.getenv("COVER_LETTER_SECTION_WORKERS", "28"))
+
+# Extracción previa de los hechos del caso (la declaración y el chat usan el JSON en lugar del cuestionario)
+CASE_FACTS_ENABLED = os.getenv("CASE_FACTS_ENABLED", "false").lower() == "true"
+
+# Configuración del ejecutor de IA (generaciones simultáneas y cola de espera)
+AI_MAX_WORKERS = int(os.getenv("AI_MAX_WORKERS", "4"))
+AI_MAX_QUEUE = int(os.getenv("AI_MAX_QUEUE", "32"))
+AI_STREAM_MAX_WORKERS = int(os.getenv("AI_STREAM_MAX_WORKERS", "64"))
+
+# Configuración de reanudación de streams SSE (Last-Event-ID)
+SSE_BUFFER_MAX_EVENTS = int(os.getenv("SSE_BUFFER_MAX_EVENTS", "200"))
+SSE_RESUME_GRACE_SECONDS = int(os.getenv("SSE_RESUME_GRACE_SECONDS", "30"))
+
+# Configuración de la caché de generaciones (resultados idénticos sin llamar a Gemini)
+GENERATION_CACHE_ENABLED = os.getenv("GENERATION_CACHE_ENABLED", "true").lower() == "true"
+GENERATION_CACHE_TTL_HOURS = float(os.getenv("GENERATION_CACHE_TTL_HOURS", "168"))  # 7 días por defecto
+GENERATION_CACHE_MAX_MB = int(os.getenv("GENERATION_CACHE_MAX_MB", "50"))
+
+# Configuración de la extracción de texto de PDF (páginas en paralelo)
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", "0")) or None  # 0 = número de núcleos
+PDF_PAGE_TIMEOUT_SECONDS = float(os.getenv("PDF_PAGE_TIMEOUT_SECONDS", "30"))
+
+# Configuración del OCR local (Tesseract) para cuestionarios escaneados
+OCR_ENABLED = os.getenv("OCR_ENABLED", "true").lower() == "true"
+OCR_LANGUAGES = os.getenv("OCR_LANGUAGES", "spa+eng")
+OCR_IMAGE_TIMEOUT_SECONDS = float(os.getenv("OCR_IMAGE_TIMEOUT_SECONDS", "60"))
 
 # Configuración de mem0 para chat
 MEM0_API_KEY = os.getenv("MEM0_API_KEY", "")
@@ -80,16 +199,128 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Cortar las subidas demasiado grandes mientras se reciben
+UPLOAD_TOO_LARGE_MESSAGE = f"El archivo excede el tamaño máximo de {MAX_FILE_SIZE_MB}MB"
+app.add_middleware(
+    UploadSizeLimitMiddleware,
+    limits={
+        "/api/upload": (MAX_FILE_SIZE_BYTES, UPLOAD_TOO_LARGE_MESSAGE),
+        "/api/batch": (
+            MAX_FILE_SIZE_BYTES * BATCH_MAX_FILES,
+            f"El lote excede el tamaño máximo de {BATCH_MAX_FILES} archivos de {MAX_FILE_SIZE_MB}MB"
+        ),
+    }
+)
+
 # Inicializar base de datos
 db_manager = DatabaseManager(os.getenv("DATABASE_URL", "sqlite:///./declaration_letters.db"))
 db_manager.create_tables()
 
+# Pool de procesos para la extracción de texto (páginas de PDF y OCR), se crea bajo demanda
+extraction_pool = LazyProcessPool(max_workers=PDF_EXTRACT_WORKERS)
+
+# OCR local para páginas escaneadas e imágenes
+ocr_engine: Optional[LocalOCR] = None
+
+if OCR_ENABLED:
+    ocr_engine = LocalOCR(
+        db_manager,
+        extraction_pool,
+        languages=OCR_LANGUAGES,
+        image_timeout_seconds=OCR_IMAGE_TIMEOUT_SECONDS
+    )
+
+# Extractor de PDF por páginas en paralelo
+pdf_extractor = PDFTextExtractor(
+    extraction_pool,
+    page_timeout_seconds=PDF_PAGE_TIMEOUT_SECONDS,
+    ocr=ocr_engine
+)
+
+# Planificador compartido de las llamadas a Gemini: el chat pasa antes que las
+# generaciones y los lotes, y los turnos se reparten entre documentos y usuarios
+gemini_default_limits = ModelLimits(max_concurrent=GEMINI_MAX_CONCURRENT, rpm=GEMINI_RPM, tpm=GEMINI_TPM)
+gemini_scheduler = GeminiScheduler(
+    gemini_default_limits,
+    model_limits=parse_model_limits(GEMINI_MODEL_LIMITS, gemini_default_limits),
+    max_wait_seconds=GEMINI_QUEUE_MAX_WAIT_SECONDS
+)
+
+# Reintentos de las llamadas a Gemini, dentro del timeout total de cada llamada
+gemini_retry_policy = RetryPolicy(
+    max_attempts=GEMINI_RETRY_MAX_ATTEMPTS,
+    base_seconds=GEMINI_RETRY_BASE_SECONDS,
+    max_backoff_seconds=GEMINI_RETRY_MAX_BACKOFF_SECONDS,
+    deadline_seconds=GEMINI_TIMEOUT
+)
+
+# Circuitos de los modelos de Gemini, compartidos por las generaciones y el chat
+gemini_breakers = CircuitBreakerRegistry(
+    failure_threshold=GEMINI_CIRCUIT_FAILURE_THRESHOLD,
+    reset_seconds=GEMINI_CIRCUIT_RESET_SECONDS
+)
+
+# Solicitudes de respaldo para el primer chunk (desactivadas por defecto)
+gemini_hedging: Optional[HedgePolicy] = None
+
+if GEMINI_HEDGE_ENABLED:
+    gemini_hedging = HedgePolicy(
+        percentile=GEMINI_HEDGE_PERCENTILE,
+        min_delay_seconds=GEMINI_HEDGE_MIN_DELAY_SECONDS,
+        default_delay_seconds=GEMINI_HEDGE_DEFAULT_DELAY_SECONDS,
+        max_per_minute=GEMINI_HEDGE_MAX_PER_MINUTE
+    )
+
+# Caché de contexto para el prefijo estable de los prompts (desactivada por defecto)
+gemini_context_cache: Optional[ContextCache] = None
+
+if GEMINI_CONTEXT_CACHE in ("gemini", "local"):
+    gemini_context_cache = ContextCache(
+        GeminiCacheBackend() if GEMINI_CONTEXT_CACHE == "gemini" else LocalCacheBackend(),
+        ttl_seconds=GEMINI_CONTEXT_CACHE_TTL_SECONDS,
+        refresh_margin_seconds=GEMINI_CONTEXT_CACHE_REFRESH_SECONDS,
+        min_prefix_tokens=GEMINI_CONTEXT_CACHE_MIN_TOKENS
+    )
+elif GEMINI_CONTEXT_CACHE != "off":
+    print(f"Advertencia: GEMINI_CONTEXT_CACHE desconocido ({GEMINI_CONTEXT_CACHE}), se usa 'off'")
+
+# Pool de API keys de Gemini, compartido por las generaciones y el chat
+gemini_keys: Optional[GeminiKeyPool] = None
+
+if GEMINI_API_KEYS:
+    try:
+        gemini_keys = GeminiKeyPool(
+            GEMINI_API_KEYS,
+            strategy=GEMINI_KEY_STRATEGY,
+            cooldown_seconds=GEMINI_KEY_COOLDOWN_SECONDS
+        )
+        print(f"Pool de API keys de Gemini: {len(gemini_keys)} keys ({GEMINI_KEY_STRATEGY})")
+    except ValueError as e:
+        print(f"Error en la configuración de API keys de Gemini: {e}")
+
 # Inicializar procesador de IA
 ai_processor: Optional[AIProcessor] = None
 
-if GEMINI_API_KEY and GEMINI_API_KEY != "tu_api_key_aqui":
-    ai_processor = create_ai_processor(GEMINI_API_KEY, GEMINI_MODEL, GEMINI_TIMEOUT)
+if gemini_keys:
+    ai_processor = create_ai_processor(GEMINI_API_KEYS[0], GEMINI_MODEL, GEMINI_TIMEOUT)
     if ai_processor:
+        ai_processor.keys = gemini_keys
+        ai_processor.pdf_extractor = pdf_extractor
+        ai_processor.ocr = ocr_engine
+        ai_processor.scheduler = gemini_scheduler
+        ai_processor.retry_policy = gemini_retry_policy
+        ai_processor.stall_timeout = GEMINI_STALL_TIMEOUT_SECONDS
+        ai_processor.breakers = gemini_breakers
+        ai_processor.fallback_models = GEMINI_FALLBACK_MODELS
+        ai_processor.hedging = gemini_hedging
+        ai_processor.context_cache = gemini_context_cache
+        ai_processor.max_continuations = GEMINI_MAX_CONTINUATIONS
+        ai_processor.cover_letter_parallel_sections = COVER_LETTER_PARALLEL_SECTIONS
+        if COVER_LETTER_PARALLEL_SECTIONS:
+            ai_processor.section_executor = AIExecutor(
+                max_workers=COVER_LETTER_SECTION_WORKERS, max_queue=AI_MAX_QUEUE, name="cover_sections"
+            )
+        ai_processor.case_facts_enabled = CASE_FACTS_ENABLED
         print("Procesador de IA inicializado correctamente")
         print(f"Timeout configurado: {GEMINI_TIMEOUT} segundos")
     else:
@@ -100,18 +331,66 @@ else:
 # Inicializar sistema de chat con memoria
 chat_system: Optional[ChatMemorySystem] = None
 
-if GEMINI_API_KEY and MEM0_API_KEY:
+if gemini_keys and MEM0_API_KEY:
     try:
         chat_system = ChatMemorySystem(
             mem0_api_key=MEM0_API_KEY,
-            google_api_key=GEMINI_API_KEY
+            google_api_key=GEMINI_API_KEYS[0]
         )
+        chat_system.keys = gemini_keys
+        chat_system.scheduler = gemini_scheduler
+        chat_system.retry_policy = gemini_retry_policy
+        chat_system.request_timeout = GEMINI_TIMEOUT
+        chat_system.breakers = gemini_breakers
+        chat_system.fallback_models = GEMINI_CHAT_FALLBACK_MODELS
+        chat_system.max_continuations = GEMINI_MAX_CONTINUATIONS
         print("Sistema de chat con memoria inicializado correctamente")
     except Exception as e:
         print(f"Error al inicializar sistema de chat: {e}")
 else:
     print("Advertencia: API keys no configuradas para el sistema de chat")
 
+# Inicializar ejecutor acotado para las llamadas bloqueantes a Gemini
+ai_executor = AIExecutor(max_workers=AI_MAX_WORKERS, max_queue=AI_MAX_QUEUE)
+
+# Ejecutor para los streams SSE: cada stream ocupa un hilo mientras espera chunks de Gemini
+ai_stream_executor = AIExecutor(max_workers=AI_STREAM_MAX_WORKERS, max_queue=AI_MAX_QUEUE, name="ai_stream")
+
+# Registro de generaciones SSE en curso (reanudables con Last-Event-ID)
+generation_hub = GenerationHub(
+    db_manager,
+    max_memory_events=SSE_BUFFER_MAX_EVENTS,
+    resume_grace_seconds=SSE_RESUME_GRACE_SECONDS
+)
+
+# Texto extraído de los cuestionarios (una extracción por contenido de archivo)
+extracted_text_store = ExtractedTextStore(db_manager)
+
+# Hechos del caso extraídos de cada cuestionario (una extracción por documento y cuestionario)
+case_facts_store = CaseFactStore(db_manager)
+
+# Cola persistente de generaciones; los lotes ocupan como máximo BATCH_MAX_CONCURRENCY workers
+job_queue = JobQueue(
+    db_manager,
+    lease_seconds=JOB_LEASE_SECONDS,
+    max_attempts=JOB_MAX_ATTEMPTS,
+    retry_base_seconds=JOB_RETRY_BASE_SECONDS,
+    source_limits={"batch": BATCH_MAX_CONCURRENCY}
+)
+
+# Worker que ejecuta los trabajos de la cola (se inicia con el servidor)
+job_worker: Optional[JobWorker] = None
+
+# Caché de generaciones por hash del contenido de entrada
+generation_cache: Optional[GenerationCache] = None
+
+if GENERATION_CACHE_ENABLED:
+    generation_cache = GenerationCache(
+        db_manager,
+        ttl_hours=GENERATION_CACHE_TTL_HOURS,
+        max_bytes=GENERATION_CACHE_MAX_MB * 1024 * 1024
+    )
+
 
 # Montar archivos estáticos
 app.mount("/frontend", StaticFiles(directory=str(FRONTEND_FOLDER)), name="frontend")
@@ -138,6 +417,191 @@ def get_ai_processor():
     return ai_processor
 
 
+async def collect_uploads_periodically():
+    """
+    Elimina periódicamente los archivos subidos sin documentos que los usen
+    """
+    while True:
+        try:
+            await asyncio.to_thread(
+                collect_unreferenced_uploads, UPLOAD_FOLDER, db_manager, UPLOAD_GC_GRACE_SECONDS
+            )
+        except Exception as e:
+            print(f"Error en la recolección de subidas: {e}")
+        await asyncio.sleep(UPLOAD_GC_INTERVAL_HOURS * 3600)
+
+
+@app.on_event("startup")
+async def start_background_tasks():
+    """Inicia las tareas periódicas de mantenimiento y el worker de la cola de generaciones"""
+    global job_worker
+    if UPLOAD_GC_INTERVAL_HOURS > 0:
+        app.state.upload_gc_task = asyncio.create_task(collect_uploads_periodically())
+    
+    if ai_processor and JOB_WORKER_MODE != "external":
+        # Documentos que quedaron a medias en una ejecución anterior
+        job_queue.recover()
+        job_worker = JobWorker(job_queue, run_generation_job, concurrency=JOB_WORKERS)
+        job_worker.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_executors():
+    """Detiene el worker de generaciones, los ejecutores de IA y el pool de extracción al apagar el servidor"""
+    if job_worker:
+        # Los trabajos en curso vuelven a la cola y se retoman al reiniciar
+        await job_worker.stop()
+    ai_executor.shutdown()
+    ai_stream_executor.shutdown()
+    extraction_pool.shutdown()
+
+
+# Mensaje para el usuario cuando el ejecutor de IA está saturado
+AI_BUSY_MESSAGE = "El servicio de IA está atendiendo demasiadas solicitudes. Por favor, intente nuevamente en unos momentos."
+
+
+def extract_uploaded_text(file_path: str, file_hash: Optional[str] = None):
+    """
+    Extrae y guarda el texto de un archivo recién subido
+    (tarea en segundo plano para que procesar no tenga que esperar la extracción)
+    
+    Args:
+        file_path: Ruta al archivo subido
+        file_hash: SHA-256 calculado al recibir el archivo
+    """
+    if not ai_processor:
+        return
+    try:
+        extracted_text_store.get_or_extract(file_path, ai_processor.extract_text_from_file, file_hash)
+    except Exception as e:
+        print(f"Error al extraer texto en segundo plano: {e}")
+
+
+def ai_error_status_code(ai_error: Exception) -> int:
+    """
+    Determina el código HTTP para un error de la API de IA
+    
+    Args:
+        ai_error: Excepción lanzada por el procesador de IA
+    
+    Returns:
+        int: 504 si fue un timeout, 503 si fue otro error transitorio, 500 en otro caso
+    """
+    error_text = str(ai_error).lower()
+    if "timeout" in error_text or "timed out" in error_text:
+        return 504
+    if is_retryable(ai_error.__cause__):
+        return 503
+    return 500
+
+
+def record_ai_attempts(log_repo: LogRepository, document_id: int, retry_record: RetryRecord, success: bool):
+    """
+    Registra en el historial del documento los reintentos de una llamada a Gemini
+    
+    Args:
+        log_repo: Repositorio de logs
+        document_id: ID del documento
+        retry_record: Intentos de la llamada
+        success: Si la llamada terminó bien
+    """
+    if retry_record.retries:
+        log_repo.create_log(document_id, "ai_retry", retry_record.summary(), success=success)
+
+
+async def load_case_facts(
+    ai: AIProcessor,
+    document_id: int,
+    questionnaire_text: str,
+    priority: int,
+    deadline: Deadline,
+    log_repo: LogRepository
+) -> Optional[Dict]:
+    """
+    Obtiene los hechos del caso del documento, extrayéndolos si el cuestionario
+    o el prompt de extracción cambiaron (primera etapa de la generación)
+    
+    Args:
+        ai: Procesador de IA
+        document_id: ID del documento
+        questionnaire_text: Texto del cuestionario
+        priority: Prioridad de la llamada a Gemini
+        deadline: Plazo de la generación (la extracción consume parte de él)
+        log_repo: Repositorio de logs
+    
+    Returns:
+        dict: Hechos del caso, o None si la extracción falló (se usa el cuestionario completo)
+    """
+    retry_record = RetryRecord()
+    extractor = functools.partial(
+        ai.extract_case_facts,
+        priority=priority,
+        fairness_key=f"document:{document_id}",
+        retry_record=retry_record,
+        deadline=deadline
+    )
+    try:
+        return await ai_executor.run(
+            case_facts_store.get_or_extract,
+            document_id,
+            questionnaire_text,
+            ai.generation_fingerprint("facts"),
+            extractor
+        )
+    except Exception as e:
+        record_ai_attempts(log_repo, document_id, retry_record, success=False)
+        metrics.increment("case_facts_errors")
+        log_repo.create_log(
+            document_id, "case_facts_error",
+            f"No se pudieron extraer los hechos del caso, se usa el cuestionario completo: {e}",
+            success=False
+        )
+        return None
+
+
+def record_cancelled_generation(db: Session, kind: str, document_id: int, generated_chars: int, abandoned: bool):
+    """
+    Registra una generación cancelada
+    
+    Si el cliente la abandonó, el trabajo termina y la declaration queda
+    'cancelled' (una regeneración conserva el contenido anterior). Si se detuvo
+    el worker o perdió el lease, el trabajo sigue en la cola: la declaration
+    queda 'queued' hasta que se retome.
+    
+    Args:
+        db: Sesión de base de datos
+        kind: Tipo de generación ('declaration' o 'cover')
+        document_id: ID del documento
+        generated_chars: Caracteres generados antes de cancelar
+        abandoned: True si se canceló porque ningún cliente la seguía
+    """
+    prefix = "process" if kind == "declaration" else "cover_letter"
+    if abandoned:
+        metrics.increment("generations_cancelled")
+        action = f"{prefix}_cancelled"
+        details = f"Generación abandonada por el cliente tras generar {generated_chars} caracteres"
+    else:
+        metrics.increment("generations_interrupted")
+        action = f"{prefix}_interrupted"
+        details = f"Generación interrumpida tras generar {generated_chars} caracteres, el trabajo vuelve a la cola"
+    try:
+        LogRepository(db).create_log(document_id, action, details, success=False)
+        
+        if kind == "declaration":
+            doc_repo = DocumentRepository(db)
+            document = doc_repo.get_document(document_id)
+            if document:
+                if not abandoned:
+                    status = "queued"
+                elif document.markdown_content:
+                    status = "completed"
+                else:
+                    status = "cancelled"
+                doc_repo.update_document_status(document_id, status)
+    except Exception as e:
+        print(f"Error al registrar la cancelación del documento {document_id}: {e}")
+
+
 # ==================== RUTAS ====================
 
 @app.get("/")
@@ -162,15 +626,38 @@ async def health_check(db: Session = Depends(get_db)):
     )
 
 
+@app.get("/api/metrics")
+async def get_metrics():
+    """
+    Obtiene las métricas internas del servidor (colas, contadores)
+    """
+    return JSONResponse(content={
+        "ai_executor": ai_executor.stats(),
+        "ai_stream_executor": ai_stream_executor.stats(),
+        "job_queue": job_queue.stats(),
+        "gemini_scheduler": gemini_scheduler.stats(),
+        "gemini_circuits": gemini_breakers.stats(),
+        "gemini_hedging": gemini_hedging.stats() if gemini_hedging else None,
+        "gemini_keys": gemini_keys.stats() if gemini_keys else None,
+        "gemini_context_cache": gemini_context_cache.stats() if gemini_context_cache else None,
+        **metrics.snapshot()
+    })
+
+
 @app.post("/api/upload", response_model=DocumentUploadResponse)
 async def upload_document(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     db: Session = Depends(get_db)
 ):
     """
     Sube un archivo de cuestionario
     
+    El texto se extrae en segundo plano después de responder, para que al
+    procesar (o regenerar) ya esté disponible.
+    
     Args:
+        background_tasks: Tareas a ejecutar después de responder
         file: Archivo a subir
         db: Sesión de base de datos
     
@@ -178,25 +665,14 @@ async def upload_document(
         DocumentUploadResponse con información del documento subido
     """
     try:
-        # Validar tamaño del archivo
-        file_content = await file.read()
-        file_size = len(file_content)
-        
-        if file_size > MAX_FILE_SIZE_BYTES:
-            raise HTTPException(
-                status_code=400,
-                detail=f"El archivo excede el tamaño máximo de {MAX_FILE_SIZE_MB}MB"
-            )
+        # Guardar el archivo por bloques validando el tamaño mientras se copia
+        try:
+            unique_filename, file_size, file_hash = await save_upload(file, UPLOAD_FOLDER, MAX_FILE_SIZE_BYTES)
+        except UploadTooLarge:
+            raise HTTPException(status_code=400, detail=UPLOAD_TOO_LARGE_MESSAGE)
         
-        # Generar nombre único para el archivo
-        file_extension = Path(file.filename).suffix
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
         file_path = UPLOAD_FOLDER / unique_filename
         
-        # Guardar archivo
-        with open(file_path, 'wb') as f:
-            f.write(file_content)
-        
         # Crear registro en base de datos
         doc_repo = DocumentRepository(db)
         document = doc_repo.create_document(
@@ -208,12 +684,18 @@ async def upload_document(
         
         # Crear log
         log_repo = LogRepository(db)
+        references = doc_repo.count_documents_by_filename(unique_filename)
+        details = f"Archivo subido: {file.filename}"
+        if references > 1:
+            details += f" (contenido idéntico a {references - 1} documento(s) anterior(es), archivo compartido)"
         log_repo.create_log(
             document_id=document.id,
             action="upload",
-            details=f"Archivo subido: {file.filename}"
+            details=details
         )
         
+        background_tasks.add_task(extract_uploaded_text, str(file_path), file_hash)
+        
         return DocumentUploadResponse(
             success=True,
             message="Archivo subido exitosamente",
@@ -231,20 +713,115 @@ async def upload_document(
 async def process_document(
     document_id: int,
     db: Session = Depends(get_db),
-    ai: AIProcessor = Depends(get_ai_processor)
+    ai: AIProcessor = Depends(get_ai_processor),
+    regenerate: bool = False,
+    wait: bool = True,
+    pipeline: bool = False
 ):
     """
-    Procesa un documento y genera la declaration letter
+    Encola la generación de la declaration letter de un documento
+    
+    La generación corre en la cola persistente: si el cliente se desconecta o
+    el servidor se reinicia, el trabajo continúa. Si ya hay un trabajo pendiente
+    o en curso para el documento (doble clic, reintento del navegador o un
+    stream abierto), se usa ese en lugar de iniciar otra llamada a Gemini. Si el
+    mismo cuestionario ya se procesó, se devuelve el resultado guardado en la
+    caché salvo que se pida regenerar.
     
     Args:
         document_id: ID del documento a procesar
         db: Sesión de base de datos
         ai: Procesador de IA
+        regenerate: True para ignorar la caché y generar de nuevo
+        wait: False para responder 202 con el trabajo sin esperar el resultado
+            (se consulta en /api/jobs/{job_id} o se sigue con /api/jobs/{job_id}/stream)
+        pipeline: True para que al completarse la declaration letter el servidor
+            encole su cover letter (se sigue todo con /api/pipelines/{pipeline_id}/stream)
     
     Returns:
-        DocumentProcessResponse con el documento generado
+        DocumentProcessResponse con el documento generado, o JobStatusResponse (202)
     """
     doc_repo = DocumentRepository(db)
+    
+    if not doc_repo.get_document(document_id):
+        raise HTTPException(status_code=404, detail="Documento no encontrado")
+    
+    chain = None
+    if pipeline:
+        chain = await asyncio.to_thread(job_queue.submit_pipeline, document_id, use_cache=not regenerate)
+        job = await asyncio.to_thread(job_queue.get, chain.declaration_job_id)
+    else:
+        job = await asyncio.to_thread(job_queue.submit, "declaration", document_id, use_cache=not regenerate)
+    if not wait:
+        status = await asyncio.to_thread(build_job_status, job, chain)
+        return JSONResponse(status_code=202, content=status.model_dump())
+    
+    job = await wait_for_job(job.id)
+    final_event = json.loads(job.result) if job.result else {}
+    
+    if job.status != 'completed':
+        status_code = final_event.get('status_code', 500)
+        if status_code == 504:
+            detail = f"La generación del Declaration Letter excedió el tiempo límite de {GEMINI_TIMEOUT} segundos. El documento es muy extenso o el servidor está muy ocupado. Por favor, intente nuevamente en unos momentos."
+        else:
+            detail = final_event.get('error', "Error al procesar documento. Por favor, intente nuevamente.")
+        raise HTTPException(status_code=status_code, detail=detail)
+    
+    # El documento se actualizó en otra sesión mientras se esperaba
+    db.expire_all()
+    document = doc_repo.get_document(document_id)
+    
+    return DocumentProcessResponse(
+        success=True,
+        message="Declaration letter generada exitosamente",
+        document_id=document_id,
+        markdown_content=document.markdown_content,
+        generated_filename=final_event.get('filename'),
+        download_url=f"/api/download/{document_id}"
+    )
+
+
+@app.post("/api/regenerate", response_model=DocumentProcessResponse)
+async def regenerate_document(
+    request: RegenerateRequest,
+    db: Session = Depends(get_db),
+    ai: AIProcessor = Depends(get_ai_processor)
+):
+    """
+    Regenera una declaration letter existente
+    
+    Args:
+        request: Solicitud con el ID del documento
+        db: Sesión de base de datos
+        ai: Procesador de IA
+    
+    Returns:
+        DocumentProcessResponse con el nuevo documento generado
+    """
+    # Llama a process_document ignorando la caché de generaciones
+    return await process_document(request.document_id, db, ai, regenerate=True)
+
+
+async def run_declaration_generation(
+    generation: LiveGeneration,
+    ai: AIProcessor,
+    use_cache: bool = True,
+    priority: int = PRIORITY_INTERACTIVE
+):
+    """
+    Genera la declaration letter publicando los eventos en la generación
+    (corre en segundo plano, independiente de la conexión SSE)
+    
+    Args:
+        generation: Generación en la que se publican los eventos
+        ai: Procesador de IA
+        use_cache: False para ignorar un resultado guardado en la caché
+        priority: Prioridad de la llamada a Gemini (los lotes esperan a las interactivas)
+    """
+    document_id = generation.document_id
+    deadline = Deadline(GEMINI_TIMEOUT)
+    db = db_manager.get_session()
+    doc_repo = DocumentRepository(db)
     log_repo = LogRepository(db)
     
     try:
@@ -252,7 +829,8 @@ async def process_document(
         document = doc_repo.get_document(document_id)
         
         if not document:
-            raise HTTPException(status_code=404, detail="Documento no encontrado")
+            generation.publish({'type': 'error', 'error': 'Documento no encontrado', 'status_code': 404})
+            return
         
         # Actualizar estado a procesando
         doc_repo.update_document_status(document_id, "processing")
@@ -261,7 +839,7 @@ async def process_document(
         log_repo.create_log(
             document_id=document_id,
             action="process_start",
-            details="Iniciando procesamiento del documento"
+            details="Iniciando procesamiento del documento (streaming)"
         )
         
         # Extraer texto del archivo
@@ -271,44 +849,114 @@ async def process_document(
             error_msg = "Archivo fuente no encontrado"
             doc_repo.update_document_status(document_id, "error", error_msg)
             log_repo.create_log(document_id, "error", error_msg)
-            raise HTTPException(status_code=404, detail=error_msg)
+            generation.publish({'type': 'error', 'error': error_msg, 'status_code': 404})
+            return
         
-        questionnaire_text = ai.extract_text_from_file(str(file_path))
+        # Texto guardado al subir el archivo (se extrae de nuevo solo si el archivo cambió);
+        # la extracción consume el mismo plazo que la generación
+        deadline.enter("la extracción del texto")
+        try:
+            questionnaire_text = await asyncio.wait_for(
+                asyncio.to_thread(
+                    extracted_text_store.get_or_extract,
+                    str(file_path),
+                    ai.extract_text_from_file,
+                    upload_file_hash(file_path)
+                ),
+                timeout=deadline.remaining()
+            )
+        except asyncio.TimeoutError:
+            timeout_error = deadline.exceeded()
+            error_msg = f"Tiempo límite excedido: {timeout_error}"
+            doc_repo.update_document_status(document_id, "error", error_msg)
+            log_repo.create_log(document_id, "process_timeout", error_msg, success=False)
+            generation.publish({'type': 'error', 'error': error_msg, 'status_code': 504})
+            return
         
         if not questionnaire_text or len(questionnaire_text.strip()) == 0:
             error_msg = "No se pudo extraer texto del archivo o el archivo está vacío"
             doc_repo.update_document_status(document_id, "error", error_msg)
             log_repo.create_log(document_id, "error", error_msg)
-            raise HTTPException(status_code=400, detail=error_msg)
+            generation.publish({'type': 'error', 'error': error_msg, 'status_code': 400})
+            return
+        
+        # Buscar un resultado ya generado para el mismo cuestionario, prompts y modelo
+        cache_key = None
+        if generation_cache:
+            cache_key = generation_cache.build_key(
+                "declaration", questionnaire_text, ai.generation_fingerprint("declaration")
+            )
+            cached_content = generation_cache.get(cache_key) if use_cache else None
+            if cached_content:
+                generated_filename = f"declaration_letter_{document_id}_{uuid.uuid4().hex[:8]}.docx"
+                doc_repo.update_document_content(document_id, cached_content, generated_filename)
+                log_repo.create_log(
+                    document_id=document_id,
+                    action="process_complete",
+                    details=f"Documento obtenido de la caché: {generated_filename}"
+                )
+                generation.publish({'type': 'content', 'chunk': cached_content})
+                generation.publish({'type': 'complete', 'filename': generated_filename, 'cached': True})
+                return
+        
+        # Primera etapa: hechos del caso (guardados por documento, se reutilizan al regenerar)
+        case_facts = None
+        if ai.case_facts_enabled:
+            case_facts = await load_case_facts(ai, document_id, questionnaire_text, priority, deadline, log_repo)
         
-        # Generar declaration letter
+        # Generar declaration letter con streaming
+        full_content = ""
+        cancellation = StreamCancellation()
+        retry_record = RetryRecord()
         try:
-            markdown_content = ai.generate_declaration_letter(questionnaire_text)
+            # El iterador síncrono de Gemini se consume en un hilo del pool
+            async for chunk in ai_stream_executor.stream(
+                ai.generate_declaration_letter_stream,
+                questionnaire_text,
+                cancellation=cancellation,
+                priority=priority,
+                fairness_key=f"document:{document_id}",
+                retry_record=retry_record,
+                deadline=deadline,
+                case_facts=case_facts
+            ):
+                full_content += chunk
+                generation.publish({'type': 'content', 'chunk': chunk})
+            
+        except asyncio.CancelledError:
+            # El cliente la abandonó, o el worker se detuvo y el trabajo vuelve a la cola
+            cancellation.cancel()
+            record_cancelled_generation(db, "declaration", document_id, len(full_content), generation.abandoned)
+            raise
+        except (AIExecutorSaturated, GeminiQueueTimeout, CircuitOpenError) as busy_error:
+            error_msg = str(busy_error)
+            doc_repo.update_document_status(document_id, "error", error_msg)
+            log_repo.create_log(document_id, "error", error_msg, success=False)
+            generation.publish({'type': 'error', 'error': AI_BUSY_MESSAGE, 'status_code': 503})
+            return
+        except GenerationDeadlineExceeded as timeout_error:
+            record_ai_attempts(log_repo, document_id, retry_record, success=False)
+            error_msg = f"Tiempo límite excedido tras generar {len(full_content)} caracteres: {timeout_error}"
+            doc_repo.update_document_status(document_id, "error", error_msg)
+            log_repo.create_log(document_id, "process_timeout", error_msg, success=False)
+            generation.publish({'type': 'error', 'error': error_msg, 'status_code': 504})
+            return
         except Exception as ai_error:
+            record_ai_attempts(log_repo, document_id, retry_record, success=False)
             error_msg = f"Error en la API de IA: {str(ai_error)}"
             doc_repo.update_document_status(document_id, "error", error_msg)
             log_repo.create_log(document_id, "error", error_msg)
-            
-            # Verificar si es un error de timeout
-            if "timeout" in str(ai_error).lower() or "timed out" in str(ai_error).lower():
-                raise HTTPException(
-                    status_code=504, 
-                    detail=f"La generación del Declaration Letter excedió el tiempo límite de {GEMINI_TIMEOUT} segundos. El documento es muy extenso o el servidor está muy ocupado. Por favor, intente nuevamente en unos momentos."
-                )
-            else:
-                raise HTTPException(
-                    status_code=500, 
-                    detail=f"Error al comunicarse con el servicio de IA: {str(ai_error)}. Por favor, intente nuevamente."
-                )
+            generation.publish({'type': 'error', 'error': error_msg, 'status_code': ai_error_status_code(ai_error)})
+            return
+        
+        record_ai_attempts(log_repo, document_id, retry_record, success=True)
         
-        if not markdown_content or len(markdown_content.strip()) == 0:
+        if not full_content or len(full_content.strip()) == 0:
             error_msg = "La IA generó un documento vacío"
             doc_repo.update_document_status(document_id, "error", error_msg)
             log_repo.create_log(document_id, "error", error_msg)
-            raise HTTPException(
-                status_code=500, 
-                detail="Error al generar la declaration letter. El contenido generado está vacío."
-            )
+            generation.publish({'type': 'error', 'error': error_msg, 'status_code': 500})
+            return
         
         # Generar nombre de archivo (solo para referencia, no se guarda físicamente)
         generated_filename = f"declaration_letter_{document_id}_{uuid.uuid4().hex[:8]}.docx"
@@ -316,274 +964,913 @@ async def process_document(
         # Actualizar base de datos
         doc_repo.update_document_content(
             document_id,
-            markdown_content,
+            full_content,
             generated_filename
         )
         
+        # Lo generado por un modelo de respaldo no se guarda bajo la clave del modelo principal
+        served_model = retry_record.model or ai.model_name
+        if cache_key and served_model == ai.model_name:
+            generation_cache.put(cache_key, "declaration", full_content)
+        
         # Crear log
         log_repo.create_log(
             document_id=document_id,
             action="process_complete",
-            details=f"Documento generado: {generated_filename}"
+            details=f"Documento generado: {generated_filename} (modelo: {served_model})"
         )
         
-        return DocumentProcessResponse(
-            success=True,
-            message="Declaration letter generada exitosamente",
-            document_id=document_id,
-            markdown_content=markdown_content,
-            generated_filename=generated_filename,
-            download_url=f"/api/download/{document_id}"
-        )
-    
-    except HTTPException:
-        raise
+        # Enviar evento de completado
+        generation.publish({'type': 'complete', 'filename': generated_filename, 'model': served_model})
+        
     except Exception as e:
-        # Capturar cualquier otro error no manejado
         error_msg = f"Error inesperado: {str(e)}"
         try:
             doc_repo.update_document_status(document_id, "error", error_msg)
             log_repo.create_log(document_id, "error", error_msg)
         except:
-            pass  # Si falla el log, al menos lanzar el error al cliente
+            pass
+        generation.publish({'type': 'error', 'error': error_msg, 'status_code': 500})
+    finally:
+        db.close()
+
+
+async def run_cover_letter_generation(
+    generation: LiveGeneration,
+    ai: AIProcessor,
+    use_cache: bool = True,
+    priority: int = PRIORITY_INTERACTIVE
+):
+    """
+    Genera el Cover Letter publicando los eventos en la generación
+    (corre en segundo plano, independiente de la conexión SSE)
+    
+    Args:
+        generation: Generación en la que se publican los eventos
+        ai: Procesador de IA
+        use_cache: False para ignorar un resultado guardado en la caché
+        priority: Prioridad de la llamada a Gemini (los lotes esperan a las interactivas)
+    """
+    document_id = generation.document_id
+    deadline = Deadline(GEMINI_TIMEOUT)
+    db = db_manager.get_session()
+    doc_repo = DocumentRepository(db)
+    log_repo = LogRepository(db)
+    
+    try:
+        # Obtener documento de la base de datos
+        document = doc_repo.get_document(document_id)
         
-        raise HTTPException(
-            status_code=500, 
-            detail=f"Error al procesar documento. Por favor, intente nuevamente."
+        if not document:
+            generation.publish({'type': 'error', 'error': 'Documento no encontrado', 'status_code': 404})
+            return
+        
+        # Verificar que el Declaration Letter ya haya sido generado
+        if not document.markdown_content:
+            generation.publish({'type': 'error', 'error': 'El Declaration Letter debe ser generado primero', 'status_code': 400})
+            return
+        
+        # Crear log
+        log_repo.create_log(
+            document_id=document_id,
+            action="cover_letter_start",
+            details="Iniciando generación de Cover Letter (streaming)"
         )
+        
+        # Buscar un Cover Letter ya generado para la misma Declaration Letter, prompts y modelo
+        cache_key = None
+        if generation_cache:
+            cache_key = generation_cache.build_key(
+                "cover", document.markdown_content, ai.generation_fingerprint("cover")
+            )
+            cached_content = generation_cache.get(cache_key) if use_cache else None
+            if cached_content:
+                cover_letter_filename = f"cover_letter_{document_id}_{uuid.uuid4().hex[:8]}.docx"
+                doc_repo.update_cover_letter_content(document_id, cached_content, cover_letter_filename)
+                log_repo.create_log(
+                    document_id=document_id,
+                    action="cover_letter_complete",
+                    details=f"Cover Letter obtenido de la caché: {cover_letter_filename}"
+                )
+                generation.publish({'type': 'content', 'chunk': cached_content})
+                generation.publish({'type': 'complete', 'filename': cover_letter_filename, 'cached': True})
+                return
+        
+        # Generar Cover Letter con streaming
+        full_content = ""
+        cancellation = StreamCancellation()
+        retry_record = RetryRecord()
+        try:
+            async for chunk in ai_stream_executor.stream(
+                ai.generate_cover_letter_stream,
+                document.markdown_content,
+                cancellation=cancellation,
+                priority=priority,
+                fairness_key=f"document:{document_id}",
+                retry_record=retry_record,
+                deadline=deadline
+            ):
+                full_content += chunk
+                generation.publish({'type': 'content', 'chunk': chunk})
+            
+        except asyncio.CancelledError:
+            # El cliente la abandonó, o el worker se detuvo y el trabajo vuelve a la cola
+            cancellation.cancel()
+            record_cancelled_generation(db, "cover", document_id, len(full_content), generation.abandoned)
+            raise
+        except (AIExecutorSaturated, GeminiQueueTimeout, CircuitOpenError) as busy_error:
+            log_repo.create_log(document_id, "cover_letter_error", str(busy_error), success=False)
+            generation.publish({'type': 'error', 'error': AI_BUSY_MESSAGE, 'status_code': 503})
+            return
+        except GenerationDeadlineExceeded as timeout_error:
+            record_ai_attempts(log_repo, document_id, retry_record, success=False)
+            error_msg = f"Tiempo límite excedido tras generar {len(full_content)} caracteres: {timeout_error}"
+            log_repo.create_log(document_id, "cover_letter_timeout", error_msg, success=False)
+            generation.publish({'type': 'error', 'error': error_msg, 'status_code': 504})
+            return
+        except Exception as ai_error:
+            record_ai_attempts(log_repo, document_id, retry_record, success=False)
+            error_msg = f"Error en la API de IA: {str(ai_error)}"
+            log_repo.create_log(document_id, "cover_letter_error", error_msg)
+            generation.publish({'type': 'error', 'error': error_msg, 'status_code': ai_error_status_code(ai_error)})
+            return
+        
+        record_ai_attempts(log_repo, document_id, retry_record, success=True)
+        
+        if not full_content or len(full_content.strip()) == 0:
+            error_msg = "La IA generó un Cover Letter vacío"
+            log_repo.create_log(document_id, "cover_letter_error", error_msg)
+            generation.publish({'type': 'error', 'error': error_msg, 'status_code': 500})
+            return
+        
+        # Generar nombre de archivo (solo para referencia, no se guarda físicamente)
+        cover_letter_filename = f"cover_letter_{document_id}_{uuid.uuid4().hex[:8]}.docx"
+        
+        # Actualizar base de datos con el Cover Letter
+        doc_repo.update_cover_letter_content(
+            document_id,
+            full_content,
+            cover_letter_filename
+        )
+        
+        # Lo generado por un modelo de respaldo no se guarda bajo la clave del modelo principal
+        served_model = retry_record.model or ai.model_name
+        if cache_key and served_model == ai.model_name:
+            generation_cache.put(cache_key, "cover", full_content)
+        
+        # Crear log
+        log_repo.create_log(
+            document_id=document_id,
+            action="cover_letter_complete",
+            details=f"Cover Letter generado: {cover_letter_filename} (modelo: {served_model})"
+        )
+        
+        # Enviar evento de completado
+        generation.publish({'type': 'complete', 'filename': cover_letter_filename, 'model': served_model})
+        
+    except Exception as e:
+        error_msg = f"Error inesperado: {str(e)}"
+        try:
+            log_repo.create_log(document_id, "cover_letter_error", error_msg)
+        except:
+            pass
+        generation.publish({'type': 'error', 'error': error_msg, 'status_code': 500})
+    finally:
+        db.close()
+
+
+def sse_response(generation: LiveGeneration, after_seq: int = 0) -> StreamingResponse:
+    """
+    Crea la respuesta SSE que sigue una generación
+    
+    Args:
+        generation: Generación a seguir
+        after_seq: Último evento ya recibido por el cliente
+    
+    Returns:
+        StreamingResponse con Server-Sent Events
+    """
+    return StreamingResponse(
+        generation_hub.sse_events(generation, after_seq),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+
+async def run_generation_job(job: GenerationJob) -> Dict:
+    """
+    Ejecuta un trabajo de la cola: inicia la generación en el registro SSE para
+    que los clientes la sigan y espera su evento final
+    
+    Args:
+        job: Trabajo tomado por el worker
+    
+    Returns:
+        dict: Evento final ('complete' o 'error')
+    """
+    producer = run_declaration_generation if job.kind == "declaration" else run_cover_letter_generation
+    priority = PRIORITY_BATCH if job.source == "batch" else PRIORITY_INTERACTIVE
+    # Solo las generaciones interactivas sueltas se cancelan si el cliente se va;
+    # los lotes, las recuperaciones y las cadenas deben terminar sin nadie mirando
+    abandonable = job.source == "interactive" and await asyncio.to_thread(job_queue.get_pipeline_for_job, job.id) is None
+    generation = generation_hub.start(
+        job.kind,
+        job.document_id,
+        lambda live: producer(live, ai_processor, use_cache=job.use_cache, priority=priority),
+        cancel_when_abandoned=abandonable
+    )
+    await asyncio.to_thread(job_queue.attach_generation, job, generation.generation_id)
+    
+    try:
+        await asyncio.shield(generation.task)
+    except asyncio.CancelledError:
+        # Worker detenido: se cancela la generación y se espera que registre la cancelación
+        generation.task.cancel()
+        await asyncio.wait([generation.task], timeout=5)
+        raise
+    
+    return generation.final_event or {'type': 'error', 'error': 'La generación terminó sin resultado', 'status_code': 500}
+
+
+def build_job_status(job: GenerationJob, pipeline: Optional[GenerationPipeline] = None) -> JobStatusResponse:
+    """
+    Construye la respuesta de estado de un trabajo (consulta la base de datos:
+    desde un handler async se llama con asyncio.to_thread)
+    
+    Args:
+        job: Trabajo de la cola
+        pipeline: Cadena declaration -> cover letter del trabajo (opcional)
+    
+    Returns:
+        JobStatusResponse
+    """
+    final_event = json.loads(job.result) if job.result else {}
+    return JobStatusResponse(
+        job_id=job.id,
+        kind=job.kind,
+        document_id=job.document_id,
+        status=job.status,
+        attempts=job.attempts,
+        max_attempts=job.max_attempts,
+        queue_position=job_queue.position(job),
+        error=final_event.get('error') if job.status != 'completed' else None,
+        created_at=job.created_at.isoformat(),
+        updated_at=job.updated_at.isoformat(),
+        stream_url=f"/api/pipelines/{pipeline.id}/stream" if pipeline else f"/api/jobs/{job.id}/stream",
+        pipeline_id=pipeline.id if pipeline else None
+    )
+
+
+async def wait_for_job(job_id: int) -> GenerationJob:
+    """
+    Espera a que un trabajo termine (completado o fallido)
+    
+    Args:
+        job_id: ID del trabajo
+    
+    Returns:
+        GenerationJob terminado
+    """
+    while True:
+        job = await asyncio.to_thread(job_queue.get, job_id)
+        if not job or job.status not in ACTIVE_JOB_STATUSES:
+            return job
+        await job_queue.wait_for_change(1.0)
+
+
+def job_final_events(job: GenerationJob) -> List[Dict]:
+    """
+    Reconstruye los eventos de un trabajo terminado cuya generación ya no está
+    en memoria (terminó hace tiempo o en otro proceso)
+    
+    Args:
+        job: Trabajo terminado
+    
+    Returns:
+        List[Dict]: Contenido completo y evento final
+    """
+    final_event = json.loads(job.result) if job.result else {}
+    if job.status != 'completed':
+        return [final_event or {'type': 'error', 'error': 'La generación falló', 'status_code': 500}]
+    
+    db = db_manager.get_session()
+    try:
+        document = DocumentRepository(db).get_document(job.document_id)
+        content = None
+        if document:
+            content = document.markdown_content if job.kind == "declaration" else document.cover_letter_markdown
+    finally:
+        db.close()
+    
+    if not content:
+        return [{'type': 'error', 'error': 'Documento no encontrado', 'status_code': 404}]
+    return [{'type': 'content', 'chunk': content}, final_event]
+
+
+async def follow_generation_events(job_id: int, generation_id: str, after_seq: int = 0):
+    """
+    Recorre los eventos de la generación de un intento: en memoria si corre en
+    este proceso, o leyendo SQLite si corre en un proceso worker
+    
+    Args:
+        job_id: ID del trabajo
+        generation_id: ID de la generación del intento
+        after_seq: Último evento ya recibido por el cliente
+    
+    Yields:
+        Tuple[int, str, Dict]: (seq, payload JSON, evento)
+    """
+    generation = generation_hub.get(generation_id)
+    if generation:
+        async for seq, payload in generation_hub.follow(generation, after_seq):
+            yield seq, payload, json.loads(payload)
+        return
+    
+    seq = after_seq
+    while True:
+        # El worker guarda los últimos eventos antes de cerrar el trabajo
+        job = await asyncio.to_thread(job_queue.get, job_id)
+        for seq, payload in await asyncio.to_thread(generation_hub.load_persisted, generation_id, seq):
+            event = json.loads(payload)
+            yield seq, payload, event
+            if event.get('type') in ('complete', 'error'):
+                return
+        
+        if not job or job.generation_id != generation_id or job.status not in ACTIVE_JOB_STATUSES:
+            return
+        await asyncio.sleep(JOB_EVENTS_POLL_SECONDS)
+
+
+async def job_sse_events(job_id: int, generation_id: Optional[str] = None, after_seq: int = 0):
+    """
+    Sigue un trabajo con Server-Sent Events: avisa mientras espera en la cola,
+    retransmite la generación de cada intento y, si un intento falla y se
+    reintenta, envía un evento 'retry' para que el cliente descarte lo recibido
+    
+    Args:
+        job_id: ID del trabajo
+        generation_id: Generación en la que continuar (reconexión con Last-Event-ID)
+        after_seq: Último evento ya recibido de esa generación
+    
+    Yields:
+        str: Eventos en formato Server-Sent Events
+    """
+    yield f"retry: {SSE_RETRY_MILLISECONDS}\n\n"
+    announced = None
+    followed = set()
+    
+    while True:
+        if generation_id is None:
+            job = await asyncio.to_thread(job_queue.get, job_id)
+            if not job:
+                yield f"data: {json.dumps({'type': 'error', 'error': 'Trabajo no encontrado', 'status_code': 404})}\n\n"
+                return
+            
+            current = job.generation_id if job.generation_id not in followed else None
+            if current and (job.status == "running" or generation_hub.get(current)):
+                generation_id, after_seq = current, 0
+            elif job.status not in ACTIVE_JOB_STATUSES:
+                for event in await asyncio.to_thread(job_final_events, job):
+                    yield f"data: {json.dumps(event)}\n\n"
+                return
+            else:
+                if job.status == "queued" and announced != job.attempts:
+                    announced = job.attempts
+                    position = await asyncio.to_thread(job_queue.position, job)
+                    yield f"data: {json.dumps({'type': 'queued', 'job_id': job.id, 'position': position})}\n\n"
+                await job_queue.wait_for_change(1.0)
+                continue
+        
+        followed.add(generation_id)
+        final_event = None
+        async for seq, payload, event in follow_generation_events(job_id, generation_id, after_seq):
+            if event.get('type') in ('complete', 'error'):
+                final_event = event
+                job = await asyncio.to_thread(job_queue.get, job_id)
+                if event.get('type') == 'error' and job and job_queue.will_retry(job, event):
+                    break
+            yield f"id: {generation_id}:{seq}\ndata: {payload}\n\n"
+        
+        if final_event and final_event.get('type') == 'complete':
+            return
+        if final_event and not job_queue.will_retry(job, final_event):
+            return
+        
+        # El intento falló y se reintenta, o su worker se detuvo y otro lo retomará
+        error = final_event.get('error') if final_event else "Procesamiento interrumpido"
+        yield f"data: {json.dumps({'type': 'retry', 'job_id': job_id, 'error': error})}\n\n"
+        generation_id = None
+
+
+def job_sse_response(job_id: int, generation_id: Optional[str] = None, after_seq: int = 0) -> StreamingResponse:
+    """
+    Crea la respuesta SSE que sigue un trabajo de la cola
+    
+    Args:
+        job_id: ID del trabajo
+        generation_id: Generación en la que continuar (reconexión)
+        after_seq: Último evento ya recibido por el cliente
+    
+    Returns:
+        StreamingResponse con Server-Sent Events
+    """
+    return StreamingResponse(
+        job_sse_events(job_id, generation_id, after_seq),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+
+async def resume_job_stream(last_event_id: Optional[str], kind: str, document_id: int) -> Optional[StreamingResponse]:
+    """
+    Continúa el stream de un cliente que reconecta con Last-Event-ID
+    
+    Args:
+        last_event_id: Valor del header Last-Event-ID ('<generation_id>:<seq>')
+        kind: Tipo de generación esperado
+        document_id: ID del documento esperado
+    
+    Returns:
+        StreamingResponse o None si no hay nada que continuar
+    """
+    resumed = generation_hub.resume(last_event_id, kind, document_id)
+    if resumed:
+        generation, after_seq = resumed
+        job = await asyncio.to_thread(job_queue.get_by_generation, generation.generation_id)
+        if job:
+            return job_sse_response(job.id, generation.generation_id, after_seq)
+        return sse_response(generation, after_seq)
+    
+    # Generación que corre en un proceso worker
+    if last_event_id and ":" in last_event_id:
+        generation_id, _, seq_text = last_event_id.partition(":")
+        job = await asyncio.to_thread(job_queue.get_by_generation, generation_id)
+        if job and job.kind == kind and job.document_id == document_id and seq_text.isdigit():
+            metrics.increment("sse_resumed")
+            return job_sse_response(job.id, generation_id, int(seq_text))
+    return None
+
+
+async def pipeline_sse_events(pipeline_id: int, generation_id: Optional[str] = None, after_seq: int = 0):
+    """
+    Sigue una cadena declaration -> cover letter en un solo stream SSE: la
+    declaration letter, un evento 'stage' y el cover letter que el servidor
+    encoló al completarse la declaration
+    
+    Args:
+        pipeline_id: ID de la cadena
+        generation_id: Generación en la que continuar (reconexión con Last-Event-ID)
+        after_seq: Último evento ya recibido de esa generación
+    
+    Yields:
+        str: Eventos en formato Server-Sent Events
+    """
+    pipeline = await asyncio.to_thread(job_queue.get_pipeline, pipeline_id)
+    if not pipeline:
+        yield f"data: {json.dumps({'type': 'error', 'error': 'Cadena no encontrada', 'status_code': 404})}\n\n"
+        return
+    
+    resumed_job = await asyncio.to_thread(job_queue.get_by_generation, generation_id) if generation_id else None
+    in_cover = resumed_job is not None and resumed_job.id == pipeline.cover_job_id
+    
+    if not in_cover:
+        if generation_id is None:
+            yield f"data: {json.dumps({'type': 'stage', 'stage': 'declaration', 'pipeline_id': pipeline_id, 'job_id': pipeline.declaration_job_id})}\n\n"
+        async for message in job_sse_events(pipeline.declaration_job_id, generation_id, after_seq):
+            yield message
+        
+        # El evento 'complete' sale antes de que el worker cierre el trabajo
+        declaration_job = await wait_for_job(pipeline.declaration_job_id)
+        if not declaration_job or declaration_job.status != "completed":
+            return
+        generation_id, after_seq = None, 0
+        
+        # El worker que completó la declaration encola el cover letter
+        while True:
+            pipeline = await asyncio.to_thread(job_queue.get_pipeline, pipeline_id)
+            if pipeline.cover_job_id:
+                break
+            if pipeline.status == "failed":
+                yield f"data: {json.dumps({'type': 'error', 'error': 'No se pudo encolar el Cover Letter', 'status_code': 500})}\n\n"
+                return
+            await job_queue.wait_for_change(1.0)
+        
+        yield f"data: {json.dumps({'type': 'stage', 'stage': 'cover', 'pipeline_id': pipeline_id, 'job_id': pipeline.cover_job_id})}\n\n"
+    
+    async for message in job_sse_events(pipeline.cover_job_id, generation_id, after_seq):
+        yield message
+
+
+def pipeline_sse_response(pipeline_id: int, generation_id: Optional[str] = None, after_seq: int = 0) -> StreamingResponse:
+    """
+    Crea la respuesta SSE que sigue una cadena declaration -> cover letter
+    
+    Args:
+        pipeline_id: ID de la cadena
+        generation_id: Generación en la que continuar (reconexión)
+        after_seq: Último evento ya recibido por el cliente
+    
+    Returns:
+        StreamingResponse con Server-Sent Events
+    """
+    return StreamingResponse(
+        pipeline_sse_events(pipeline_id, generation_id, after_seq),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+
+async def resume_pipeline_stream(last_event_id: Optional[str], document_id: int) -> Optional[StreamingResponse]:
+    """
+    Continúa el stream de una cadena cuando el cliente reconecta con Last-Event-ID
+    
+    Args:
+        last_event_id: Valor del header Last-Event-ID ('<generation_id>:<seq>')
+        document_id: ID del documento esperado
+    
+    Returns:
+        StreamingResponse o None si no hay nada que continuar
+    """
+    if not last_event_id or ":" not in last_event_id:
+        return None
+    generation_id, _, seq_text = last_event_id.partition(":")
+    job = await asyncio.to_thread(job_queue.get_by_generation, generation_id)
+    if not job or job.document_id != document_id or not seq_text.isdigit():
+        return None
+    chain = await asyncio.to_thread(job_queue.get_pipeline_for_job, job.id)
+    if not chain:
+        return None
+    metrics.increment("sse_resumed")
+    return pipeline_sse_response(chain.id, generation_id, int(seq_text))
+
+
+@app.get("/api/jobs/{job_id}", response_model=JobStatusResponse)
+async def get_job_status(job_id: int):
+    """
+    Obtiene el estado de un trabajo de generación (para consultar periódicamente)
+    
+    Args:
+        job_id: ID del trabajo
+    
+    Returns:
+        JobStatusResponse con el estado, los intentos y la posición en la cola
+    """
+    job = await asyncio.to_thread(job_queue.get, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    chain = await asyncio.to_thread(job_queue.get_pipeline_for_job, job_id)
+    return await asyncio.to_thread(build_job_status, job, chain)
+
+
+@app.get("/api/jobs/{job_id}/stream")
+async def stream_job(job_id: int, request: Request):
+    """
+    Sigue un trabajo de generación con Server-Sent Events
+    
+    Args:
+        job_id: ID del trabajo
+        request: Petición HTTP (para leer Last-Event-ID)
+    
+    Returns:
+        StreamingResponse con Server-Sent Events
+    """
+    job = await asyncio.to_thread(job_queue.get, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    
+    resumed = await resume_job_stream(request.headers.get("last-event-id"), job.kind, job.document_id)
+    if resumed:
+        return resumed
+    return job_sse_response(job_id)
 
 
-@app.post("/api/regenerate", response_model=DocumentProcessResponse)
-async def regenerate_document(
-    request: RegenerateRequest,
-    db: Session = Depends(get_db),
-    ai: AIProcessor = Depends(get_ai_processor)
-):
+@app.get("/api/pipelines/{pipeline_id}/stream")
+async def stream_pipeline(pipeline_id: int, request: Request):
     """
-    Regenera una declaration letter existente
+    Sigue una cadena declaration -> cover letter con Server-Sent Events
     
     Args:
-        request: Solicitud con el ID del documento
-        db: Sesión de base de datos
-        ai: Procesador de IA
+        pipeline_id: ID de la cadena
+        request: Petición HTTP (para leer Last-Event-ID)
     
     Returns:
-        DocumentProcessResponse con el nuevo documento generado
+        StreamingResponse con Server-Sent Events
     """
-    # Simplemente llama a process_document nuevamente
-    return await process_document(request.document_id, db, ai)
+    chain = await asyncio.to_thread(job_queue.get_pipeline, pipeline_id)
+    if not chain:
+        raise HTTPException(status_code=404, detail="Cadena no encontrada")
+    
+    resumed = await resume_pipeline_stream(request.headers.get("last-event-id"), chain.document_id)
+    if resumed:
+        return resumed
+    return pipeline_sse_response(pipeline_id)
 
 
 @app.get("/api/process/{document_id}/stream")
 async def process_document_stream(
     document_id: int,
+    request: Request,
     db: Session = Depends(get_db),
-    ai: AIProcessor = Depends(get_ai_processor)
+    ai: AIProcessor = Depends(get_ai_processor),
+    regenerate: bool = False,
+    pipeline: bool = False
 ):
     """
     Procesa un documento y genera la declaration letter con streaming (SSE)
     
+    La generación es un trabajo de la cola persistente: sigue aunque el cliente
+    se desconecte. Si el navegador reconecta con Last-Event-ID, se reenvían los
+    eventos perdidos y se continúa con la misma generación. Una solicitud nueva
+    mientras otra está pendiente o en curso se une a su trabajo.
+    
     Args:
         document_id: ID del documento a procesar
+        request: Petición HTTP (para leer Last-Event-ID)
         db: Sesión de base de datos
         ai: Procesador de IA
+        regenerate: True para ignorar la caché y generar de nuevo
+        pipeline: True para encadenar el cover letter en el servidor y recibir
+            los dos en este mismo stream (separados por eventos 'stage')
     
     Returns:
         StreamingResponse con Server-Sent Events
     """
-    async def event_generator():
-        doc_repo = DocumentRepository(db)
-        log_repo = LogRepository(db)
-        
-        try:
-            # Obtener documento de la base de datos
-            document = doc_repo.get_document(document_id)
-            
-            if not document:
-                yield f"data: {json.dumps({'type': 'error', 'error': 'Documento no encontrado'})}\n\n"
-                return
-            
-            # Actualizar estado a procesando
-            doc_repo.update_document_status(document_id, "processing")
-            
-            # Crear log
-            log_repo.create_log(
-                document_id=document_id,
-                action="process_start",
-                details="Iniciando procesamiento del documento (streaming)"
-            )
-            
-            # Extraer texto del archivo
-            file_path = UPLOAD_FOLDER / document.filename
-            
-            if not file_path.exists():
-                error_msg = "Archivo fuente no encontrado"
-                doc_repo.update_document_status(document_id, "error", error_msg)
-                log_repo.create_log(document_id, "error", error_msg)
-                yield f"data: {json.dumps({'type': 'error', 'error': error_msg})}\n\n"
-                return
-            
-            questionnaire_text = ai.extract_text_from_file(str(file_path))
-            
-            if not questionnaire_text or len(questionnaire_text.strip()) == 0:
-                error_msg = "No se pudo extraer texto del archivo o el archivo está vacío"
-                doc_repo.update_document_status(document_id, "error", error_msg)
-                log_repo.create_log(document_id, "error", error_msg)
-                yield f"data: {json.dumps({'type': 'error', 'error': error_msg})}\n\n"
-                return
-            
-            # Generar declaration letter con streaming
-            full_content = ""
-            try:
-                for chunk in ai.generate_declaration_letter_stream(questionnaire_text):
-                    full_content += chunk
-                    # Enviar chunk al cliente
-                    yield f"data: {json.dumps({'type': 'content', 'chunk': chunk})}\n\n"
-                    await asyncio.sleep(0)  # Permitir que otros tasks se ejecuten
-                
-            except Exception as ai_error:
-                error_msg = f"Error en la API de IA: {str(ai_error)}"
-                doc_repo.update_document_status(document_id, "error", error_msg)
-                log_repo.create_log(document_id, "error", error_msg)
-                yield f"data: {json.dumps({'type': 'error', 'error': error_msg})}\n\n"
-                return
-            
-            if not full_content or len(full_content.strip()) == 0:
-                error_msg = "La IA generó un documento vacío"
-                doc_repo.update_document_status(document_id, "error", error_msg)
-                log_repo.create_log(document_id, "error", error_msg)
-                yield f"data: {json.dumps({'type': 'error', 'error': error_msg})}\n\n"
-                return
-            
-            # Generar nombre de archivo (solo para referencia, no se guarda físicamente)
-            generated_filename = f"declaration_letter_{document_id}_{uuid.uuid4().hex[:8]}.docx"
-            
-            # Actualizar base de datos
-            doc_repo.update_document_content(
-                document_id,
-                full_content,
-                generated_filename
-            )
-            
-            # Crear log
-            log_repo.create_log(
-                document_id=document_id,
-                action="process_complete",
-                details=f"Documento generado: {generated_filename}"
-            )
-            
-            # Enviar evento de completado
-            yield f"data: {json.dumps({'type': 'complete', 'filename': generated_filename})}\n\n"
-            
-        except Exception as e:
-            error_msg = f"Error inesperado: {str(e)}"
-            try:
-                doc_repo.update_document_status(document_id, "error", error_msg)
-                log_repo.create_log(document_id, "error", error_msg)
-            except:
-                pass
-            yield f"data: {json.dumps({'type': 'error', 'error': error_msg})}\n\n"
+    if not DocumentRepository(db).get_document(document_id):
+        raise HTTPException(status_code=404, detail="Documento no encontrado")
     
-    return StreamingResponse(
-        event_generator(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no"
-        }
-    )
+    if pipeline:
+        resumed = await resume_pipeline_stream(request.headers.get("last-event-id"), document_id)
+        if resumed:
+            return resumed
+        chain = await asyncio.to_thread(job_queue.submit_pipeline, document_id, use_cache=not regenerate)
+        return pipeline_sse_response(chain.id)
+    
+    resumed = await resume_job_stream(request.headers.get("last-event-id"), "declaration", document_id)
+    if resumed:
+        return resumed
+    
+    job = await asyncio.to_thread(job_queue.submit, "declaration", document_id, use_cache=not regenerate)
+    return job_sse_response(job.id)
 
 
 @app.get("/api/generate-cover-letter/{document_id}/stream")
 async def generate_cover_letter_stream(
     document_id: int,
+    request: Request,
     db: Session = Depends(get_db),
-    ai: AIProcessor = Depends(get_ai_processor)
+    ai: AIProcessor = Depends(get_ai_processor),
+    regenerate: bool = False
 ):
     """
     Genera un Cover Letter con streaming (SSE)
     
+    La generación es un trabajo de la cola persistente: sigue aunque el cliente
+    se desconecte. Si el navegador reconecta con Last-Event-ID, se reenvían los
+    eventos perdidos y se continúa con la misma generación. Una solicitud nueva
+    mientras otra está pendiente o en curso se une a su trabajo.
+    
     Args:
         document_id: ID del documento con el Declaration Letter
+        request: Petición HTTP (para leer Last-Event-ID)
         db: Sesión de base de datos
         ai: Procesador de IA
+        regenerate: True para ignorar la caché y generar de nuevo
     
     Returns:
         StreamingResponse con Server-Sent Events
     """
-    async def event_generator():
-        doc_repo = DocumentRepository(db)
-        log_repo = LogRepository(db)
-        
+    document = DocumentRepository(db).get_document(document_id)
+    
+    if not document:
+        raise HTTPException(status_code=404, detail="Documento no encontrado")
+    
+    # Verificar que el Declaration Letter ya haya sido generado
+    if not document.markdown_content:
+        raise HTTPException(
+            status_code=400,
+            detail="El Declaration Letter debe ser generado primero"
+        )
+    
+    resumed = await resume_job_stream(request.headers.get("last-event-id"), "cover", document_id)
+    if resumed:
+        return resumed
+    
+    job = await asyncio.to_thread(job_queue.submit, "cover", document_id, use_cache=not regenerate)
+    return job_sse_response(job.id)
+
+
+# Estados de un documento que indican que su generación del lote sigue pendiente
+BATCH_PENDING_STATUSES = ("queued", "processing")
+
+
+def build_batch_status(db: Session, batch_id: str) -> Optional[BatchStatusResponse]:
+    """
+    Calcula el progreso agregado de un lote
+    
+    Args:
+        db: Sesión de base de datos
+        batch_id: ID del lote
+    
+    Returns:
+        BatchStatusResponse o None si el lote no existe
+    """
+    batch_repo = BatchRepository(db)
+    if not batch_repo.get_batch(batch_id):
+        return None
+    
+    documents = batch_repo.get_batch_documents(batch_id)
+    counts = {}
+    for document in documents:
+        counts[document.status] = counts.get(document.status, 0) + 1
+    
+    return BatchStatusResponse(
+        batch_id=batch_id,
+        total=len(documents),
+        counts=counts,
+        finished=not any(document.status in BATCH_PENDING_STATUSES for document in documents),
+        documents=[
+            BatchDocumentInfo(
+                document_id=document.id,
+                filename=document.original_filename,
+                status=document.status,
+                error_message=document.error_message
+            )
+            for document in documents
+        ]
+    )
+
+
+@app.post("/api/batch", response_model=BatchUploadResponse)
+async def upload_batch(
+    background_tasks: BackgroundTasks,
+    files: List[UploadFile] = File(...),
+    process: bool = True,
+    db: Session = Depends(get_db)
+):
+    """
+    Sube varios archivos en una sola solicitud y programa sus declaration letters
+    
+    Los documentos se crean en una sola transacción. Las generaciones se
+    encolan en la cola persistente, como máximo BATCH_MAX_CONCURRENCY a la vez
+    y detrás de las solicitudes interactivas. Cada documento se puede seguir con
+    /api/process/{id}/stream (se une al trabajo del lote) y el lote
+    completo con /api/batch/{batch_id} o /api/batch/{batch_id}/stream.
+    
+    Args:
+        background_tasks: Tareas a ejecutar después de responder
+        files: Archivos a subir
+        process: False para solo subir los archivos
+        db: Sesión de base de datos
+    
+    Returns:
+        BatchUploadResponse con el ID del lote y sus documentos
+    """
+    if len(files) > BATCH_MAX_FILES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"El lote excede el máximo de {BATCH_MAX_FILES} archivos"
+        )
+    
+    if process and not ai_processor:
+        raise HTTPException(
+            status_code=503,
+            detail="Servicio de IA no disponible. Configure la API key de Gemini."
+        )
+    
+    # Guardar cada archivo; los que fallan se informan sin cancelar el lote
+    saved_files = []
+    errors = []
+    for file in files:
         try:
-            # Obtener documento de la base de datos
-            document = doc_repo.get_document(document_id)
-            
-            if not document:
-                yield f"data: {json.dumps({'type': 'error', 'error': 'Documento no encontrado'})}\n\n"
-                return
-            
-            # Verificar que el Declaration Letter ya haya sido generado
-            if not document.markdown_content:
-                yield f"data: {json.dumps({'type': 'error', 'error': 'El Declaration Letter debe ser generado primero'})}\n\n"
-                return
-            
-            # Crear log
-            log_repo.create_log(
-                document_id=document_id,
-                action="cover_letter_start",
-                details="Iniciando generación de Cover Letter (streaming)"
+            stored_filename, file_size, file_hash = await save_upload(file, UPLOAD_FOLDER, MAX_FILE_SIZE_BYTES)
+        except UploadTooLarge:
+            errors.append(f"{file.filename}: {UPLOAD_TOO_LARGE_MESSAGE}")
+            continue
+        except Exception as e:
+            errors.append(f"{file.filename}: Error al subir archivo: {str(e)}")
+            continue
+        saved_files.append({
+            "filename": stored_filename,
+            "original_filename": file.filename,
+            "file_size": file_size,
+            "file_type": file.content_type,
+            "file_hash": file_hash
+        })
+    
+    if not saved_files:
+        raise HTTPException(status_code=400, detail="Ningún archivo del lote se pudo subir: " + "; ".join(errors))
+    
+    batch_id = uuid.uuid4().hex
+    try:
+        documents = BatchRepository(db).create_batch(
+            batch_id,
+            saved_files,
+            status="queued" if process else "uploaded"
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al registrar el lote: {str(e)}")
+    
+    for saved_file in saved_files:
+        background_tasks.add_task(extract_uploaded_text, str(UPLOAD_FOLDER / saved_file["filename"]), saved_file["file_hash"])
+    
+    if process:
+        # Detrás de las solicitudes interactivas; como máximo BATCH_MAX_CONCURRENCY a la vez
+        for document in documents:
+            await asyncio.to_thread(job_queue.submit, "declaration", document.id, source="batch", priority=1)
+    
+    print(f"Lote {batch_id}: {len(documents)} documentos, {len(errors)} archivos rechazados")
+    
+    return BatchUploadResponse(
+        success=True,
+        message=f"{len(documents)} archivos subidos" + (" y en cola para procesar" if process else ""),
+        batch_id=batch_id,
+        documents=[
+            BatchDocumentInfo(
+                document_id=document.id,
+                filename=document.original_filename,
+                status=document.status
             )
-            
-            # Generar Cover Letter con streaming
-            full_content = ""
+            for document in documents
+        ],
+        errors=errors
+    )
+
+
+@app.get("/api/batch/{batch_id}", response_model=BatchStatusResponse)
+async def get_batch_status(
+    batch_id: str,
+    db: Session = Depends(get_db)
+):
+    """
+    Obtiene el progreso agregado de un lote
+    
+    Args:
+        batch_id: ID del lote
+        db: Sesión de base de datos
+    
+    Returns:
+        BatchStatusResponse con los estados de sus documentos
+    """
+    status = build_batch_status(db, batch_id)
+    if not status:
+        raise HTTPException(status_code=404, detail="Lote no encontrado")
+    return status
+
+
+@app.get("/api/batch/{batch_id}/stream")
+async def stream_batch_status(batch_id: str):
+    """
+    Envía el progreso de un lote con Server-Sent Events cada vez que cambia,
+    hasta que todos sus documentos terminan
+    
+    Args:
+        batch_id: ID del lote
+    
+    Returns:
+        StreamingResponse con Server-Sent Events
+    """
+    db = db_manager.get_session()
+    try:
+        if not BatchRepository(db).get_batch(batch_id):
+            raise HTTPException(status_code=404, detail="Lote no encontrado")
+    finally:
+        db.close()
+    
+    async def event_generator():
+        last_payload = None
+        while True:
+            db = db_manager.get_session()
             try:
-                for chunk in ai.generate_cover_letter_stream(document.markdown_content):
-                    full_content += chunk
-                    # Enviar chunk al cliente
-                    yield f"data: {json.dumps({'type': 'content', 'chunk': chunk})}\n\n"
-                    await asyncio.sleep(0)  # Permitir que otros tasks se ejecuten
-                
-            except Exception as ai_error:
-                error_msg = f"Error en la API de IA: {str(ai_error)}"
-                log_repo.create_log(document_id, "cover_letter_error", error_msg)
-                yield f"data: {json.dumps({'type': 'error', 'error': error_msg})}\n\n"
-                return
+                status = build_batch_status(db, batch_id)
+            finally:
+                db.close()
             
-            if not full_content or len(full_content.strip()) == 0:
-                error_msg = "La IA generó un Cover Letter vacío"
-                log_repo.create_log(document_id, "cover_letter_error", error_msg)
-                yield f"data: {json.dumps({'type': 'error', 'error': error_msg})}\n\n"
+            if not status:
+                yield f"data: {json.dumps({'type': 'error', 'error': 'Lote no encontrado', 'status_code': 404})}\n\n"
                 return
             
-            # Generar nombre de archivo (solo para referencia, no se guarda físicamente)
-            cover_letter_filename = f"cover_letter_{document_id}_{uuid.uuid4().hex[:8]}.docx"
+            payload = status.model_dump()
+            if payload != last_payload:
+                last_payload = payload
+                yield f"data: {json.dumps({'type': 'progress', **payload})}\n\n"
             
-            # Actualizar base de datos con el Cover Letter
-            doc_repo.update_cover_letter_content(
-                document_id,
-                full_content,
-                cover_letter_filename
-            )
-            
-            # Crear log
-            log_repo.create_log(
-                document_id=document_id,
-                action="cover_letter_complete",
-                details=f"Cover Letter generado: {cover_letter_filename}"
-            )
-            
-            # Enviar evento de completado
-            yield f"data: {json.dumps({'type': 'complete', 'filename': cover_letter_filename})}\n\n"
+            if status.finished:
+                yield f"data: {json.dumps({'type': 'complete', 'batch_id': batch_id})}\n\n"
+                return
             
-        except Exception as e:
-            error_msg = f"Error inesperado: {str(e)}"
-            try:
-                log_repo.create_log(document_id, "cover_letter_error", error_msg)
-            except:
-                pass
-            yield f"data: {json.dumps({'type': 'error', 'error': error_msg})}\n\n"
+            await asyncio.sleep(1)
     
     return StreamingResponse(
         event_generator(),
@@ -705,110 +1992,62 @@ async def preview_document(
 async def generate_cover_letter(
     document_id: int,
     db: Session = Depends(get_db),
-    ai: AIProcessor = Depends(get_ai_processor)
+    ai: AIProcessor = Depends(get_ai_processor),
+    regenerate: bool = False
 ):
     """
     Genera un Cover Letter basado en el Declaration Letter existente
     
+    Si ya hay un trabajo de Cover Letter pendiente o en curso para el
+    documento, se espera su resultado en lugar de iniciar otra llamada a Gemini.
+    
     Args:
         document_id: ID del documento con el Declaration Letter
         db: Sesión de base de datos
         ai: Procesador de IA
+        regenerate: True para ignorar la caché y generar de nuevo
     
     Returns:
         CoverLetterGenerateResponse con el Cover Letter generado
     """
     doc_repo = DocumentRepository(db)
-    log_repo = LogRepository(db)
+    document = doc_repo.get_document(document_id)
     
-    try:
-        # Obtener documento de la base de datos
-        document = doc_repo.get_document(document_id)
-        
-        if not document:
-            raise HTTPException(status_code=404, detail="Documento no encontrado")
-        
-        # Verificar que el Declaration Letter ya haya sido generado
-        if not document.markdown_content:
-            raise HTTPException(
-                status_code=400, 
-                detail="El Declaration Letter debe ser generado primero"
-            )
-        
-        # Crear log
-        log_repo.create_log(
-            document_id=document_id,
-            action="cover_letter_start",
-            details="Iniciando generación de Cover Letter"
-        )
-        
-        # Generar Cover Letter usando el Declaration Letter como base
-        try:
-            cover_letter_markdown = ai.generate_cover_letter(document.markdown_content)
-        except Exception as ai_error:
-            error_msg = f"Error en la API de IA: {str(ai_error)}"
-            log_repo.create_log(document_id, "cover_letter_error", error_msg)
-            
-            # Verificar si es un error de timeout
-            if "timeout" in str(ai_error).lower() or "timed out" in str(ai_error).lower():
-                raise HTTPException(
-                    status_code=504, 
-                    detail=f"La generación del Cover Letter excedió el tiempo límite de {GEMINI_TIMEOUT} segundos. El documento es muy extenso o el servidor está muy ocupado. Por favor, intente nuevamente en unos momentos."
-                )
-            else:
-                raise HTTPException(
-                    status_code=500, 
-                    detail=f"Error al comunicarse con el servicio de IA: {str(ai_error)}. Por favor, intente nuevamente."
-                )
-        
-        if not cover_letter_markdown or len(cover_letter_markdown.strip()) == 0:
-            error_msg = "La IA generó un Cover Letter vacío"
-            log_repo.create_log(document_id, "cover_letter_error", error_msg)
-            raise HTTPException(
-                status_code=500, 
-                detail="Error al generar el Cover Letter. El contenido generado está vacío."
-            )
-        
-        # Generar nombre de archivo (solo para referencia, no se guarda físicamente)
-        cover_letter_filename = f"cover_letter_{document_id}_{uuid.uuid4().hex[:8]}.docx"
-        
-        # Actualizar base de datos con el Cover Letter
-        doc_repo.update_cover_letter_content(
-            document_id,
-            cover_letter_markdown,
-            cover_letter_filename
-        )
-        
-        # Crear log
-        log_repo.create_log(
-            document_id=document_id,
-            action="cover_letter_complete",
-            details=f"Cover Letter generado: {cover_letter_filename}"
-        )
-        
-        return CoverLetterGenerateResponse(
-            success=True,
-            message="Cover Letter generado exitosamente",
-            document_id=document_id,
-            cover_letter_markdown=cover_letter_markdown,
-            cover_letter_filename=cover_letter_filename,
-            download_url=f"/api/download-cover-letter/{document_id}"
-        )
+    if not document:
+        raise HTTPException(status_code=404, detail="Documento no encontrado")
     
-    except HTTPException:
-        raise
-    except Exception as e:
-        # Capturar cualquier otro error no manejado
-        error_msg = f"Error inesperado: {str(e)}"
-        try:
-            log_repo.create_log(document_id, "cover_letter_error", error_msg)
-        except:
-            pass
-        
+    # Verificar que el Declaration Letter ya haya sido generado
+    if not document.markdown_content:
         raise HTTPException(
-            status_code=500, 
-            detail=f"Error al generar Cover Letter. Por favor, intente nuevamente."
+            status_code=400, 
+            detail="El Declaration Letter debe ser generado primero"
         )
+    
+    # Encolar la generación (o usar el trabajo que ya está en curso) y esperar el resultado
+    job = await asyncio.to_thread(job_queue.submit, "cover", document_id, use_cache=not regenerate)
+    job = await wait_for_job(job.id)
+    final_event = json.loads(job.result) if job.result else {}
+    
+    if job.status != 'completed':
+        status_code = final_event.get('status_code', 500)
+        if status_code == 504:
+            detail = f"La generación del Cover Letter excedió el tiempo límite de {GEMINI_TIMEOUT} segundos. El documento es muy extenso o el servidor está muy ocupado. Por favor, intente nuevamente en unos momentos."
+        else:
+            detail = final_event.get('error', "Error al generar Cover Letter. Por favor, intente nuevamente.")
+        raise HTTPException(status_code=status_code, detail=detail)
+    
+    # El documento se actualizó en otra sesión mientras se esperaba
+    db.expire_all()
+    cover_letter_markdown = doc_repo.get_document(document_id).cover_letter_markdown
+    
+    return CoverLetterGenerateResponse(
+        success=True,
+        message="Cover Letter generado exitosamente",
+        document_id=document_id,
+        cover_letter_markdown=cover_letter_markdown,
+        cover_letter_filename=final_event.get('filename'),
+        download_url=f"/api/download-cover-letter/{document_id}"
+    )
 
 
 @app.get("/api/download-cover-letter/{document_id}")
@@ -979,14 +2218,25 @@ async def chat_with_ai(
         # Generar ID de usuario único (puede ser una sesión o user ID real)
         user_id = chat_message.user_id or f"user_{chat_message.document_id}"
         
-        # Generar respuesta del chat
-        response = chat_system.chat(
-            user_message=chat_message.message,
-            user_id=user_id,
-            document_content=document_content,
-            document_type=chat_message.document_type,
-            save_to_memory=True
-        )
+        # Hechos del caso guardados al generar la declaración (contexto compacto del cuestionario)
+        case_facts = case_facts_store.get(chat_message.document_id) if CASE_FACTS_ENABLED else None
+        
+        # Generar respuesta del chat (fuera del event loop)
+        try:
+            response = await ai_executor.run(
+                chat_system.chat,
+                user_message=chat_message.message,
+                user_id=user_id,
+                document_content=document_content,
+                document_type=chat_message.document_type,
+                save_to_memory=True,
+                case_facts=case_facts
+            )
+        except AIExecutorSaturated:
+            raise HTTPException(
+                status_code=503,
+                detail=AI_BUSY_MESSAGE
+            )
         
         # Verificar si la respuesta contiene texto modificado
         has_modification = "MODIFIED_TEXT:" in response
@@ -1079,20 +2329,31 @@ async def chat_with_ai_stream(
             # Generar ID de usuario único
             user_id = chat_message.user_id or f"user_{chat_message.document_id}"
             
+            # Hechos del caso guardados al generar la declaración (contexto compacto del cuestionario)
+            case_facts = case_facts_store.get(chat_message.document_id) if CASE_FACTS_ENABLED else None
+            
             # Generar respuesta con streaming
             full_response = ""
+            cancellation = StreamCancellation()
             try:
-                for chunk in chat_system.generate_response_stream(
+                async for chunk in ai_stream_executor.stream(
+                    chat_system.generate_response_stream,
                     user_message=chat_message.message,
                     user_id=user_id,
                     document_content=document_content,
-                    document_type=chat_message.document_type
+                    document_type=chat_message.document_type,
+                    cancellation=cancellation,
+                    case_facts=case_facts
                 ):
                     full_response += chunk
                     # Enviar chunk al cliente
                     yield f"data: {json.dumps({'type': 'content', 'chunk': chunk})}\n\n"
-                    await asyncio.sleep(0)  # Permitir que otros tasks se ejecuten
                 
+            except (asyncio.CancelledError, GeneratorExit):
+                # El cliente cerró la conexión: no seguir pidiendo tokens a Gemini
+                cancellation.cancel()
+                metrics.increment("chat_streams_cancelled")
+                raise
             except Exception as stream_error:
                 error_msg = f"Error en streaming: {str(stream_error)}"
                 yield f"data: {json.dumps({'type': 'error', 'error': error_msg})}\n\n"
@@ -1119,8 +2380,8 @@ async def chat_with_ai_stream(
                     
                     modified_text = modified_text.strip()
             
-            # Guardar en memoria después de completar
-            chat_system.save_conversation(user_id, chat_message.message, full_response)
+            # Guardar en memoria después de completar (llamada de red a mem0, fuera del event loop)
+            await asyncio.to_thread(chat_system.save_conversation, user_id, chat_message.message, full_response)
             
             # Enviar evento de completado con información de modificación
             yield f"data: {json.dumps({'type': 'complete', 'has_modification': has_modification, 'modified_text': modified_text})}\n\n"
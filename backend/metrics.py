@@ -0,0 +1,60 @@
+"""
+Métricas internas de DeclarationLetterOnline
+Contadores y gauges en memoria expuestos en /api/metrics
+"""
+
+import threading
+from typing import Dict
+
+
+class MetricsRegistry:
+    """
+    Registro thread-safe de contadores y gauges del proceso
+    """
+
+    def __init__(self):
+        """
+        Inicializa el registro vacío
+        """
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._gauges: Dict[str, float] = {}
+
+    def increment(self, name: str, value: float = 1):
+        """
+        Incrementa un contador
+
+        Args:
+            name: Nombre del contador
+            value: Cantidad a sumar (default: 1)
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value: float):
+        """
+        Fija el valor actual de un gauge
+
+        Args:
+            name: Nombre del gauge
+            value: Valor actual
+        """
+        with self._lock:
+            self._gauges[name] = value
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """
+        Obtiene una copia de todas las métricas
+
+        Returns:
+            dict: {"counters": {...}, "gauges": {...}}
+        """
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges)
+            }
+
+
+# Registro global del proceso
+metrics = MetricsRegistry()
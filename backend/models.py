@@ -3,11 +3,11 @@ Modelos de datos para DeclarationLetterOnline
 Define las estructuras de datos utilizadas en la aplicación
 """
 
-from sqlalchemy import Column, Integer, String, DateTime, Text, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, Text, Boolean, LargeBinary, Float
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
 from pydantic import BaseModel
-from typing import Optional
+from typing import Optional, List, Dict
 
 Base = declarative_base()
 
@@ -25,7 +25,7 @@ class Document(Base):
     original_filename = Column(String(255), nullable=False)
     upload_date = Column(DateTime, default=datetime.utcnow)
     processed_date = Column(DateTime, nullable=True)
-    status = Column(String(50), default="uploaded")  # uploaded, processing, completed, error
+    status = Column(String(50), default="uploaded")  # uploaded, queued, processing, completed, error, cancelled
     generated_filename = Column(String(255), nullable=True)
     markdown_content = Column(Text, nullable=True)
     error_message = Column(Text, nullable=True)
@@ -58,6 +58,179 @@ class ProcessingLog(Base):
         return f"<ProcessingLog(id={self.id}, document_id={self.document_id}, action={self.action})>"
 
 
+class GenerationEvent(Base):
+    """
+    Modelo para los eventos SSE de una generación que se vacían de memoria
+    (permite reenviarlos a un cliente que reconecta con Last-Event-ID)
+    """
+    __tablename__ = "generation_events"
+    
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    generation_id = Column(String(64), nullable=False, index=True)
+    seq = Column(Integer, nullable=False)
+    payload = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"<GenerationEvent(generation_id={self.generation_id}, seq={self.seq})>"
+
+
+class GenerationCacheEntry(Base):
+    """
+    Modelo para la caché de resultados de generación
+    (clave: hash del texto de entrada, versión de los prompts, modelo y configuración)
+    """
+    __tablename__ = "generation_cache"
+    
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    cache_key = Column(String(64), nullable=False, unique=True, index=True)
+    kind = Column(String(50), nullable=False)  # declaration, cover
+    content = Column(Text, nullable=False)
+    content_size = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_accessed_at = Column(DateTime, default=datetime.utcnow)
+    hit_count = Column(Integer, default=0)
+    
+    def __repr__(self):
+        return f"<GenerationCacheEntry(kind={self.kind}, cache_key={self.cache_key[:12]})>"
+
+
+class ExtractedText(Base):
+    """
+    Modelo para el texto extraído de los archivos subidos
+    (comprimido con zlib, indexado por el SHA-256 del archivo)
+    """
+    __tablename__ = "extracted_texts"
+    
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    file_sha256 = Column(String(64), nullable=False, unique=True, index=True)
+    text_sha256 = Column(String(64), nullable=False)
+    text_compressed = Column(LargeBinary, nullable=False)
+    text_length = Column(Integer, nullable=False)
+    extraction_seconds = Column(Float, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"<ExtractedText(file_sha256={self.file_sha256[:12]}, text_length={self.text_length})>"
+
+
+class CaseFacts(Base):
+    """
+    Modelo para los hechos del caso extraídos del cuestionario de un documento
+    (JSON compacto que las generaciones y el chat usan en lugar del cuestionario)
+    """
+    __tablename__ = "case_facts"
+    
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    document_id = Column(Integer, nullable=False, unique=True, index=True)
+    source_sha256 = Column(String(64), nullable=False)  # cuestionario normalizado del que se extrajeron
+    fingerprint = Column(String(64), nullable=False)  # modelo, configuración y prompt de extracción
+    facts_json = Column(Text, nullable=False)
+    source_length = Column(Integer, nullable=False)
+    facts_length = Column(Integer, nullable=False)
+    extraction_seconds = Column(Float, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"<CaseFacts(document_id={self.document_id}, facts_length={self.facts_length})>"
+
+
+class OCRPageCache(Base):
+    """
+    Modelo para el texto reconocido por OCR, indexado por el SHA-256 de la imagen
+    (una página escaneada nunca se reconoce dos veces)
+    """
+    __tablename__ = "ocr_page_cache"
+    
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    image_sha256 = Column(String(64), nullable=False, unique=True, index=True)
+    text = Column(Text, nullable=False)
+    ocr_seconds = Column(Float, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"<OCRPageCache(image_sha256={self.image_sha256[:12]})>"
+
+
+class ProcessingBatch(Base):
+    """
+    Modelo para un lote de documentos subidos y procesados juntos
+    """
+    __tablename__ = "processing_batches"
+    
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    batch_id = Column(String(32), nullable=False, unique=True, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    document_count = Column(Integer, nullable=False)
+    
+    def __repr__(self):
+        return f"<ProcessingBatch(batch_id={self.batch_id}, document_count={self.document_count})>"
+
+
+class BatchItem(Base):
+    """
+    Modelo para la relación entre un lote y sus documentos
+    """
+    __tablename__ = "batch_items"
+    
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    batch_id = Column(String(32), nullable=False, index=True)
+    document_id = Column(Integer, nullable=False)
+    position = Column(Integer, nullable=False)
+    
+    def __repr__(self):
+        return f"<BatchItem(batch_id={self.batch_id}, document_id={self.document_id})>"
+
+
+class GenerationJob(Base):
+    """
+    Modelo para un trabajo de generación en la cola persistente
+    (sobrevive a reinicios del servidor y a clientes que se desconectan)
+    """
+    __tablename__ = "generation_jobs"
+
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    kind = Column(String(50), nullable=False)  # declaration, cover
+    document_id = Column(Integer, nullable=False, index=True)
+    source = Column(String(50), default="interactive")  # interactive, batch, recovery
+    priority = Column(Integer, default=0)  # menor número = se toma antes
+    use_cache = Column(Boolean, default=True)
+    status = Column(String(50), default="queued", index=True)  # queued, running, completed, failed
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer, default=3)
+    available_at = Column(DateTime, default=datetime.utcnow)  # no se toma antes (reintentos con espera)
+    lease_owner = Column(String(64), nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+    generation_id = Column(String(64), nullable=True)  # generación del intento actual
+    result = Column(Text, nullable=True)  # evento final ('complete' o 'error') en JSON
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<GenerationJob(id={self.id}, kind={self.kind}, document_id={self.document_id}, status={self.status})>"
+
+
+class GenerationPipeline(Base):
+    """
+    Modelo para una cadena declaration letter -> cover letter resuelta en el
+    servidor: al completarse el trabajo de la declaration se encola el del
+    cover letter, sin depender del navegador
+    """
+    __tablename__ = "generation_pipelines"
+
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    document_id = Column(Integer, nullable=False, index=True)
+    declaration_job_id = Column(Integer, nullable=False, index=True)
+    cover_job_id = Column(Integer, nullable=True, index=True)
+    status = Column(String(50), default="declaration", index=True)  # declaration, cover, completed, failed
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<GenerationPipeline(id={self.id}, document_id={self.document_id}, status={self.status})>"
+
+
 # ==================== MODELOS Pydantic (API) ====================
 
 class DocumentUploadResponse(BaseModel):
@@ -70,6 +243,56 @@ class DocumentUploadResponse(BaseModel):
     filename: Optional[str] = None
 
 
+class BatchDocumentInfo(BaseModel):
+    """
+    Documento dentro de un lote
+    """
+    document_id: int
+    filename: str
+    status: str
+    error_message: Optional[str] = None
+
+
+class BatchUploadResponse(BaseModel):
+    """
+    Respuesta al subir un lote de documentos
+    """
+    success: bool
+    message: str
+    batch_id: Optional[str] = None
+    documents: List[BatchDocumentInfo] = []
+    errors: List[str] = []
+
+
+class BatchStatusResponse(BaseModel):
+    """
+    Progreso agregado de un lote
+    """
+    batch_id: str
+    total: int
+    counts: Dict[str, int]
+    finished: bool
+    documents: List[BatchDocumentInfo]
+
+
+class JobStatusResponse(BaseModel):
+    """
+    Estado de un trabajo de generación en la cola
+    """
+    job_id: int
+    kind: str
+    document_id: int
+    status: str
+    attempts: int
+    max_attempts: int
+    queue_position: Optional[int] = None
+    error: Optional[str] = None
+    created_at: str
+    updated_at: str
+    stream_url: str
+    pipeline_id: Optional[int] = None  # cadena declaration -> cover letter, si se pidió
+
+
 class DocumentProcessResponse(BaseModel):
     """
     Respuesta al procesar un documento
@@ -0,0 +1,248 @@
+"""
+OCR local (Tesseract) para cuestionarios escaneados o fotografiados
+Reconoce en paralelo, en el pool de procesos de extracción, las imágenes de
+páginas escaneadas de PDF, de DOCX sin texto y de subidas PNG/JPG. El texto se
+guarda por SHA-256 de la imagen, así que volver a procesar nunca repite el OCR
+"""
+
+import hashlib
+import time
+import zipfile
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional, Tuple
+
+from backend.database import DatabaseManager, OCRPageCacheRepository
+from backend.metrics import metrics
+from backend.process_pool import LazyProcessPool
+
+
+# Extensiones de imagen que se procesan directamente con OCR
+IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp']
+
+
+def _ocr_image(image_data: bytes, languages: str) -> Tuple[str, float]:
+    """
+    Reconoce el texto de una imagen (se ejecuta en un proceso del pool)
+
+    Args:
+        image_data: Bytes de la imagen
+        languages: Idiomas de Tesseract (p. ej. 'spa+eng')
+
+    Returns:
+        Tuple[str, float]: (texto reconocido, segundos)
+    """
+    import io
+    import pytesseract
+    from PIL import Image
+
+    start_time = time.time()
+    with Image.open(io.BytesIO(image_data)) as image:
+        text = pytesseract.image_to_string(image, lang=languages)
+    return text, time.time() - start_time
+
+
+class LocalOCR:
+    """
+    Motor de OCR local con caché por imagen
+    """
+
+    def __init__(
+        self,
+        db_manager: DatabaseManager,
+        process_pool: LazyProcessPool,
+        languages: str = "spa+eng",
+        image_timeout_seconds: float = 60,
+        min_page_chars: int = 20
+    ):
+        """
+        Inicializa el motor y verifica que Tesseract esté instalado
+
+        Args:
+            db_manager: Gestor de base de datos para la caché
+            process_pool: Pool de procesos compartido con la extracción de PDF
+            languages: Idiomas de Tesseract separados por '+'
+            image_timeout_seconds: Tiempo máximo de OCR por imagen
+            min_page_chars: Páginas con menos caracteres se consideran escaneadas
+        """
+        self.db_manager = db_manager
+        self.process_pool = process_pool
+        self.image_timeout_seconds = image_timeout_seconds
+        self.min_page_chars = min_page_chars
+        self.languages = languages
+        self.available = False
+
+        try:
+            import pytesseract
+            from PIL import Image
+
+            installed = set(pytesseract.get_languages(config=""))
+            wanted = [language for language in languages.split("+") if language in installed]
+            if not wanted:
+                wanted = ["eng"] if "eng" in installed else sorted(installed)[:1]
+            self.languages = "+".join(wanted)
+            self.available = bool(self.languages)
+            print(f"OCR local disponible (Tesseract {pytesseract.get_tesseract_version()}, idiomas: {self.languages})")
+        except ImportError:
+            print("Advertencia: pytesseract/Pillow no disponibles, OCR desactivado")
+        except Exception as e:
+            print(f"Advertencia: Tesseract no disponible, OCR desactivado: {e}")
+
+    def recognize(self, images: List[bytes]) -> List[str]:
+        """
+        Reconoce el texto de varias imágenes en paralelo, usando la caché
+
+        Args:
+            images: Bytes de cada imagen
+
+        Returns:
+            List[str]: Texto de cada imagen, en el mismo orden
+        """
+        hashes = [hashlib.sha256(image).hexdigest() for image in images]
+        texts = self._load_cached(hashes)
+        metrics.increment("ocr_cache_hits", sum(1 for image_hash in hashes if image_hash in texts))
+
+        # Una imagen repetida (p. ej. el mismo logo en cada página) se reconoce una vez
+        pending = {}
+        for image_hash, image in zip(hashes, images):
+            if image_hash not in texts and image_hash not in pending:
+                pending[image_hash] = image
+
+        if pending:
+            texts.update(self._recognize_uncached(pending))
+
+        return [texts.get(image_hash, "") for image_hash in hashes]
+
+    def recognize_pages(self, page_images: Dict[int, List[bytes]]) -> Dict[int, str]:
+        """
+        Reconoce el texto de las imágenes de varias páginas
+
+        Args:
+            page_images: {número de página: [imágenes de la página]}
+
+        Returns:
+            dict: {número de página: texto reconocido}
+        """
+        flat = [(page_number, image) for page_number, images in page_images.items() for image in images]
+        texts = self.recognize([image for _, image in flat])
+
+        page_texts: Dict[int, List[str]] = {}
+        for (page_number, _), text in zip(flat, texts):
+            page_texts.setdefault(page_number, []).append(text.strip())
+        return {page_number: '\n'.join(t for t in parts if t) for page_number, parts in page_texts.items()}
+
+    def pdf_page_images(self, file_path: str, page_numbers: List[int]) -> Dict[int, List[bytes]]:
+        """
+        Obtiene las imágenes incrustadas en páginas de un PDF
+
+        Args:
+            file_path: Ruta al PDF
+            page_numbers: Páginas a revisar (índice desde 0)
+
+        Returns:
+            dict: {número de página: [imágenes]} solo para las páginas con imágenes
+        """
+        import PyPDF2
+
+        page_images = {}
+        with open(file_path, 'rb') as f:
+            pdf_reader = PyPDF2.PdfReader(f)
+            for page_number in page_numbers:
+                try:
+                    images = [image.data for image in pdf_reader.pages[page_number].images]
+                except Exception as e:
+                    print(f"Error al leer las imágenes de la página {page_number + 1}: {e}")
+                    continue
+                if images:
+                    page_images[page_number] = images
+        return page_images
+
+    def docx_images(self, file_path: str) -> List[bytes]:
+        """
+        Obtiene las imágenes incrustadas en un DOCX, en orden
+
+        Args:
+            file_path: Ruta al DOCX
+
+        Returns:
+            List[bytes]: Imágenes de word/media
+        """
+        try:
+            with zipfile.ZipFile(file_path, 'r') as docx:
+                names = sorted(name for name in docx.namelist() if name.startswith('word/media/'))
+                return [docx.read(name) for name in names]
+        except Exception as e:
+            print(f"Error al leer las imágenes del DOCX: {e}")
+            return []
+
+    def _recognize_uncached(self, pending: Dict[str, bytes], resubmit_broken: bool = True) -> Dict[str, str]:
+        """
+        Reconoce en el pool las imágenes que no están en caché y guarda los resultados.
+        Las imágenes que estaban en un pool que otra extracción terminó se
+        envían una vez más a un pool nuevo
+        """
+        pool = self.process_pool.get()
+        futures = {
+            image_hash: pool.submit(_ocr_image, image, self.languages)
+            for image_hash, image in pending.items()
+        }
+
+        texts = {}
+        broken = {}
+        deadline = time.time()
+        timed_out = False
+        for image_hash, future in futures.items():
+            deadline = max(deadline, time.time()) + self.image_timeout_seconds
+            try:
+                text, ocr_seconds = future.result(timeout=max(0, deadline - time.time()))
+            except FutureTimeoutError:
+                timed_out = True
+                metrics.increment("ocr_timeouts")
+                print(f"OCR de la imagen {image_hash[:12]} excedió {self.image_timeout_seconds}s, se omite")
+                continue
+            except BrokenProcessPool:
+                if resubmit_broken:
+                    broken[image_hash] = pending[image_hash]
+                else:
+                    print(f"OCR de la imagen {image_hash[:12]} interrumpido, se omite")
+                continue
+            except Exception as e:
+                print(f"Error de OCR en la imagen {image_hash[:12]}: {e}")
+                continue
+
+            metrics.increment("ocr_images_recognized")
+            texts[image_hash] = text
+            self._save_cached(image_hash, text, ocr_seconds)
+
+        if timed_out:
+            # Un proceso atascado en una imagen no debe bloquear el OCR siguiente
+            self.process_pool.discard(pool, futures.values())
+        if broken:
+            print(f"OCR: {len(broken)} imágenes interrumpidas por un pool descartado, se reenvían")
+            texts.update(self._recognize_uncached(broken, resubmit_broken=False))
+        return texts
+
+    def _load_cached(self, hashes: List[str]) -> Dict[str, str]:
+        """
+        Lee de SQLite el texto ya reconocido
+        """
+        db = self.db_manager.get_session()
+        try:
+            return OCRPageCacheRepository(db).get_texts(list(set(hashes)))
+        except Exception as e:
+            print(f"Error al leer la caché de OCR: {e}")
+            return {}
+        finally:
+            db.close()
+
+    def _save_cached(self, image_hash: str, text: str, ocr_seconds: Optional[float]):
+        """
+        Guarda en SQLite el texto reconocido de una imagen
+        """
+        db = self.db_manager.get_session()
+        try:
+            OCRPageCacheRepository(db).save_text(image_hash, text, ocr_seconds)
+        except Exception as e:
+            print(f"Error al guardar en la caché de OCR: {e}")
+        finally:
+            db.close()
@@ -0,0 +1,185 @@
+"""
+Extracción de texto de PDF por páginas en paralelo
+Reparte las páginas de un PDF en bloques entre procesos para que la extracción
+de paquetes de cuestionarios de 100+ páginas escale con los núcleos disponibles
+"""
+
+import math
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional, Tuple
+
+from backend.metrics import metrics
+from backend.process_pool import LazyProcessPool
+
+
+# (número de página, texto, segundos; None si la página excedió el tiempo máximo)
+PageResult = Tuple[int, str, Optional[float]]
+
+
+def _extract_page_range(file_path: str, first_page: int, last_page: int) -> List[PageResult]:
+    """
+    Extrae el texto de un rango de páginas (se ejecuta en un proceso del pool)
+
+    Args:
+        file_path: Ruta al PDF
+        first_page: Primera página (índice desde 0, incluida)
+        last_page: Última página (excluida)
+
+    Returns:
+        List[PageResult]: Texto y tiempo de cada página, en orden
+    """
+    import PyPDF2
+
+    results = []
+    with open(file_path, 'rb') as f:
+        pdf_reader = PyPDF2.PdfReader(f)
+        for page_number in range(first_page, last_page):
+            start_time = time.time()
+            try:
+                text = pdf_reader.pages[page_number].extract_text() or ""
+            except Exception as e:
+                print(f"Error al extraer la página {page_number + 1}: {e}")
+                text = ""
+            results.append((page_number, text, time.time() - start_time))
+    return results
+
+
+class PDFTextExtractor:
+    """
+    Extractor de texto de PDF que reparte las páginas en un pool de procesos
+    """
+
+    def __init__(
+        self,
+        process_pool: LazyProcessPool,
+        page_timeout_seconds: float = 30,
+        parallel_min_pages: int = 8,
+        ocr=None
+    ):
+        """
+        Inicializa el extractor
+
+        Args:
+            process_pool: Pool de procesos (se crea con el primer PDF grande)
+            page_timeout_seconds: Tiempo máximo por página antes de descartarla
+            parallel_min_pages: PDFs con menos páginas se extraen en el mismo hilo
+            ocr: LocalOCR para las páginas escaneadas (opcional)
+        """
+        self.process_pool = process_pool
+        self.page_timeout_seconds = page_timeout_seconds
+        self.parallel_min_pages = parallel_min_pages
+        self.ocr = ocr
+
+    def extract(self, file_path: str) -> Optional[str]:
+        """
+        Extrae el texto de un PDF conservando el orden de las páginas
+
+        Args:
+            file_path: Ruta al PDF
+
+        Returns:
+            str: Texto extraído
+        """
+        pages = self.extract_pages(file_path)
+        if self.ocr and self.ocr.available:
+            pages = self._ocr_scanned_pages(file_path, pages)
+        return '\n'.join(text for _, text, _ in pages)
+
+    def extract_pages(self, file_path: str) -> List[PageResult]:
+        """
+        Extrae el texto de cada página con su tiempo de extracción
+
+        Args:
+            file_path: Ruta al PDF
+
+        Returns:
+            List[PageResult]: (página, texto, segundos) en orden; las páginas que
+            exceden el tiempo máximo quedan vacías con tiempo None
+        """
+        import PyPDF2
+
+        with open(file_path, 'rb') as f:
+            page_count = len(PyPDF2.PdfReader(f).pages)
+
+        start_time = time.time()
+        if page_count < self.parallel_min_pages or self.process_pool.max_workers < 2:
+            pages = _extract_page_range(file_path, 0, page_count)
+        else:
+            pages = self._extract_parallel(file_path, page_count)
+        elapsed_time = time.time() - start_time
+
+        metrics.increment("pdf_pages_extracted", page_count)
+        self._report(pages, elapsed_time)
+        return pages
+
+    def _extract_parallel(self, file_path: str, page_count: int) -> List[PageResult]:
+        """
+        Reparte las páginas en bloques contiguos entre los procesos del pool
+        """
+        # Varios bloques por proceso para equilibrar páginas lentas (escaneadas, con tablas)
+        pages_per_task = max(1, math.ceil(page_count / (self.process_pool.max_workers * 4)))
+        pool = self.process_pool.get()
+
+        tasks = []
+        for first_page in range(0, page_count, pages_per_task):
+            last_page = min(first_page + pages_per_task, page_count)
+            future = pool.submit(_extract_page_range, file_path, first_page, last_page)
+            tasks.append((first_page, last_page, future))
+
+        pages: List[PageResult] = []
+        deadline = time.time()
+        timed_out = False
+        for first_page, last_page, future in tasks:
+            # Cada bloque dispone del tiempo máximo de sus páginas, contado desde que termina el anterior
+            deadline = max(deadline, time.time()) + self.page_timeout_seconds * (last_page - first_page)
+            try:
+                pages.extend(future.result(timeout=max(0, deadline - time.time())))
+            except FutureTimeoutError:
+                timed_out = True
+                metrics.increment("pdf_page_timeouts", last_page - first_page)
+                print(f"Páginas {first_page + 1}-{last_page} excedieron {self.page_timeout_seconds}s por página, se omiten")
+                pages.extend((page_number, "", None) for page_number in range(first_page, last_page))
+            except BrokenProcessPool:
+                # Otra extracción descartó el pool: se extrae el bloque en este hilo
+                pages.extend(_extract_page_range(file_path, first_page, last_page))
+
+        if timed_out:
+            # Un proceso atascado en una página no debe bloquear las extracciones siguientes
+            self.process_pool.discard(pool, [future for _, _, future in tasks])
+        return pages
+
+    def _ocr_scanned_pages(self, file_path: str, pages: List[PageResult]) -> List[PageResult]:
+        """
+        Reemplaza el texto de las páginas sin texto (escaneadas) por el reconocido con OCR
+        """
+        # Las páginas que excedieron el tiempo máximo no se vuelven a abrir
+        scanned = [
+            page_number for page_number, text, seconds in pages
+            if seconds is not None and len(text.strip()) < self.ocr.min_page_chars
+        ]
+        if not scanned:
+            return pages
+
+        page_images = self.ocr.pdf_page_images(file_path, scanned)
+        if not page_images:
+            return pages
+
+        ocr_texts = self.ocr.recognize_pages(page_images)
+        print(f"OCR aplicado a {len(ocr_texts)} páginas escaneadas")
+        return [
+            (page_number, ocr_texts.get(page_number) or text, seconds)
+            for page_number, text, seconds in pages
+        ]
+
+    def _report(self, pages: List[PageResult], elapsed_time: float):
+        """
+        Muestra el tiempo total y las páginas más lentas
+        """
+        timed = [page for page in pages if page[2] is not None]
+        print(f"PDF extraído: {len(pages)} páginas en {elapsed_time:.2f} segundos")
+        slowest = sorted(timed, key=lambda page: page[2], reverse=True)[:3]
+        if slowest and len(pages) > 1:
+            summary = ", ".join(f"p{page_number + 1}={seconds:.2f}s" for page_number, _, seconds in slowest)
+            print(f"Páginas más lentas: {summary}")
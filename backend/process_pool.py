@@ -0,0 +1,104 @@
+"""
+Pool de procesos compartido para el trabajo de CPU de la extracción de texto
+(páginas de PDF y OCR), creado bajo demanda
+"""
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing.process import BaseProcess
+from typing import Iterable, List, Optional
+
+
+class LazyProcessPool:
+    """
+    ProcessPoolExecutor que se crea con la primera tarea y se puede descartar
+    si alguno de sus procesos queda atascado
+    """
+
+    def __init__(self, max_workers: Optional[int] = None):
+        """
+        Inicializa el pool (sin crear procesos todavía)
+
+        Args:
+            max_workers: Número de procesos (default: número de núcleos)
+        """
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def get(self) -> ProcessPoolExecutor:
+        """
+        Obtiene el pool de procesos, creándolo si hace falta (o si un proceso murió y lo rompió)
+
+        Returns:
+            ProcessPoolExecutor: Pool activo
+        """
+        with self._lock:
+            if self._pool is None or getattr(self._pool, "_broken", False):
+                # spawn: el servidor tiene hilos en curso y fork podría heredar locks tomados
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._pool
+
+    def discard(self, pool: ProcessPoolExecutor, futures: Iterable[Future] = ()):
+        """
+        Descarta un pool con procesos atascados; la próxima tarea crea uno
+        nuevo. Sus procesos se terminan en cuanto no quedan tareas de otras
+        extracciones en él (terminarlos antes las haría fallar con BrokenProcessPool)
+
+        Args:
+            pool: Pool obtenido con get()
+            futures: Tareas de quien descarta el pool (las que no empezaron se cancelan)
+        """
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+
+        own = set(futures)
+        for future in own:
+            future.cancel()
+        others = [
+            item.future for item in list((getattr(pool, "_pending_work_items", None) or {}).values())
+            if item.future not in own and not item.future.done()
+        ]
+        # shutdown() olvida los procesos del pool: se guardan antes para poder terminarlos
+        processes = list((getattr(pool, "_processes", None) or {}).values())
+        pool.shutdown(wait=False)
+        if not others:
+            _terminate(processes)
+            return
+
+        print(f"Pool de procesos descartado: se termina cuando acaben {len(others)} tareas de otras extracciones")
+        remaining = [len(others)]
+        remaining_lock = threading.Lock()
+
+        def task_done(_future: Future):
+            with remaining_lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                _terminate(processes)
+
+        for future in others:
+            future.add_done_callback(task_done)
+
+    def shutdown(self):
+        """
+        Detiene el pool de procesos
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _terminate(processes: List[BaseProcess]):
+    """
+    Termina los procesos de un pool descartado (los atascados no terminan solos)
+    """
+    for process in processes:
+        process.terminate()
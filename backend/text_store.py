@@ -0,0 +1,145 @@
+"""
+Almacén del texto extraído de los cuestionarios subidos
+La extracción (PDF/DOCX) se hace una sola vez por contenido de archivo: el texto
+se guarda comprimido en SQLite indexado por el SHA-256 del archivo, y solo se
+vuelve a extraer si el archivo cambia
+"""
+
+import hashlib
+import threading
+import time
+import zlib
+from typing import Callable, List, Optional
+
+from backend.database import DatabaseManager, ExtractedTextRepository
+from backend.metrics import metrics
+
+
+# Tamaño de bloque para calcular el hash de los archivos
+_HASH_CHUNK_BYTES = 1024 * 1024
+
+# Locks de extracción compartidos por hash (cantidad fija, no crece con los archivos)
+_LOCK_STRIPES = 64
+
+
+def file_sha256(file_path: str) -> str:
+    """
+    Calcula el SHA-256 de un archivo leyéndolo por bloques
+
+    Args:
+        file_path: Ruta al archivo
+
+    Returns:
+        str: Hash en hexadecimal
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(_HASH_CHUNK_BYTES), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ExtractedTextStore:
+    """
+    Texto extraído de los archivos, persistido y compartido entre solicitudes
+    """
+
+    def __init__(self, db_manager: DatabaseManager):
+        """
+        Inicializa el almacén
+
+        Args:
+            db_manager: Gestor de base de datos
+        """
+        self.db_manager = db_manager
+        self._locks: List[threading.Lock] = [threading.Lock() for _ in range(_LOCK_STRIPES)]
+
+    def get_or_extract(
+        self,
+        file_path: str,
+        extractor: Callable[[str], Optional[str]],
+        file_hash: Optional[str] = None
+    ) -> Optional[str]:
+        """
+        Devuelve el texto guardado para el archivo o lo extrae y lo guarda
+
+        Es bloqueante: se llama desde un hilo (tarea en segundo plano de la
+        subida o asyncio.to_thread al procesar). Si dos solicitudes piden el
+        mismo archivo a la vez, la segunda espera a la primera en lugar de
+        extraer otra vez.
+
+        Args:
+            file_path: Ruta al archivo
+            extractor: Función que extrae el texto (AIProcessor.extract_text_from_file)
+            file_hash: SHA-256 del archivo si ya se conoce
+
+        Returns:
+            str: Texto extraído o None si no se pudo extraer
+        """
+        file_hash = file_hash or file_sha256(file_path)
+
+        with self._lock_for(file_hash):
+            text = self._load(file_hash)
+            if text is not None:
+                metrics.increment("extracted_text_hits")
+                return text
+
+            metrics.increment("extracted_text_misses")
+            start_time = time.time()
+            text = extractor(file_path)
+            elapsed_time = time.time() - start_time
+
+            # Un resultado vacío no se guarda: puede deberse a una dependencia faltante
+            if text and text.strip():
+                self._save(file_hash, text, elapsed_time)
+                print(f"Texto extraído en {elapsed_time:.2f} segundos ({len(text)} caracteres)")
+            return text
+
+    def _lock_for(self, file_hash: str) -> threading.Lock:
+        """
+        Obtiene el lock de extracción de un archivo (archivos distintos pueden
+        compartirlo; lo importante es que el mismo archivo use siempre el mismo)
+        """
+        return self._locks[int(file_hash[:8], 16) % len(self._locks)]
+
+    def _load(self, file_hash: str) -> Optional[str]:
+        """
+        Lee y descomprime el texto guardado, verificando su hash
+        """
+        db = self.db_manager.get_session()
+        try:
+            repository = ExtractedTextRepository(db)
+            extracted = repository.get_by_file_hash(file_hash)
+            if not extracted:
+                return None
+
+            text = zlib.decompress(extracted.text_compressed).decode('utf-8')
+            if hashlib.sha256(text.encode('utf-8')).hexdigest() != extracted.text_sha256:
+                print(f"Texto guardado corrupto para el archivo {file_hash[:12]}, se extraerá de nuevo")
+                repository.delete_by_file_hash(file_hash)
+                return None
+            return text
+        except Exception as e:
+            print(f"Error al leer el texto extraído guardado: {e}")
+            return None
+        finally:
+            db.close()
+
+    def _save(self, file_hash: str, text: str, extraction_seconds: float):
+        """
+        Comprime y guarda el texto extraído
+        """
+        encoded = text.encode('utf-8')
+        db = self.db_manager.get_session()
+        try:
+            ExtractedTextRepository(db).save_text(
+                file_sha256=file_hash,
+                text_sha256=hashlib.sha256(encoded).hexdigest(),
+                text_compressed=zlib.compress(encoded),
+                text_length=len(text),
+                extraction_seconds=extraction_seconds
+            )
+        except Exception as e:
+            print(f"Error al guardar el texto extraído: {e}")
+        finally:
+            db.close()
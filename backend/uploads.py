@@ -0,0 +1,239 @@
+"""
+Recepción y almacenamiento de archivos subidos
+Copia el archivo por bloques a un temporal, calcula el SHA-256 mientras escribe,
+corta en cuanto se supera el tamaño máximo y lo mueve de forma atómica a la
+carpeta de subidas. La memoria usada por subida no depende del tamaño del archivo.
+
+Los archivos se guardan por contenido (<sha256><extensión>): subir el mismo
+cuestionario varias veces comparte un único archivo, y su texto extraído.
+Las referencias son las filas de Document que usan el archivo; los que ya
+no tienen referencias se eliminan en la recolección periódica.
+"""
+
+import hashlib
+import json
+import os
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import aiofiles
+import aiofiles.os
+from fastapi import UploadFile
+
+from backend.database import DatabaseManager, DocumentRepository, ExtractedTextRepository
+from backend.metrics import metrics
+
+
+# Tamaño de bloque al copiar el archivo subido
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+# Margen para los encabezados multipart al limitar el tamaño del cuerpo
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+# Prefijo de los archivos temporales de subidas en curso
+TEMP_UPLOAD_PREFIX = ".upload-"
+
+
+class UploadTooLarge(Exception):
+    """
+    Se lanza cuando el archivo subido excede el tamaño máximo
+    """
+    pass
+
+
+def upload_file_hash(path: Path) -> Optional[str]:
+    """
+    Obtiene el SHA-256 de un archivo subido a partir de su nombre
+
+    Args:
+        path: Ruta al archivo en la carpeta de subidas
+
+    Returns:
+        str: Hash en hexadecimal, o None si el nombre no es un hash (subidas anteriores a
+            guardar por contenido y temporales)
+    """
+    if path.name.startswith(TEMP_UPLOAD_PREFIX) or len(path.stem) != 64:
+        return None
+    return path.stem
+
+
+async def save_upload(upload: UploadFile, folder: Path, max_bytes: int) -> Tuple[str, int, str]:
+    """
+    Guarda un archivo subido en la carpeta de subidas, con su hash como nombre;
+    si ya existe un archivo con el mismo contenido se reutiliza
+
+    Args:
+        upload: Archivo recibido por FastAPI
+        folder: Carpeta de destino
+        max_bytes: Tamaño máximo permitido
+
+    Returns:
+        Tuple[str, int, str]: (nombre del archivo guardado, tamaño, SHA-256)
+
+    Raises:
+        UploadTooLarge: Si el archivo excede max_bytes (no queda nada escrito)
+    """
+    file_extension = Path(upload.filename or "").suffix
+    temp_path = folder / f"{TEMP_UPLOAD_PREFIX}{uuid.uuid4().hex}.part"
+    digest = hashlib.sha256()
+    file_size = 0
+
+    try:
+        async with aiofiles.open(temp_path, 'wb') as f:
+            while True:
+                chunk = await upload.read(UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                file_size += len(chunk)
+                if file_size > max_bytes:
+                    raise UploadTooLarge(f"El archivo excede el tamaño máximo de {max_bytes} bytes")
+                digest.update(chunk)
+                await f.write(chunk)
+
+        file_hash = digest.hexdigest()
+        stored_filename = f"{file_hash}{file_extension.lower()}"
+        stored_path = folder / stored_filename
+
+        try:
+            # Mismo contenido ya guardado: se comparte el archivo existente. Renovar
+            # la fecha evita que la recolección lo borre antes de registrar el documento
+            os.utime(stored_path)
+            await aiofiles.os.remove(temp_path)
+            metrics.increment("uploads_deduplicated")
+        except FileNotFoundError:
+            await aiofiles.os.replace(temp_path, stored_path)
+        return stored_filename, file_size, file_hash
+
+    except BaseException:
+        try:
+            await aiofiles.os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def collect_unreferenced_uploads(folder: Path, db_manager: DatabaseManager, grace_seconds: float = 3600) -> int:
+    """
+    Elimina los archivos subidos que ya no usa ningún documento, junto con su
+    texto extraído, y los temporales de subidas interrumpidas
+
+    Args:
+        folder: Carpeta de subidas
+        db_manager: Gestor de base de datos
+        grace_seconds: Antigüedad mínima para borrar (protege las subidas en curso)
+
+    Returns:
+        int: Número de archivos eliminados
+    """
+    db = db_manager.get_session()
+    try:
+        referenced = DocumentRepository(db).get_referenced_filenames()
+        text_repo = ExtractedTextRepository(db)
+        cutoff = time.time() - grace_seconds
+        removed = 0
+
+        for path in folder.iterdir():
+            if not path.is_file() or path.name in referenced:
+                continue
+            try:
+                if path.stat().st_mtime > cutoff:
+                    continue
+                path.unlink()
+            except FileNotFoundError:
+                continue
+            removed += 1
+
+            # Los archivos por contenido tienen el SHA-256 como nombre
+            file_hash = upload_file_hash(path)
+            if file_hash:
+                text_repo.delete_by_file_hash(file_hash)
+
+        if removed:
+            metrics.increment("uploads_collected", removed)
+            print(f"Recolección de subidas: {removed} archivos sin referencias eliminados")
+        return removed
+    finally:
+        db.close()
+
+
+class UploadSizeLimitMiddleware:
+    """
+    Middleware ASGI que corta la subida en cuanto el cuerpo supera el máximo,
+    sin esperar a que el navegador termine de enviar el archivo
+    """
+
+    def __init__(self, app, limits: Dict[str, Tuple[int, str]]):
+        """
+        Args:
+            app: Aplicación ASGI
+            limits: {ruta de subida: (tamaño máximo de los archivos, mensaje de error)};
+                al tamaño se le suma el margen multipart
+        """
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope["path"]) if scope["type"] == "http" and scope["method"] == "POST" else None
+        if not limit:
+            await self.app(scope, receive, send)
+            return
+
+        max_bytes, detail = limit
+        max_body_bytes = max_bytes + MULTIPART_OVERHEAD_BYTES
+
+        # Content-Length declarado: se rechaza sin leer el cuerpo
+        headers = dict(scope.get("headers") or [])
+        content_length = headers.get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > max_body_bytes:
+            await self._reject(send, detail)
+            return
+
+        received = 0
+        exceeded = False
+        rejected = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_body_bytes:
+                    exceeded = True
+                    raise UploadTooLarge(detail)
+            return message
+
+        async def limited_send(message):
+            nonlocal rejected
+            # FastAPI convierte el error de lectura del cuerpo en su propio 400:
+            # se reemplaza por el mensaje de tamaño máximo
+            if exceeded:
+                if not rejected:
+                    rejected = True
+                    await self._reject(send, detail)
+                return
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, limited_send)
+        except UploadTooLarge:
+            if not rejected:
+                rejected = True
+                await self._reject(send, detail)
+
+    async def _reject(self, send, detail: str):
+        """
+        Responde 400 con el mismo formato que HTTPException
+        """
+        body = json.dumps({"detail": detail}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 400,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"connection", b"close"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,64 @@
+"""
+Proceso worker de generaciones
+Ejecuta los trabajos de la cola persistente fuera del servidor web, para que
+las llamadas largas a Gemini no compitan con los archivos estáticos ni con
+/health. Comparte la configuración y la base de datos SQLite del servidor web:
+los dos procesos deben correr en la misma máquina (mismo disco). El servidor
+web, con JOB_WORKER_MODE=external, solo encola y retransmite el progreso, que
+el worker guarda en SQLite a medida que se genera.
+
+Limitación: los clientes SSE se conectan al servidor web, así que el worker no
+sabe si alguien sigue una generación. Una generación interactiva que el cliente
+abandona no se cancela (SSE_RESUME_GRACE_SECONDS solo aplica en modo embedded):
+termina y su resultado queda guardado.
+"""
+
+import asyncio
+import signal
+
+from backend import main as app_main
+from backend.job_queue import JobWorker
+
+
+async def run_worker(concurrency: int):
+    """
+    Consume la cola hasta recibir SIGINT o SIGTERM
+
+    Args:
+        concurrency: Trabajos simultáneos de este proceso
+    """
+    # El servidor web sigue las generaciones leyendo sus eventos de SQLite
+    app_main.generation_hub.persist_events = True
+
+    app_main.job_queue.recover()
+    worker = JobWorker(app_main.job_queue, app_main.run_generation_job, concurrency=concurrency)
+    worker.start()
+
+    stop_requested = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stop_requested.set)
+
+    await stop_requested.wait()
+    print("Deteniendo el worker: los trabajos en curso vuelven a la cola")
+    await worker.stop()
+
+
+def main() -> int:
+    """
+    Punto de entrada del worker
+
+    Returns:
+        int: Código de salida
+    """
+    if not app_main.ai_processor:
+        print("Error: el worker necesita la API key de Gemini configurada")
+        return 1
+
+    try:
+        asyncio.run(run_worker(app_main.JOB_WORKERS))
+    finally:
+        app_main.ai_executor.shutdown()
+        app_main.ai_stream_executor.shutdown()
+        app_main.extraction_pool.shutdown()
+    return 0
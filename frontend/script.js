@@ -9,6 +9,10 @@
 
 const API_BASE_URL = window.location.origin;
 
+// Reconexiones automáticas de un stream SSE antes de darlo por perdido.
+// El servidor reenvía los eventos perdidos usando el header Last-Event-ID.
+const MAX_STREAM_RECONNECTS = 5;
+
 // Estado de la aplicación
 const appState = {
     documentsQueue: [],  // Cola de archivos listos para procesar
@@ -138,11 +142,11 @@ function handleMultipleFiles(files) {
         }
         
     // Validar tipo de archivo
-    const validExtensions = ['.docx', '.doc', '.pdf', '.txt'];
+    const validExtensions = ['.docx', '.doc', '.pdf', '.txt', '.png', '.jpg', '.jpeg'];
     const fileExtension = file.name.substring(file.name.lastIndexOf('.')).toLowerCase();
     
         if (!validExtensions.includes(fileExtension)) {
-            showError(`Invalid file type: ${file.name}. Please upload DOCX, PDF or TXT files.`);
+            showError(`Invalid file type: ${file.name}. Please upload DOCX, PDF, TXT or image (PNG, JPG) files.`);
             continue;
     }
     
@@ -319,10 +323,17 @@ async function handleProcessAll() {
     elements.processAllBtn.disabled = true;
     elements.processAllBtn.textContent = 'Processing...';
     
+    // Subir todos los archivos pendientes en un solo lote; el servidor empieza
+    // a generar en paralelo y cada stream se une a la generación de su documento
+    const itemsToUpload = pendingItems.filter(item => item.status === 'pending');
+    if (itemsToUpload.length > 0) {
+        await uploadBatchFromQueue(itemsToUpload);
+    }
+    
     // Procesar cada archivo
     for (const item of pendingItems) {
         if (item.status === 'pending') {
-            // Subir archivo primero
+            // Subir archivo primero (si el lote no lo incluyó)
             await uploadFileFromQueue(item);
         }
         
@@ -369,6 +380,56 @@ async function uploadFileFromQueue(item) {
     }
 }
 
+async function uploadBatchFromQueue(items) {
+    const formData = new FormData();
+    for (const item of items) {
+        formData.append('files', item.file);
+        item.status = 'uploading';
+    }
+    updateQueueUI();
+    
+    try {
+        const response = await fetch(`${API_BASE_URL}/api/batch`, {
+            method: 'POST',
+            body: formData
+        });
+        
+        if (!response.ok) {
+            throw new Error('Batch upload failed');
+        }
+        
+        const data = await response.json();
+        
+        // Los documentos vuelven en el orden enviado, sin los archivos rechazados
+        const documentsByName = {};
+        for (const doc of data.documents) {
+            (documentsByName[doc.filename] = documentsByName[doc.filename] || []).push(doc.document_id);
+        }
+        for (const item of items) {
+            const ids = documentsByName[item.fileName];
+            if (ids && ids.length > 0) {
+                item.documentId = ids.shift();
+                item.status = 'uploaded';
+            } else {
+                item.status = 'error';
+            }
+        }
+        
+        for (const error of data.errors) {
+            showError(error);
+        }
+        
+    } catch (error) {
+        console.error('Batch upload error:', error);
+        // Volver a la subida individual
+        for (const item of items) {
+            item.status = 'pending';
+        }
+    }
+    
+    updateQueueUI();
+}
+
 async function uploadFile(file) {
     const formData = new FormData();
     formData.append('file', file);
@@ -519,8 +580,11 @@ async function processDocumentFromQueue(item) {
 
 async function processDocumentStream(documentId, fileName) {
     return new Promise((resolve, reject) => {
-        const eventSource = new EventSource(`${API_BASE_URL}/api/process/${documentId}/stream`);
+        // pipeline=true: el servidor encola el Cover Letter al terminar la Declaration
+        // y envía los dos por este mismo stream (sigue aunque se cierre la pestaña)
+        const eventSource = new EventSource(`${API_BASE_URL}/api/process/${documentId}/stream?pipeline=true`);
         let fullContent = '';
+        const reconnectState = { attempts: 0 };
         let chunkBuffer = '';
         let isFirstChunk = true;
         
@@ -540,6 +604,7 @@ async function processDocumentStream(documentId, fileName) {
         disableDocumentButtons(documentId);
         
         eventSource.onmessage = function(event) {
+            reconnectState.attempts = 0;
             try {
                 const data = JSON.parse(event.data);
                 
@@ -556,9 +621,15 @@ async function processDocumentStream(documentId, fileName) {
                     // Simular velocidad de escritura (como ChatGPT)
                     simulateTypingEffect(documentId, 'declaration', chunkBuffer);
                     
+                } else if (data.type === 'retry') {
+                    // El intento falló y el servidor lo reintenta: se descarta lo recibido
+                    fullContent = '';
+                    chunkBuffer = '';
+                    isFirstChunk = true;
+                    showLoadingSpinner(documentId);
+                    
                 } else if (data.type === 'complete') {
-                    eventSource.close();
-                    // Limpiar referencia al stream
+                    // El stream sigue abierto: a continuación llega el Cover Letter
                     if (appState.activeStreams[documentId]) {
                         delete appState.activeStreams[documentId].declaration;
                     }
@@ -582,9 +653,9 @@ async function processDocumentStream(documentId, fileName) {
                     // Habilitar botones de Declaration (Download y Regenerate)
                     enableDeclarationButtons(documentId);
                     
-                    // Generar Cover Letter automáticamente después de completar Declaration Letter
+                    // Mostrar el Cover Letter que el servidor genera a continuación en el mismo stream
                     // Esperamos a que se complete el Cover Letter antes de resolver
-                    generateCoverLetterAutomatically(documentId)
+                    generateCoverLetterAutomatically(documentId, eventSource)
                         .then(() => {
                             resolve();
                         })
@@ -616,6 +687,10 @@ async function processDocumentStream(documentId, fileName) {
         };
         
         eventSource.onerror = function(error) {
+            // El navegador reconecta solo y el servidor continúa la misma generación
+            if (isStreamReconnecting(eventSource, reconnectState)) {
+                return;
+            }
             eventSource.close();
             // Limpiar referencia al stream
             if (appState.activeStreams[documentId]) {
@@ -623,11 +698,7 @@ async function processDocumentStream(documentId, fileName) {
             }
             hideLoadingSpinner(documentId);
             enableDeclarationButtons(documentId);
-            if (!fullContent) {
-                reject(new Error('Connection lost'));
-            } else {
-                resolve();  // Si ya hay contenido, considerar exitoso
-            }
+            reject(new Error('Connection lost'));
         };
     });
 }
@@ -905,7 +976,7 @@ function convertMarkdownToHTML(markdownContent) {
 }
 
 // Función para generar Cover Letter automáticamente (sin intervención del usuario)
-async function generateCoverLetterAutomatically(documentId) {
+async function generateCoverLetterAutomatically(documentId, pipelineSource = null) {
     const panel = document.querySelector(`.document-panel[data-document-id="${documentId}"]`);
     if (!panel) return;
     
@@ -920,8 +991,8 @@ async function generateCoverLetterAutomatically(documentId) {
     coverContent.innerHTML = '<p style="color: #6b7280; font-style: italic;">Generating Cover Letter automatically...</p>';
     
     try {
-        // Generar con streaming
-        await generateCoverLetterStream(documentId);
+        // Generar con streaming (o seguir el stream de la cadena, si ya viene del servidor)
+        await generateCoverLetterStream(documentId, pipelineSource);
         
     } catch (error) {
         showError(`Error generating Cover Letter: ${error.message}`);
@@ -1075,8 +1146,9 @@ async function regenerateDocument(documentId) {
 
 async function regenerateDocumentStream(documentId) {
     return new Promise((resolve, reject) => {
-        const eventSource = new EventSource(`${API_BASE_URL}/api/process/${documentId}/stream`);
+        const eventSource = new EventSource(`${API_BASE_URL}/api/process/${documentId}/stream?regenerate=true`);
         let fullContent = '';
+        const reconnectState = { attempts: 0 };
         let chunkBuffer = '';
         let isFirstChunk = true;
         
@@ -1087,6 +1159,7 @@ async function regenerateDocumentStream(documentId) {
         disableDocumentButtons(documentId);
         
         eventSource.onmessage = function(event) {
+            reconnectState.attempts = 0;
             try {
                 const data = JSON.parse(event.data);
                 
@@ -1103,6 +1176,13 @@ async function regenerateDocumentStream(documentId) {
                     // Efecto de escritura gradual
                     simulateTypingEffect(documentId, 'declaration', chunkBuffer);
                     
+                } else if (data.type === 'retry') {
+                    // El intento falló y el servidor lo reintenta: se descarta lo recibido
+                    fullContent = '';
+                    chunkBuffer = '';
+                    isFirstChunk = true;
+                    showLoadingSpinner(documentId);
+                    
                 } else if (data.type === 'complete') {
                     eventSource.close();
                     
@@ -1134,14 +1214,14 @@ async function regenerateDocumentStream(documentId) {
         };
         
         eventSource.onerror = function(error) {
+            // El navegador reconecta solo y el servidor continúa la misma generación
+            if (isStreamReconnecting(eventSource, reconnectState)) {
+                return;
+            }
             eventSource.close();
             hideLoadingSpinner(documentId);
             enableDeclarationButtons(documentId);
-            if (!fullContent) {
-                reject(new Error('Connection lost'));
-        } else {
-                resolve();
-            }
+            reject(new Error('Connection lost'));
         };
     });
 }
@@ -1149,10 +1229,12 @@ async function regenerateDocumentStream(documentId) {
 window.regenerateDocument = regenerateDocument;
 
 
-async function generateCoverLetterStream(documentId) {
+// pipelineSource: stream de /api/process/{id}/stream?pipeline=true que ya entregó la Declaration
+async function generateCoverLetterStream(documentId, pipelineSource = null) {
     return new Promise((resolve, reject) => {
-        const eventSource = new EventSource(`${API_BASE_URL}/api/generate-cover-letter/${documentId}/stream`);
+        const eventSource = pipelineSource || new EventSource(`${API_BASE_URL}/api/generate-cover-letter/${documentId}/stream`);
         let fullContent = '';
+        const reconnectState = { attempts: 0 };
         let chunkBuffer = '';
         let isFirstChunk = true;
         
@@ -1175,6 +1257,7 @@ async function generateCoverLetterStream(documentId) {
         }
         
         eventSource.onmessage = function(event) {
+            reconnectState.attempts = 0;
             try {
                 const data = JSON.parse(event.data);
                 
@@ -1191,6 +1274,12 @@ async function generateCoverLetterStream(documentId) {
                     // Efecto de escritura gradual para Cover Letter
                     simulateTypingEffectCover(documentId, chunkBuffer);
                     
+                } else if (data.type === 'retry') {
+                    // El intento falló y el servidor lo reintenta: se descarta lo recibido
+                    fullContent = '';
+                    chunkBuffer = '';
+                    isFirstChunk = true;
+                    
                 } else if (data.type === 'complete') {
                     eventSource.close();
                     // Limpiar referencia al stream
@@ -1230,20 +1319,33 @@ async function generateCoverLetterStream(documentId) {
         };
         
         eventSource.onerror = function(error) {
+            // El navegador reconecta solo y el servidor continúa la misma generación
+            if (isStreamReconnecting(eventSource, reconnectState)) {
+                return;
+            }
             eventSource.close();
             // Limpiar referencia al stream
             if (appState.activeStreams[documentId]) {
                 delete appState.activeStreams[documentId].cover;
             }
-            if (!fullContent) {
-                reject(new Error('Connection lost'));
-            } else {
-                resolve();
-            }
+            reject(new Error('Connection lost'));
         };
     });
 }
 
+// Indica si el EventSource se está reconectando por su cuenta (y cuenta el intento)
+function isStreamReconnecting(eventSource, reconnectState) {
+    if (eventSource.readyState !== EventSource.CONNECTING) {
+        return false;
+    }
+    if (reconnectState.attempts >= MAX_STREAM_RECONNECTS) {
+        return false;
+    }
+    reconnectState.attempts++;
+    console.warn(`Stream interrupted, reconnecting (${reconnectState.attempts}/${MAX_STREAM_RECONNECTS})...`);
+    return true;
+}
+
 // Typing effect para Cover Letter con auto-scroll
 let typingIntervalsCover = {};
 
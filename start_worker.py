@@ -0,0 +1,45 @@
+"""
+Script de inicio del worker de generaciones para DeclarationLetterOnline
+Ejecuta los trabajos de la cola fuera del servidor web. Se usa junto con
+JOB_WORKER_MODE=external en el servidor (python start_server.py), en la misma
+máquina y con la misma base de datos.
+"""
+
+import os
+import sys
+from pathlib import Path
+
+# Añadir el directorio raíz al path
+sys.path.insert(0, str(Path(__file__).parent))
+
+def main():
+    """
+    Inicia el worker de generaciones
+    """
+    print("\n" + "="*70)
+    print("  DeclarationLetterOnline - Worker de generaciones")
+    print("="*70 + "\n")
+    
+    # Cargar variables de entorno SOLO en desarrollo local (no en Render)
+    from dotenv import load_dotenv
+    is_render = os.getenv("RENDER", "false").lower() == "true"
+    if not is_render:
+        load_dotenv()
+        print("Cargando variables de entorno desde .env (modo local)")
+    else:
+        print("Usando variables de entorno de Render")
+    
+    print(f"Generaciones simultáneas: {os.getenv('JOB_WORKERS', '4')}")
+    print("\nPresiona Ctrl+C para detener el worker\n")
+    
+    from backend.worker import main as run_worker
+    return run_worker()
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        print("\n\nWorker detenido. Hasta luego!")
+    except Exception as e:
+        print(f"\nError al iniciar el worker: {e}")
+        sys.exit(1)
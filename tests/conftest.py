@@ -0,0 +1,18 @@
+"""
+Fixtures compartidas de las pruebas
+"""
+
+import pytest
+
+from backend.database import DatabaseManager
+
+
+@pytest.fixture
+def db_manager():
+    """
+    Base de datos SQLite en memoria con todas las tablas
+    """
+    manager = DatabaseManager("sqlite://")
+    manager.create_tables()
+    yield manager
+    manager.close()
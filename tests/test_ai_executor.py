@@ -0,0 +1,194 @@
+"""
+Pruebas del ejecutor acotado de las llamadas a Gemini (backend/ai_executor.py)
+"""
+
+import asyncio
+import threading
+from typing import Optional
+
+import pytest
+
+from backend.ai_executor import AIExecutor, AIExecutorSaturated
+
+
+@pytest.fixture
+def executor():
+    """
+    Ejecutor pequeño para las pruebas
+    """
+    executor = AIExecutor(max_workers=1, max_queue=1, name="test")
+    yield executor
+    executor.shutdown()
+
+
+def collect(executor: AIExecutor, iterator_factory, *args, **kwargs):
+    """
+    Consume AIExecutor.stream hasta el final y devuelve sus elementos
+    """
+    async def consume():
+        return [item async for item in executor.stream(iterator_factory, *args, **kwargs)]
+
+    return asyncio.run(asyncio.wait_for(consume(), timeout=5))
+
+
+def test_run_returns_the_function_result(executor):
+    """
+    run() ejecuta la función en un hilo del pool y devuelve su resultado
+    """
+    async def main():
+        return await executor.run(lambda a, b=0: (a + b, threading.current_thread().name), 2, b=3)
+
+    result, thread_name = asyncio.run(main())
+    assert result == 5
+    assert thread_name.startswith("test-worker")
+    assert executor.stats()["queued"] == 0
+
+
+def test_run_propagates_errors(executor):
+    """
+    El error de la función llega a quien la espera
+    """
+    def fail():
+        raise ValueError("falló")
+
+    with pytest.raises(ValueError, match="falló"):
+        asyncio.run(executor.run(fail))
+
+
+def test_submit_rejects_when_workers_and_queue_are_full(executor):
+    """
+    Con el hilo ocupado y la cola llena se responde AIExecutorSaturated en lugar de encolar sin límite
+    """
+    release = threading.Event()
+    running = executor.submit(release.wait)
+    queued = executor.submit(release.wait)
+    try:
+        with pytest.raises(AIExecutorSaturated):
+            executor.submit(release.wait)
+    finally:
+        release.set()
+    running.result(timeout=5)
+    queued.result(timeout=5)
+
+
+def test_cancelled_queued_task_frees_its_slot(executor):
+    """
+    Una tarea cancelada antes de empezar devuelve su lugar en la cola
+    """
+    release = threading.Event()
+    running = executor.submit(release.wait)
+    queued = executor.submit(release.wait)
+    assert queued.cancel()
+    assert executor.stats()["queued"] == 0
+    release.set()
+    running.result(timeout=5)
+    assert executor.submit(lambda: "ok").result(timeout=5) == "ok"
+
+
+class FakeStream:
+    """
+    Iterador síncrono como el streaming de Gemini: registra cuántos elementos se pidieron y si se cerró
+    """
+
+    def __init__(self, count: int, fail_after: Optional[int] = None, delay: float = 0):
+        self.count = count
+        self.fail_after = fail_after
+        self.delay = delay
+        self.pulled = 0
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.fail_after is not None and self.pulled == self.fail_after:
+            raise ConnectionError("stream cortado")
+        if self.pulled == self.count or self.closed.is_set():
+            raise StopIteration
+        if self.delay:
+            self.closed.wait(self.delay)
+        self.pulled += 1
+        return self.pulled
+
+    def close(self):
+        self.closed.set()
+
+
+def test_stream_yields_items_in_order_and_closes_the_iterator(executor):
+    """
+    Los elementos llegan en orden y el iterador síncrono se cierra al terminar
+    """
+    stream = FakeStream(5)
+    assert collect(executor, lambda: stream) == [1, 2, 3, 4, 5]
+    assert stream.closed.wait(5)
+
+
+def test_stream_error_after_items_reaches_consumer(executor):
+    """
+    Un error a mitad del stream llega al consumidor después de los elementos ya producidos
+    """
+    stream = FakeStream(5, fail_after=2)
+    received = []
+
+    async def consume():
+        async for item in executor.stream(lambda: stream):
+            received.append(item)
+
+    with pytest.raises(ConnectionError, match="stream cortado"):
+        asyncio.run(asyncio.wait_for(consume(), timeout=5))
+    assert received == [1, 2]
+    assert stream.closed.wait(5)
+
+
+def test_stream_stops_producer_when_consumer_leaves(executor):
+    """
+    Si el consumidor deja de leer (cliente desconectado), el hilo deja de pedir
+    elementos, cierra el iterador y libera su lugar en el pool
+    """
+    stream = FakeStream(1000, delay=0.01)
+
+    async def consume_two():
+        stream_iterator = executor.stream(lambda: stream, queue_size=1)
+        received = [await stream_iterator.__anext__(), await stream_iterator.__anext__()]
+        await stream_iterator.aclose()
+        return received
+
+    assert asyncio.run(asyncio.wait_for(consume_two(), timeout=5)) == [1, 2]
+    assert stream.closed.wait(5)
+    assert stream.pulled < 1000
+    assert executor.submit(lambda: "libre").result(timeout=5) == "libre"
+
+
+def test_stream_cancelled_consumer_closes_the_iterator(executor):
+    """
+    Cancelar la tarea que consume el stream también detiene al productor
+    """
+    stream = FakeStream(1000, delay=0.01)
+
+    async def main():
+        started = asyncio.Event()
+
+        async def consume():
+            async for _ in executor.stream(lambda: stream, queue_size=1):
+                started.set()
+
+        task = asyncio.create_task(consume())
+        await asyncio.wait_for(started.wait(), timeout=5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert stream.closed.wait(5)
+    assert stream.pulled < 1000
+
+
+def test_stream_factory_error_reaches_consumer(executor):
+    """
+    Si la función que abre el stream falla, el consumidor recibe el error en lugar de esperar para siempre
+    """
+    def failing_factory():
+        raise ConnectionError("no se pudo abrir el stream")
+
+    with pytest.raises(ConnectionError, match="no se pudo abrir el stream"):
+        collect(executor, failing_factory)
@@ -0,0 +1,111 @@
+"""
+Pruebas del circuit breaker por modelo (backend/circuit_breaker.py)
+"""
+
+import time
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+from backend.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreakerRegistry, CircuitOpenError
+from backend.deadline import GenerationDeadlineExceeded
+
+
+def fail(registry: CircuitBreakerRegistry, model_name: str, probe=None):
+    """
+    Registra un fallo transitorio de una llamada al modelo
+    """
+    with pytest.raises(google_exceptions.ServiceUnavailable):
+        with registry.track(model_name, probe) as call:
+            call.start()
+            raise google_exceptions.ServiceUnavailable("overloaded")
+
+
+def succeed(registry: CircuitBreakerRegistry, model_name: str, probe=None):
+    """
+    Registra una llamada exitosa al modelo
+    """
+    with registry.track(model_name, probe) as call:
+        call.start()
+
+
+def open_circuit(registry: CircuitBreakerRegistry) -> str:
+    """
+    Abre el circuito de 'pro' con fallos seguidos
+    """
+    for _ in range(registry.failure_threshold):
+        model_name, probe = registry.choose(["pro"])
+        fail(registry, model_name, probe)
+    assert registry.stats()["pro"]["state"] == OPEN
+    return "pro"
+
+
+def test_only_the_probe_closes_a_half_open_circuit():
+    """
+    Una llamada que empezó antes de abrirse el circuito no lo cierra al terminar bien
+    """
+    registry = CircuitBreakerRegistry(failure_threshold=2, reset_seconds=0.05)
+    model_name, stale_probe = registry.choose(["pro"])
+    assert stale_probe is None
+    open_circuit(registry)
+
+    time.sleep(0.06)
+    _, probe = registry.choose(["pro"])
+    assert probe is not None
+    assert registry.stats()["pro"]["state"] == HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        registry.choose(["pro"])
+
+    succeed(registry, model_name, stale_probe)
+    assert registry.stats()["pro"]["state"] == HALF_OPEN
+
+    succeed(registry, "pro", probe)
+    assert registry.stats()["pro"]["state"] == CLOSED
+
+
+def test_non_probe_failure_does_not_reopen_or_release_the_probe():
+    """
+    El fallo de otra llamada no decide el circuito ni libera la prueba en curso
+    """
+    registry = CircuitBreakerRegistry(failure_threshold=2, reset_seconds=0.05)
+    stale_name, stale_probe = registry.choose(["pro"])
+    open_circuit(registry)
+
+    time.sleep(0.06)
+    _, probe = registry.choose(["pro"])
+    fail(registry, stale_name, stale_probe)
+    assert registry.stats()["pro"]["state"] == HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        registry.choose(["pro"])
+
+    fail(registry, "pro", probe)
+    assert registry.stats()["pro"]["state"] == OPEN
+
+
+def test_falls_back_while_the_primary_is_open():
+    """
+    Con el circuito del principal abierto se elige el primer modelo de respaldo
+    """
+    registry = CircuitBreakerRegistry(failure_threshold=2, reset_seconds=60)
+    open_circuit(registry)
+    assert registry.choose(["pro", "flash"]) == ("flash", None)
+
+
+def test_expired_deadline_does_not_open_the_circuit():
+    """
+    Un documento que agota el plazo de la generación no cuenta como fallo del modelo; un stream trabado sí
+    """
+    registry = CircuitBreakerRegistry(failure_threshold=2, reset_seconds=60)
+    for _ in range(registry.failure_threshold):
+        with pytest.raises(GenerationDeadlineExceeded):
+            with registry.track("pro") as call:
+                call.start()
+                raise GenerationDeadlineExceeded("Plazo de 300 segundos agotado")
+    assert registry.stats()["pro"]["state"] == CLOSED
+
+    for _ in range(registry.failure_threshold):
+        with pytest.raises(GenerationDeadlineExceeded):
+            with registry.track("pro") as call:
+                call.start()
+                raise GenerationDeadlineExceeded("Stream cortado", stalled=True)
+    assert registry.stats()["pro"]["state"] == OPEN
@@ -0,0 +1,64 @@
+"""
+Pruebas de la unión de continuaciones (backend/continuation.py)
+"""
+
+from backend.continuation import MIN_OVERLAP, OVERLAP_WINDOW, SeamStitcher, trim_overlap
+
+
+PREVIOUS = "Por medio de la presente declaro que el solicitante trabajó en la empresa durante cinco años"
+
+
+def test_trim_overlap_removes_repeated_tail():
+    """
+    Se recorta el inicio de la continuación que repite el final del texto anterior
+    """
+    assert trim_overlap(PREVIOUS, "empresa durante cinco años, cumpliendo sus funciones") == ", cumpliendo sus funciones"
+
+
+def test_trim_overlap_keeps_short_or_missing_overlap():
+    """
+    Un solape menor que MIN_OVERLAP puede ser legítimo y se conserva
+    """
+    short = PREVIOUS[-(MIN_OVERLAP - 1):]
+    assert trim_overlap(PREVIOUS, short + " y más") == short + " y más"
+    assert trim_overlap(PREVIOUS, " con excelentes resultados.") == " con excelentes resultados."
+
+
+def test_trim_overlap_handles_full_repetition():
+    """
+    Si la continuación solo repite el final, no queda nada que añadir
+    """
+    assert trim_overlap(PREVIOUS, PREVIOUS[-40:]) == ""
+
+
+def test_stitcher_first_part_passes_through():
+    """
+    La primera parte no tiene texto anterior y sus chunks pasan sin retenerse
+    """
+    stitcher = SeamStitcher("")
+    assert stitcher.feed("Hola") == "Hola"
+    assert stitcher.flush() == ""
+
+
+def test_stitcher_holds_start_until_window_then_trims():
+    """
+    El inicio se retiene hasta llenar la ventana; después se recorta el solape y se deja pasar el resto
+    """
+    stitcher = SeamStitcher(PREVIOUS)
+    repeated = "durante cinco años"
+    filler = "x" * OVERLAP_WINDOW
+    assert stitcher.feed(repeated) == ""
+    assert stitcher.feed(filler) == filler
+    assert stitcher.feed(" fin") == " fin"
+    assert stitcher.flush() == ""
+
+
+def test_stitcher_flush_trims_short_continuation():
+    """
+    Una continuación más corta que la ventana se entrega al terminar, sin el solape
+    """
+    stitcher = SeamStitcher(PREVIOUS)
+    assert stitcher.feed("durante cinco ") == ""
+    assert stitcher.feed("años. Atentamente.") == ""
+    assert stitcher.flush() == ". Atentamente."
+    assert stitcher.flush() == ""
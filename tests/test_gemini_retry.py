@@ -0,0 +1,122 @@
+"""
+Pruebas de los reintentos de las llamadas a Gemini (backend/gemini_retry.py)
+"""
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+from backend.deadline import GenerationDeadlineExceeded
+from backend.gemini_retry import RetryPolicy, RetryRecord, call_with_retry, is_retryable, stream_with_retry
+
+
+# Sin espera entre intentos para que las pruebas no tarden
+POLICY = RetryPolicy(max_attempts=3, base_seconds=0, max_backoff_seconds=0)
+
+
+class FlakyStream:
+    """
+    Abre streams que fallan según un guion: cada entrada es el número de
+    chunks que produce el intento antes de fallar (None = termina bien)
+    """
+
+    def __init__(self, *script):
+        self.script = list(script)
+        self.opened = 0
+
+    def __call__(self):
+        fail_after = self.script[self.opened]
+        self.opened += 1
+        return self._chunks(fail_after)
+
+    def _chunks(self, fail_after):
+        for index in range(3):
+            if index == fail_after:
+                raise google_exceptions.ServiceUnavailable("overloaded")
+            yield f"chunk-{self.opened}-{index}"
+
+
+def test_is_retryable_classifies_transient_errors():
+    """
+    Los errores de saturación y de conexión se repiten; los de la solicitud no
+    """
+    assert is_retryable(google_exceptions.ServiceUnavailable("overloaded"))
+    assert is_retryable(google_exceptions.TooManyRequests("quota"))
+    assert is_retryable(ConnectionError("reset"))
+    assert not is_retryable(google_exceptions.InvalidArgument("bad prompt"))
+    assert not is_retryable(ValueError("bug"))
+    assert not is_retryable(None)
+    assert is_retryable(GenerationDeadlineExceeded("Stream cortado", stalled=True))
+    assert not is_retryable(GenerationDeadlineExceeded("Plazo agotado"))
+
+
+def test_call_with_retry_repeats_until_success():
+    """
+    Una llamada que falla con un error transitorio se repite y se registran los intentos
+    """
+    outcomes = [google_exceptions.ServiceUnavailable("overloaded"), "ok"]
+
+    def call():
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    record = RetryRecord()
+    assert call_with_retry(call, POLICY, record) == "ok"
+    assert record.attempts == 2
+    assert len(record.retries) == 1
+
+
+def test_call_with_retry_stops_at_max_attempts():
+    """
+    Al agotar los intentos se lanza el error del último
+    """
+    record = RetryRecord()
+
+    def call():
+        raise google_exceptions.ServiceUnavailable("overloaded")
+
+    with pytest.raises(google_exceptions.ServiceUnavailable):
+        call_with_retry(call, POLICY, record)
+    assert record.attempts == POLICY.max_attempts
+
+
+def test_stream_retries_before_first_chunk():
+    """
+    Un stream que falla antes de producir nada se abre de nuevo
+    """
+    open_stream = FlakyStream(0, None)
+    record = RetryRecord()
+    assert list(stream_with_retry(open_stream, POLICY, record)) == ["chunk-2-0", "chunk-2-1", "chunk-2-2"]
+    assert open_stream.opened == 2
+    assert record.attempts == 2
+
+
+def test_stream_does_not_retry_after_first_chunk():
+    """
+    Si el stream ya produjo texto, el error se propaga en lugar de repetir la llamada y duplicar el texto
+    """
+    open_stream = FlakyStream(1, None)
+    record = RetryRecord()
+    received = []
+    with pytest.raises(google_exceptions.ServiceUnavailable):
+        for chunk in stream_with_retry(open_stream, POLICY, record):
+            received.append(chunk)
+    assert received == ["chunk-1-0"]
+    assert open_stream.opened == 1
+    assert record.retries == []
+
+
+def test_retry_record_merge_sums_attempts():
+    """
+    merge() suma los intentos de otra llamada y toma su modelo
+    """
+    record = RetryRecord()
+    record.attempts, record.model = 1, "pro"
+    other = RetryRecord()
+    other.attempts, other.retries, other.model = 2, [("503", 1.0)], "flash"
+
+    record.merge(other)
+    assert record.attempts == 3
+    assert record.retries == [("503", 1.0)]
+    assert record.model == "flash"
@@ -0,0 +1,107 @@
+"""
+Pruebas del registro de generaciones para SSE (backend/generation_hub.py)
+"""
+
+import asyncio
+import json
+import time
+from datetime import datetime, timedelta
+
+from backend.database import GenerationEventRepository, JobRepository
+from backend.generation_hub import GenerationHub
+from backend.models import GenerationEvent
+
+
+def content_producer(count: int):
+    """
+    Productor que publica count chunks y el evento final
+    """
+    async def producer(generation):
+        for index in range(count):
+            generation.publish({"type": "content", "chunk": str(index)})
+            await asyncio.sleep(0)
+        generation.publish({"type": "complete"})
+
+    return producer
+
+
+def test_spilled_events_are_replayed_in_order(db_manager):
+    """
+    Los eventos que se vaciaron a SQLite se reenvían en orden a quien se une tarde
+    """
+    async def main():
+        hub = GenerationHub(db_manager, max_memory_events=4)
+        generation = hub.start("declaration", 1, content_producer(20))
+        await generation.task
+        assert generation._first_memory_seq > 1
+        return [json.loads(payload) async for _, payload in hub.follow(generation)]
+
+    events = asyncio.run(main())
+    assert [event.get("chunk") for event in events[:-1]] == [str(index) for index in range(20)]
+    assert events[-1] == {"type": "complete"}
+
+
+def test_persisted_events_are_saved_when_the_task_ends(db_manager):
+    """
+    Con persist_events, al terminar la tarea todos los eventos ya están en SQLite para el proceso web
+    """
+    async def main():
+        hub = GenerationHub(db_manager, persist_events=True, persist_interval_seconds=60)
+        generation = hub.start("declaration", 1, content_producer(5))
+        await generation.task
+        return [json.loads(payload) for _, payload in hub.load_persisted(generation.generation_id, 0)]
+
+    events = asyncio.run(main())
+    assert len(events) == 6
+    assert events[-1] == {"type": "complete"}
+
+
+def test_publish_does_not_wait_for_sqlite(db_manager):
+    """
+    publish() no bloquea el event loop aunque el guardado en SQLite sea lento
+    """
+    hub = GenerationHub(db_manager, max_memory_events=2)
+    save_spilled = hub._save_spilled
+
+    def slow_save(generation_id, events):
+        time.sleep(0.3)
+        return save_spilled(generation_id, events)
+
+    hub._save_spilled = slow_save
+
+    async def producer(generation):
+        started = time.monotonic()
+        for index in range(10):
+            generation.publish({"type": "content", "chunk": str(index)})
+        assert time.monotonic() - started < 0.1
+        generation.publish({"type": "complete"})
+
+    async def main():
+        generation = hub.start("declaration", 1, producer)
+        await generation.task
+        return [seq async for seq, _ in hub.follow(generation)]
+
+    assert asyncio.run(main()) == list(range(1, 12))
+
+
+def test_startup_purge_keeps_events_of_active_jobs(db_manager):
+    """
+    Al iniciar, solo se eliminan los eventos antiguos de generaciones sin un trabajo activo
+    """
+    db = db_manager.get_session()
+    try:
+        events = GenerationEventRepository(db)
+        events.save_events("en-curso", [(1, "{}")])
+        events.save_events("terminada", [(1, "{}")])
+        jobs = JobRepository(db)
+        jobs.create_job("declaration", 1).generation_id = "en-curso"
+        finished = jobs.create_job("cover", 1)
+        finished.generation_id, finished.status = "terminada", "completed"
+        db.query(GenerationEvent).update({GenerationEvent.created_at: datetime.utcnow() - timedelta(hours=1)})
+        db.commit()
+    finally:
+        db.close()
+
+    hub = GenerationHub(db_manager, retention_seconds=60)
+    assert hub.load_persisted("en-curso", 0) == [(1, "{}")]
+    assert hub.load_persisted("terminada", 0) == []
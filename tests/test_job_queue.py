@@ -0,0 +1,153 @@
+"""
+Pruebas de la cola persistente de generaciones (backend/job_queue.py)
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from backend.database import DocumentRepository
+from backend.job_queue import JobQueue
+from backend.models import GenerationJob
+
+
+ERROR_503 = {"type": "error", "error": "Gemini saturado", "status_code": 503}
+
+
+@pytest.fixture
+def document_id(db_manager):
+    """
+    Documento al que pertenecen los trabajos
+    """
+    db = db_manager.get_session()
+    try:
+        return DocumentRepository(db).create_document("a.pdf", "a.pdf", 100, "application/pdf").id
+    finally:
+        db.close()
+
+
+def make_queue(db_manager, **kwargs) -> JobQueue:
+    """
+    Cola sin espera entre reintentos, para tomar el trabajo de nuevo enseguida
+    """
+    kwargs.setdefault("retry_base_seconds", 0)
+    return JobQueue(db_manager, **kwargs)
+
+
+def expire_lease(db_manager, job_id: int):
+    """
+    Vence el lease de un trabajo como si su worker se hubiera detenido
+    """
+    db = db_manager.get_session()
+    try:
+        db.query(GenerationJob).filter(GenerationJob.id == job_id).update(
+            {GenerationJob.lease_expires_at: datetime.utcnow() - timedelta(seconds=1)}
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def test_submit_coalesces_active_job(db_manager, document_id):
+    """
+    Un segundo envío del mismo documento y tipo devuelve el trabajo pendiente
+    """
+    queue = make_queue(db_manager)
+    first = queue.submit("declaration", document_id)
+    assert queue.submit("declaration", document_id).id == first.id
+    assert queue.submit("cover", document_id).id != first.id
+
+
+def test_expired_lease_is_reclaimed_by_another_worker(db_manager, document_id):
+    """
+    Si el worker deja de enviar heartbeats, otro worker retoma el trabajo y el primero lo pierde
+    """
+    first_worker = make_queue(db_manager)
+    second_worker = make_queue(db_manager)
+    job = first_worker.submit("declaration", document_id)
+
+    claimed = first_worker.claim()
+    assert claimed.id == job.id and claimed.attempts == 1
+    assert second_worker.claim() is None
+
+    expire_lease(db_manager, job.id)
+    reclaimed = second_worker.claim()
+    assert reclaimed.id == job.id
+    assert reclaimed.attempts == 2
+    assert reclaimed.lease_owner == second_worker.worker_id
+    assert not first_worker.heartbeat(claimed)
+    assert second_worker.heartbeat(reclaimed)
+
+
+def test_expired_lease_on_last_attempt_fails_the_job(db_manager, document_id):
+    """
+    Un trabajo que se interrumpió en su último intento se marca como fallido en lugar de retomarse
+    """
+    queue = make_queue(db_manager, max_attempts=1)
+    job = queue.submit("declaration", document_id)
+    queue.claim()
+    expire_lease(db_manager, job.id)
+
+    assert queue.claim() is None
+    assert queue.get(job.id).status == "failed"
+
+
+def test_release_requeues_without_counting_the_attempt(db_manager, document_id):
+    """
+    Al apagar, el trabajo vuelve a la cola sin gastar un intento
+    """
+    queue = make_queue(db_manager)
+    job = queue.submit("declaration", document_id)
+    claimed = queue.claim()
+    queue.release(claimed)
+
+    released = queue.get(job.id)
+    assert released.status == "queued"
+    assert released.attempts == 0
+    assert released.lease_owner is None
+    assert queue.claim().attempts == 1
+
+
+@pytest.mark.parametrize("final_event, attempts, expected", [
+    ({"type": "error", "status_code": 503}, 1, True),
+    ({"type": "error", "status_code": 504}, 2, True),
+    ({"type": "error", "status_code": 503}, 3, False),
+    ({"type": "error", "status_code": 500}, 1, False),
+    ({"type": "error", "status_code": 499}, 1, False),
+    ({"type": "error"}, 1, False),
+    ({"type": "complete"}, 1, False),
+])
+def test_will_retry_only_transient_errors_with_attempts_left(db_manager, final_event, attempts, expected):
+    """
+    Solo se reintentan los errores transitorios (503/504) mientras queden intentos
+    """
+    queue = make_queue(db_manager)
+    job = GenerationJob(attempts=attempts, max_attempts=3)
+    assert queue.will_retry(job, final_event) is expected
+
+
+def test_finish_requeues_transient_error_and_fails_after_max_attempts(db_manager, document_id):
+    """
+    Un 503 vuelve a la cola hasta agotar los intentos; entonces el trabajo queda fallido
+    """
+    queue = make_queue(db_manager, max_attempts=2)
+    job = queue.submit("declaration", document_id)
+
+    queue.finish(queue.claim(), ERROR_503)
+    assert queue.get(job.id).status == "queued"
+
+    claimed = queue.claim()
+    assert claimed.attempts == 2
+    queue.finish(claimed, ERROR_503)
+    assert queue.get(job.id).status == "failed"
+    assert queue.claim() is None
+
+
+def test_finish_does_not_retry_application_errors(db_manager, document_id):
+    """
+    Un 500 marca el trabajo como fallido en el primer intento
+    """
+    queue = make_queue(db_manager)
+    job = queue.submit("declaration", document_id)
+    queue.finish(queue.claim(), {"type": "error", "error": "documento inválido", "status_code": 500})
+    assert queue.get(job.id).status == "failed"
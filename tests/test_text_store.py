@@ -0,0 +1,141 @@
+"""
+Pruebas del almacén del texto extraído (backend/text_store.py)
+"""
+
+import hashlib
+import threading
+
+from backend.database import ExtractedTextRepository
+from backend.text_store import ExtractedTextStore, file_sha256
+
+
+class CountingExtractor:
+    """
+    Extractor que cuenta sus llamadas y devuelve un texto fijo
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, file_path: str) -> str:
+        with self._lock:
+            self.calls += 1
+        return self.text
+
+
+def test_file_sha256_matches_hashlib(tmp_path):
+    """
+    El hash por bloques coincide con el de todo el contenido
+    """
+    path = tmp_path / "cuestionario.txt"
+    path.write_bytes(b"a" * (3 * 1024 * 1024 + 7))
+    assert file_sha256(str(path)) == hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def test_round_trip_extracts_once(db_manager, tmp_path):
+    """
+    El texto se extrae una vez, se guarda comprimido y se devuelve igual en las siguientes
+    """
+    path = tmp_path / "cuestionario.txt"
+    path.write_text("contenido")
+    text = "Nombre: María\nPaís: Honduras\n" * 200
+    extractor = CountingExtractor(text)
+    store = ExtractedTextStore(db_manager)
+
+    assert store.get_or_extract(str(path), extractor) == text
+    assert store.get_or_extract(str(path), extractor) == text
+    assert ExtractedTextStore(db_manager).get_or_extract(str(path), extractor) == text
+    assert extractor.calls == 1
+
+    db = db_manager.get_session()
+    try:
+        stored = ExtractedTextRepository(db).get_by_file_hash(file_sha256(str(path)))
+        assert stored.text_length == len(text)
+        assert len(stored.text_compressed) < len(text.encode("utf-8"))
+    finally:
+        db.close()
+
+
+def test_given_file_hash_is_used_as_key(db_manager, tmp_path):
+    """
+    Con el hash ya conocido no se vuelve a calcular: es la clave del texto guardado
+    """
+    path = tmp_path / "cuestionario.txt"
+    path.write_text("contenido")
+    extractor = CountingExtractor("texto")
+    store = ExtractedTextStore(db_manager)
+
+    store.get_or_extract(str(path), extractor, file_hash="ab" * 32)
+    assert store.get_or_extract(str(path), extractor, file_hash="ab" * 32) == "texto"
+    assert extractor.calls == 1
+
+
+def test_empty_text_is_not_saved(db_manager, tmp_path):
+    """
+    Un resultado vacío (p. ej. falta una dependencia) se vuelve a extraer la próxima vez
+    """
+    path = tmp_path / "escaneado.pdf"
+    path.write_bytes(b"%PDF")
+    extractor = CountingExtractor("  ")
+    store = ExtractedTextStore(db_manager)
+
+    store.get_or_extract(str(path), extractor)
+    store.get_or_extract(str(path), extractor)
+    assert extractor.calls == 2
+
+
+def test_corrupted_text_is_extracted_again(db_manager, tmp_path):
+    """
+    Si el texto guardado no coincide con su hash, se descarta y se extrae de nuevo
+    """
+    path = tmp_path / "cuestionario.txt"
+    path.write_text("contenido")
+    extractor = CountingExtractor("texto original")
+    store = ExtractedTextStore(db_manager)
+    store.get_or_extract(str(path), extractor)
+
+    db = db_manager.get_session()
+    try:
+        stored = ExtractedTextRepository(db).get_by_file_hash(file_sha256(str(path)))
+        stored.text_sha256 = "0" * 64
+        db.commit()
+    finally:
+        db.close()
+
+    assert store.get_or_extract(str(path), extractor) == "texto original"
+    assert extractor.calls == 2
+
+
+def test_concurrent_requests_extract_once(db_manager, tmp_path):
+    """
+    Dos solicitudes simultáneas del mismo archivo comparten una sola extracción
+    """
+    path = tmp_path / "cuestionario.txt"
+    path.write_text("contenido")
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_extractor(file_path: str) -> str:
+        calls.append(file_path)
+        started.set()
+        release.wait(5)
+        return "texto"
+
+    store = ExtractedTextStore(db_manager)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(store.get_or_extract(str(path), slow_extractor)))
+        for _ in range(2)
+    ]
+    threads[0].start()
+    started.wait(5)
+    threads[1].start()
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert results == ["texto", "texto"]
+    assert len(calls) == 1
@@ -0,0 +1,115 @@
+"""
+Pruebas del límite de tamaño de las subidas (backend/uploads.py)
+"""
+
+import asyncio
+import json
+
+from backend.uploads import MULTIPART_OVERHEAD_BYTES, UploadSizeLimitMiddleware
+
+
+MAX_BYTES = 1024
+LIMIT_BODY_BYTES = MAX_BYTES + MULTIPART_OVERHEAD_BYTES
+DETAIL = "El archivo excede el tamaño máximo"
+
+
+async def echo_app(scope, receive, send):
+    """
+    Aplicación que lee todo el cuerpo y responde cuántos bytes recibió
+    """
+    size = 0
+    while True:
+        message = await receive()
+        size += len(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    body = json.dumps({"size": size}).encode()
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def fastapi_like_app(scope, receive, send):
+    """
+    Aplicación que, como FastAPI, convierte un error al leer el cuerpo en su propio 400
+    """
+    try:
+        await echo_app(scope, receive, send)
+    except Exception:
+        await send({"type": "http.response.start", "status": 400, "headers": []})
+        await send({"type": "http.response.body", "body": b'{"detail":"There was an error parsing the body"}'})
+
+
+def call(app, path="/api/upload", chunks=(b"",), method="POST", content_length=None):
+    """
+    Envía una solicitud al middleware con el cuerpo en bloques
+
+    Returns:
+        tuple: (status, cuerpo JSON, bloques leídos por la aplicación)
+    """
+    middleware = UploadSizeLimitMiddleware(app, {"/api/upload": (MAX_BYTES, DETAIL)})
+    headers = [] if content_length is None else [(b"content-length", str(content_length).encode())]
+    scope = {"type": "http", "method": method, "path": path, "headers": headers}
+    pending = list(chunks)
+    read = []
+    sent = []
+
+    async def receive():
+        chunk = pending.pop(0)
+        read.append(chunk)
+        return {"type": "http.request", "body": chunk, "more_body": bool(pending)}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(middleware(scope, receive, send))
+    status = sent[0]["status"]
+    body = json.loads(b"".join(message.get("body", b"") for message in sent[1:]))
+    return status, body, len(read)
+
+
+def test_small_upload_passes_through():
+    """
+    Un cuerpo dentro del límite llega entero a la aplicación
+    """
+    status, body, _ = call(echo_app, chunks=[b"a" * 500, b"b" * 500])
+    assert status == 200
+    assert body == {"size": 1000}
+
+
+def test_declared_content_length_over_limit_is_rejected_without_reading():
+    """
+    Con Content-Length mayor al límite se responde 400 sin llamar a la aplicación
+    """
+    status, body, read = call(echo_app, chunks=[b"a"], content_length=LIMIT_BODY_BYTES + 1)
+    assert status == 400
+    assert body == {"detail": DETAIL}
+    assert read == 0
+
+
+def test_streamed_body_is_cut_as_soon_as_it_exceeds_the_limit():
+    """
+    Sin Content-Length, la subida se corta en el bloque que supera el límite
+    """
+    chunk = b"x" * (LIMIT_BODY_BYTES // 4)
+    status, body, read = call(echo_app, chunks=[chunk] * 20)
+    assert status == 400
+    assert body == {"detail": DETAIL}
+    assert read == 5
+
+
+def test_application_error_response_is_replaced_by_size_message():
+    """
+    El 400 genérico de la aplicación al fallar la lectura se reemplaza por el mensaje de tamaño
+    """
+    status, body, _ = call(fastapi_like_app, chunks=[b"x" * (LIMIT_BODY_BYTES + 1)])
+    assert status == 400
+    assert body == {"detail": DETAIL}
+
+
+def test_other_paths_and_methods_are_not_limited():
+    """
+    Solo se limitan los POST a las rutas de subida configuradas
+    """
+    big = [b"x" * (LIMIT_BODY_BYTES + 1)]
+    assert call(echo_app, path="/api/chat", chunks=big)[0] == 200
+    assert call(echo_app, method="PUT", chunks=big)[0] == 200